@@ -0,0 +1,91 @@
+"""
+harness.py - timing things and writing down the results.
+
+Every result is one JSON document per line, tagged with what was run,
+with which parameters, on which commit, so that runs from different
+days can be lined up against each other.
+"""
+from datetime import datetime, timezone
+import json
+import platform
+import subprocess
+import time
+from typing import Callable, Dict, IO, List, Optional
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1,
+                max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+class Timings:
+    """
+    How long each of a number of operations took, in seconds, and how
+    long all of them took together.
+    """
+
+    def __init__(self) -> None:
+        self.latencies = []  # type: List[float]
+        self.wall_seconds = 0.0
+        self.operations = 0
+
+    def time(self, operation: Callable[[], object]) -> object:
+        started = time.perf_counter()
+        result = operation()
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+    def summary(self) -> Dict[str, object]:
+        latencies = sorted(self.latencies)
+        operations = self.operations or len(latencies)
+        wall = self.wall_seconds or sum(latencies)
+        return {
+            'operations': operations,
+            'seconds': round(wall, 6),
+            'per_second': round(operations / wall, 3) if wall else None,
+            'latency': {
+                'mean': round(sum(latencies) / len(latencies), 6)
+                if latencies else None,
+                'p50': round(percentile(latencies, 0.50), 6),
+                'p95': round(percentile(latencies, 0.95), 6),
+                'p99': round(percentile(latencies, 0.99), 6),
+                'max': round(latencies[-1], 6) if latencies else None,
+            },
+        }
+
+
+class Results:
+    def __init__(self, out: IO[str]) -> None:
+        self._out = out
+        self._context = {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        }
+
+    def record(self,
+               benchmark: str,
+               params: Dict[str, object],
+               timings: Timings) -> None:
+        result = {
+            'benchmark': benchmark,
+            'params': params,
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+        }
+        result.update(timings.summary())
+        result.update(self._context)
+        self._out.write(json.dumps(result, sort_keys=True))
+        self._out.write('\n')
+        self._out.flush()
@@ -0,0 +1,260 @@
+"""
+Benchmarks for the observe, diff and persist hot path.
+
+Each benchmark writes one JSON line of results (throughput, and latency
+percentiles in seconds) to stdout or to --output, which is appended to,
+so results from successive runs accumulate in one file. Run from the
+root of the repository, with `src` on the path:
+
+    PYTHONPATH=src python -m benchmarks.run --records=1000000
+
+Usage:
+    run [--only=<names>] [--records=<n>] [--urls=<n>] [--queries=<n>]
+        [--page-size=<sizes>] [--page-shape=<shapes>]
+        [--change-every=<n>] [--pages=<n>]
+        [--rounds=<n>] [--workers=<n>] [--storage=<backend>]
+        [--durability=<policy>] [--batch-size=<n>] [--output=<file>]
+
+Options:
+    --only=<names>          Comma-separated benchmarks to run, out of
+                            persist, query, decode, diff and observe
+                            [default: persist,query,decode,diff,observe]
+    --records=<n>           How many records to fill storage with before
+                            timing queries or decoding [default: 10000]
+    --urls=<n>              How many different pages those records are
+                            spread over [default: 100]
+    --queries=<n>           How many of each kind of query to time
+                            [default: 50]
+    --page-size=<sizes>     Comma-separated sizes of synthetic page, in
+                            bytes, to run each page benchmark with
+                            [default: 50000,1000000]
+    --page-shape=<shapes>   Comma-separated kinds of synthetic page, out
+                            of distinct (every row different) and
+                            repetitive (the same markup over and over)
+                            [default: distinct,repetitive]
+    --change-every=<n>      A page changes every <n> times it's fetched
+                            [default: 2]
+    --pages=<n>             How many pages of the smallest size to
+                            persist, diff or observe per round; larger
+                            pages are taken proportionally fewer at a
+                            time [default: 50]
+    --rounds=<n>            How many rounds to time [default: 5]
+    --workers=<n>           Workers for observe_the_web [default: 4]
+    --storage=<backend>     Record store backend [default: jsonlines]
+    --durability=<policy>   Storage durability, `none` or `fsync`
+                            [default: none]
+    --batch-size=<n>        Persist in batches of this many; 1 commits
+                            each observation by itself [default: 1]
+    --output=<file>         Append results to this file, not stdout
+"""
+from contextlib import ExitStack, redirect_stdout
+from datetime import datetime, timezone
+import io
+import itertools
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+import docopt
+
+from webwatcher.artefact import Artefact
+from webwatcher.contentdiff import ContentDiffer
+from webwatcher.diffa import Diffa
+from webwatcher.main import Observer, observe_the_web
+from webwatcher.observation import PageObservation
+from webwatcher.recordstore import open_record_store
+from webwatcher.storage import Storage
+from webwatcher.temporarystorage import TemporaryStorage
+from webwatcher.watchconfiguration import PageUnderObsevation
+from webwatcher.webfetcher import WebFetcher
+
+from benchmarks.harness import Results, Timings
+from benchmarks.synthetic import PAGE_SHAPES, PageServer, page, records
+
+
+class _NoScreenshots:
+    def take_screenshot_of(self, url):
+        return None
+
+
+def _write(directory, name, content) -> str:
+    path = Path(directory) / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def _page_variants(args):
+    """
+    Each size and shape of page to benchmark, and how many pages of it
+    to take per round, so that a round covers about as many bytes
+    whatever the size.
+    """
+    smallest = min(args['--page-size'])
+    for size in args['--page-size']:
+        for shape in args['--page-shape']:
+            yield size, shape, max(1, args['--pages'] * smallest // size)
+
+
+def bench_persist(results, args, workdir):
+    for size, shape, pages in _page_variants(args):
+        storage = Storage(
+            storage_root=Path(workdir) / 'persist-{}-{}'.format(shape, size),
+            backend=args['--storage'],
+            durability=args['--durability'])
+        timings = Timings()
+        started = time.perf_counter()
+        with storage.batch(max_records=args['--batch-size']) \
+                if args['--batch-size'] > 1 else ExitStack():
+            for n in range(args['--rounds'] * pages):
+                url = 'https://site{}.example.com/'.format(n % pages)
+                content = _write(workdir, 'page',
+                                 page(size, n, shape=shape))
+                observation = PageObservation(
+                    url, datetime.now(timezone.utc), True, None,
+                    Artefact(content, disposable=True))
+                timings.time(lambda: storage.persist(observation))
+        # Including the final commit
+        timings.wall_seconds = time.perf_counter() - started
+        results.record('persist', {'page_size': size,
+                                   'page_shape': shape,
+                                   'storage': args['--storage'],
+                                   'durability': args['--durability'],
+                                   'batch_size': args['--batch-size']},
+                       timings)
+
+
+def bench_query(results, args, workdir):
+    root = Path(workdir) / 'query'
+    root.mkdir()
+    open_record_store(args['--storage'], root).replace_all(
+        records(args['--records'], args['--urls']))
+    storage = Storage(storage_root=root, backend=args['--storage'])
+    params = {'records': args['--records'],
+              'urls': args['--urls'],
+              'storage': args['--storage']}
+    urls = ['https://site{}.example.com/page'.format(i % args['--urls'])
+            for i in range(args['--queries'])]
+
+    queries = [
+        ('query_fetch', lambda url: storage.find(url=url)
+            .having('timestamp').order_by('timestamp', desc=True).fetch()),
+        ('query_first', lambda url: storage.find(url=url)
+            .having('timestamp').order_by('timestamp', desc=True).first()),
+        ('query_latest', storage.latest),
+    ]
+    for name, query in queries:
+        timings = Timings()
+        for url in urls:
+            timings.time(lambda: query(url))
+        results.record(name, params, timings)
+
+
+def bench_decode(results, args, workdir):
+    """
+    Reads every record back, dates and all, from each record store
+    backend in turn.
+    """
+    for backend in ('jsonlines', 'sqlite', 'binary'):
+        root = Path(workdir) / backend
+        root.mkdir()
+        store = open_record_store(backend, root)
+        store.replace_all(records(args['--records'], args['--urls']))
+        timings = Timings()
+        for _ in range(args['--rounds']):
+            timings.time(lambda: sum(1 for _ in store.scan({}, ())))
+        timings.operations = args['--records'] * args['--rounds']
+        results.record('decode', {'records': args['--records'],
+                                  'storage': backend}, timings)
+
+
+def bench_diff(results, args, workdir):
+    diffa = Diffa(content_differ=ContentDiffer())
+    now = datetime.now(timezone.utc)
+    for size, shape, pages in _page_variants(args):
+        observations = [
+            PageObservation('https://example.com/', now, True, None,
+                            Artefact(_write(workdir, 'v{}'.format(n),
+                                            page(size, n, shape=shape))))
+            for n in range(pages + 1)]
+        timings = Timings()
+        for _ in range(args['--rounds']):
+            for old, new in zip(observations, observations[1:]):
+                timings.time(lambda: diffa.diff(new, old))
+        results.record('diff', {'page_size': size,
+                                'page_shape': shape}, timings)
+
+
+def bench_observe(results, args, workdir):
+    temp = TemporaryStorage(dir=workdir)
+    watcher = Observer(_NoScreenshots(), WebFetcher(temp))
+    diffa = Diffa(content_differ=ContentDiffer())
+    for size, shape, pages in _page_variants(args):
+        storage = Storage(
+            storage_root=Path(workdir) / 'observe-{}-{}'.format(shape, size),
+            backend=args['--storage'])
+        timings = Timings()
+        with PageServer(size, args['--change-every'],
+                        page_shape=shape) as server:
+            watched = [
+                PageUnderObsevation(url='{}/page{}'.format(server.url, i))
+                for i in range(pages)]
+            for _ in range(args['--rounds']):
+                with redirect_stdout(io.StringIO()):
+                    timings.time(lambda: observe_the_web(
+                        diffa, storage, watcher, watched,
+                        workers=args['--workers']))
+        timings.operations = pages * args['--rounds']
+        timings.wall_seconds = sum(timings.latencies)
+        # Latencies here are of whole passes over every page
+        results.record('observe', {'page_size': size,
+                                   'page_shape': shape,
+                                   'change_every': args['--change-every'],
+                                   'pages': pages,
+                                   'workers': args['--workers'],
+                                   'storage': args['--storage']}, timings)
+
+
+_BENCHMARKS = {
+    'persist': bench_persist,
+    'query': bench_query,
+    'decode': bench_decode,
+    'diff': bench_diff,
+    'observe': bench_observe,
+}
+
+_NUMERIC = ('--records', '--urls', '--queries', '--change-every',
+            '--pages', '--rounds', '--workers', '--batch-size')
+
+
+def main() -> None:
+    args = docopt.docopt(__doc__)
+    for option in _NUMERIC:
+        args[option] = int(args[option])
+    args['--page-size'] = [int(size)
+                           for size in args['--page-size'].split(',')]
+    args['--page-shape'] = [shape.strip()
+                            for shape in args['--page-shape'].split(',')]
+    unknown_shapes = set(args['--page-shape']) - set(PAGE_SHAPES)
+    if unknown_shapes:
+        sys.exit('Unknown page shapes: {}'.format(
+            ', '.join(sorted(unknown_shapes))))
+    chosen = [name.strip() for name in args['--only'].split(',')]
+    unknown = set(chosen) - set(_BENCHMARKS)
+    if unknown:
+        sys.exit('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+
+    out = open(args['--output'], 'a', encoding='utf-8') \
+        if args['--output'] else sys.stdout
+    try:
+        results = Results(out)
+        for name in chosen:
+            with tempfile.TemporaryDirectory() as workdir:
+                _BENCHMARKS[name](results, args, workdir)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
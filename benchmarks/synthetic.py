@@ -0,0 +1,125 @@
+"""
+synthetic.py - made-up pages and observation records.
+"""
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import random
+from socketserver import ThreadingMixIn
+import threading
+import zlib
+from typing import Dict, Iterator
+
+
+PAGE_SHAPES = ('distinct', 'repetitive')
+
+
+def page(size: int, version: int, seed: int=0,
+         shape: str='distinct') -> bytes:
+    """
+    An HTML page of about `size` bytes. In a `distinct` page every row
+    is different, and successive versions differ in one table cell, as
+    real pages mostly change in one place. A `repetitive` page repeats
+    the same markup row after row, and every 97th row changes between
+    versions, which is the worst case for matching pages up.
+    """
+    if shape not in PAGE_SHAPES:
+        raise ValueError('Unknown page shape: {}'.format(shape))
+    rng = random.Random(seed)
+    rows = []
+    length = 0
+    i = 0
+    while length < size:
+        if shape == 'repetitive':
+            text = 'version {}'.format(version) if i % 97 == 7 else 'cell'
+            row = '<tr><td class="cell">{}</td></tr>\n'.format(text)
+        else:
+            text = 'row {} {:08x}'.format(i, rng.getrandbits(32))
+            if i == 7:
+                text = 'version {}'.format(version)
+            row = '<tr><td>{}</td><td>{}</td></tr>\n'.format(i, text)
+        rows.append(row)
+        length += len(row)
+        i += 1
+    return '<html><body><table>\n{}</table></body></html>\n'.format(
+        ''.join(rows)).encode('utf-8')
+
+
+def records(count: int, urls: int) -> Iterator[Dict[str, object]]:
+    """
+    Observation records spread over `urls` pages, oldest first, shaped
+    like the ones the watcher writes (without stored artefacts).
+    """
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    for i in range(count):
+        url = 'https://site{}.example.com/page'.format(i % urls)
+        version = i // urls // 10
+        yield {
+            'type': 'observation',
+            'url': url,
+            'timestamp': start + timedelta(minutes=i),
+            'was_available': i % 97 != 0,
+            'screenshot_content':
+                sha256('{}-{}'.format(url, version).encode()).hexdigest(),
+            'raw_content_hash':
+                sha256('{}/{}'.format(url, version).encode()).hexdigest(),
+        }
+
+
+class _Pages(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            hits = server.hits.get(self.path, 0)
+            server.hits[self.path] = hits + 1
+        # Every `change_every`th fetch of a page sees a new version of it
+        version = hits // server.change_every
+        body = server.page_cache.get((self.path, version))
+        if body is None:
+            body = page(server.page_size, version,
+                        seed=zlib.crc32(self.path.encode('utf-8')),
+                        shape=server.page_shape)
+            server.page_cache[(self.path, version)] = body
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer, which needs Python 3.7
+    daemon_threads = True
+
+
+class PageServer:
+    """
+    A local stand-in for the web, serving synthetic pages of `page_size`
+    bytes and `page_shape` that change every `change_every` fetches.
+    """
+
+    def __init__(self, page_size: int, change_every: int=1,
+                 page_shape: str='distinct') -> None:
+        self._server = _Server(('127.0.0.1', 0), _Pages)
+        self._server.lock = threading.Lock()
+        self._server.hits = dict()
+        self._server.page_cache = dict()
+        self._server.page_size = page_size
+        self._server.page_shape = page_shape
+        self._server.change_every = max(1, change_every)
+        self.url = 'http://127.0.0.1:{}'.format(
+            self._server.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
@@ -28,6 +28,10 @@ setup(
     ],
 
     install_requires=load_requirements(),
+    extras_require={
+        'imagediff': ['numpy', 'Pillow'],
+        'zstd': ['zstandard'],
+    },
     package_dir={'': 'src'},
     packages=find_packages(where='src'),
     entry_points={
@@ -0,0 +1,102 @@
+"""
+artefact.py - files produced while observing a page, together with what
+we know about their contents, so nothing downstream has to read them
+again just to find out.
+"""
+from hashlib import sha256
+import os
+from typing import IO, Optional
+
+from webwatcher.compression import is_encoded, open_artefact
+from webwatcher.delta import DELTA_SUFFIX, read_header
+from webwatcher.filehash import file_hash
+
+
+class Artefact:
+    def __init__(self,
+                 path: str,
+                 sha256: Optional[str]=None,
+                 size: Optional[int]=None,
+                 disposable: bool=False) -> None:
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        # A disposable artefact is a temporary file that nobody needs once
+        # it has been stored, so storage is free to move or delete it.
+        self.disposable = disposable
+
+    def described(self) -> 'Artefact':
+        """
+        Makes sure the hash and size are both known, only reading
+        the file for whichever wasn't recorded as it was written. Both
+        describe the original contents of a compressed or delta
+        encoded artefact.
+        """
+        if is_encoded(self.path):
+            if self.sha256 is None:
+                hasher, self.size = _hash_stream(self.path)
+                self.sha256 = hasher.hexdigest()
+            elif self.size is None:
+                self.size = _original_size(self.path)
+            return self
+        if self.sha256 is None:
+            self.sha256 = file_hash(self.path).hexdigest()
+        if self.size is None:
+            self.size = os.path.getsize(self.path)
+        return self
+
+    def __str__(self):
+        return self.path
+
+
+def _hash_stream(path: str):
+    hasher = sha256()
+    size = 0
+    with open_artefact(path) as f:
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+    return hasher, size
+
+
+def _original_size(path: str) -> int:
+    if path.endswith(DELTA_SUFFIX):
+        return read_header(path).size
+    size = 0
+    with open_artefact(path) as f:
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            size += len(chunk)
+    return size
+
+
+class HashingWriter:
+    """
+    Wraps a binary file opened for writing; hashes and counts the bytes
+    as they go past.
+    """
+
+    def __init__(self, target: IO[bytes]) -> None:
+        self._target = target
+        self._hasher = sha256()
+        self._size = 0
+
+    def write(self, data: bytes) -> int:
+        self._hasher.update(data)
+        self._size += len(data)
+        return self._target.write(data)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def artefact(self, disposable: bool=False) -> Artefact:
+        return Artefact(self._target.name,
+                        sha256=self._hasher.hexdigest(),
+                        size=self._size,
+                        disposable=disposable)
@@ -0,0 +1,310 @@
+"""
+artefactstore.py - the content-addressed half of Storage.
+
+Each blob is named after the SHA-256 of its contents, so storing
+something that's already there costs nothing but a stat or two. New
+blobs only ever appear under their final name through an atomic rename:
+readers never see a partially written file.
+
+Blobs may be compressed, or stored as a delta from an earlier version,
+in which case the name is still that of the original contents, plus a
+suffix saying how they're encoded; use compression.open_artefact to read
+them.
+"""
+import base64
+from contextlib import contextmanager
+import io
+import os
+from pathlib import Path
+import shutil
+import tempfile
+from typing import IO, Collection, Iterator, List, Optional, Tuple
+
+from webwatcher.artefact import Artefact
+from webwatcher.compression import Codec, SUFFIXES, codec_named, \
+    open_artefact, worth_compressing
+from webwatcher.delta import DELTA_SUFFIX, DeltaHeader, bases_of, depth_of, \
+    make_delta, write_delta
+
+
+_EMPTY_FILE = '_empty_file'
+
+
+class ArtefactStoreStats:
+    def __init__(self) -> None:
+        self.hits = 0
+        self.writes = 0
+        self.bytes_deduplicated = 0
+        self.bytes_written = 0
+        self.bytes_saved_by_compression = 0
+        self.deltas = 0
+        self.bytes_saved_by_deltas = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.writes
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return ('{writes} artefacts stored ({bytes_written} bytes, '
+                '{saved} saved by compression, {delta_saved} by storing '
+                '{deltas} as deltas), '
+                '{hits} already present ({ratio:.0%} deduplicated)').format(
+                    writes=self.writes,
+                    bytes_written=self.bytes_written,
+                    saved=self.bytes_saved_by_compression,
+                    delta_saved=self.bytes_saved_by_deltas,
+                    deltas=self.deltas,
+                    hits=self.hits,
+                    ratio=self.hit_ratio)
+
+
+class EncodedDelta:
+    def __init__(self, base: Path, encoded: bytes) -> None:
+        self.base = base
+        self.encoded = encoded
+
+
+# A delta has to be at least this much smaller than the full contents
+# to be worth the extra work of reading it back
+_DELTA_SAVING = 0.5
+
+
+class ArtefactStore:
+    """
+    With `max_delta_chain` set, an artefact can be stored as the changes
+    from an earlier blob (see delta_for), so long as that doesn't mean
+    following more than `max_delta_chain` deltas to read it back;
+    otherwise, a full copy is stored and later versions build on that.
+    """
+
+    def __init__(self,
+                 root: Path,
+                 compression: str='none',
+                 max_delta_chain: int=0) -> None:
+        self.root = root
+        self.stats = ArtefactStoreStats()
+        self._codec = codec_named(compression)
+        self._max_delta_chain = max_delta_chain
+
+    def delta_for(self, artefact: Artefact, base: Optional[Path]) \
+            -> Optional['EncodedDelta']:
+        """
+        The changes from `base` to the artefact's contents, ready to
+        `put`, if storing them that way is allowed and worthwhile. This
+        reads both in full, so is best done before taking any locks.
+        """
+        if base is None:
+            return None
+        if artefact.sha256 is None:
+            artefact.described()
+        if self._stored(artefact) is not None:
+            return None
+        size = artefact.described().size
+        assert size is not None
+        encoded = self._delta_from(base, artefact.path, size)
+        return EncodedDelta(Path(base), encoded) if encoded else None
+
+    def put(self,
+            artefact: Artefact,
+            delta: Optional['EncodedDelta']=None,
+            written: Optional[List[Path]]=None) -> Path:
+        """
+        Stores the artefact's contents, unless identical contents are
+        already stored, and returns where they live. Disposable artefacts
+        are moved in (or removed, if they turn out to be duplicates);
+        anything else is copied, and left where it was. Given a `delta`,
+        and so long as its base is still there, the contents are stored
+        as that delta. New blobs are added to `written`, if given, ready
+        to `sync`.
+        """
+        # Artefacts reused from earlier observations are found by the
+        # hash they were recorded with, without reading them again
+        destination = self._stored(artefact)
+        if destination is None:
+            artefact.described()
+            destination = self._stored(artefact)
+
+        if destination is not None:
+            self.stats.hits += 1
+            if artefact.size is not None:
+                self.stats.bytes_deduplicated += artefact.size
+            if artefact.disposable and \
+                    Path(artefact.path).resolve() != destination.resolve():
+                os.remove(artefact.path)
+        else:
+            size = artefact.size
+            assert size is not None
+            name = blob_name_for(artefact)
+            os.makedirs(str(self.root), exist_ok=True)
+            if delta is not None and delta.base.is_file():
+                destination = self.root / (name + DELTA_SUFFIX)
+                with self._incoming(destination) as target:
+                    target.write(delta.encoded)
+                size_written = len(delta.encoded)
+                if artefact.disposable:
+                    os.remove(artefact.path)
+                self.stats.deltas += 1
+                self.stats.bytes_saved_by_deltas += \
+                    size - size_written
+            elif self._codec is not None and \
+                    worth_compressing(artefact.path, size):
+                destination = self.root / (name + self._codec.suffix)
+                size_written = self._compress_in(
+                    artefact.path, destination, self._codec)
+                if artefact.disposable:
+                    os.remove(artefact.path)
+                self.stats.bytes_saved_by_compression += \
+                    size - size_written
+            else:
+                destination = self.root / name
+                size_written = size
+                if artefact.disposable:
+                    self._move_in(artefact.path, destination)
+                else:
+                    self._copy_in(artefact.path, destination)
+            self.stats.writes += 1
+            self.stats.bytes_written += size_written
+            if written is not None:
+                written.append(destination)
+
+        if artefact.disposable:
+            artefact.path = str(destination)
+            artefact.disposable = False
+        return destination
+
+    def sync(self, blobs: Collection[Path]) -> None:
+        """
+        Makes sure that `blobs`, and their names, are on disk.
+        """
+        if not blobs:
+            return
+        for blob in blobs:
+            _fsync(str(blob))
+        _fsync(str(self.root))
+
+    def _delta_from(self, base: Optional[Path], path: str, size: int) \
+            -> Optional[bytes]:
+        """
+        The encoded delta from `base` to the `size` bytes at `path`, if
+        storing one is allowed and worthwhile.
+        """
+        if self._max_delta_chain <= 0 or base is None:
+            return None
+        base = Path(base)
+        if base.parent.resolve() != self.root.resolve() or \
+                not base.is_file():
+            return None
+        depth = depth_of(str(base)) + 1
+        if depth > self._max_delta_chain:
+            return None
+
+        with open_artefact(str(base)) as f:
+            old = f.read()
+        with open_artefact(path) as f:
+            new = f.read()
+        encoded = io.BytesIO()
+        write_delta(encoded,
+                    DeltaHeader(base.name, depth, size),
+                    make_delta(old, new))
+        if encoded.tell() > size * _DELTA_SAVING:
+            return None
+        return encoded.getvalue()
+
+    def _stored(self, artefact: Artefact) -> Optional[Path]:
+        if artefact.sha256 is None:
+            return None
+        return self._existing(blob_name_for(artefact))
+
+    def _existing(self, name: str) -> Optional[Path]:
+        for suffix in ('',) + SUFFIXES + (DELTA_SUFFIX,):
+            candidate = self.root / (name + suffix)
+            if candidate.exists():
+                return candidate
+        return None
+
+    def sweep(self,
+              referenced: Collection[str],
+              unless_newer_than: float) -> Tuple[int, int]:
+        """
+        Deletes every blob (and abandoned partial write) whose name isn't
+        in `referenced`. Files modified after `unless_newer_than` (a unix
+        time) are left alone, as they may belong to a run that hasn't
+        written its record yet. Blobs that a kept delta is built on are
+        kept too. Returns the number of files and bytes removed.
+        """
+        try:
+            entries = [entry for entry in os.scandir(str(self.root))
+                       if entry.is_file()]
+        except FileNotFoundError:
+            return 0, 0
+
+        kept = set(referenced)
+        kept.update(entry.name for entry in entries
+                    if entry.stat().st_mtime > unless_newer_than)
+        for name in list(kept):
+            if name.endswith(DELTA_SUFFIX):
+                kept.update(bases_of(str(self.root / name)))
+
+        removed = removed_bytes = 0
+        for entry in entries:
+            if entry.name in kept:
+                continue
+            stat = entry.stat()
+            os.remove(entry.path)
+            removed += 1
+            removed_bytes += stat.st_size
+
+        return removed, removed_bytes
+
+    def _move_in(self, source: str, destination: Path) -> None:
+        try:
+            os.replace(source, str(destination))
+        except OSError:
+            # Most likely the temporary file is on another filesystem
+            self._copy_in(source, destination)
+            os.remove(source)
+
+    def _copy_in(self, source: str, destination: Path) -> None:
+        with self._incoming(destination) as target, open(source, 'rb') as f:
+            shutil.copyfileobj(f, target)
+
+    def _compress_in(self, source: str, destination: Path,
+                     codec: Codec) -> int:
+        with self._incoming(destination) as target, open(source, 'rb') as f:
+            codec.compress(f, target)
+            target.flush()
+            return target.tell()
+
+    @contextmanager
+    def _incoming(self, destination: Path) -> Iterator[IO[bytes]]:
+        """
+        A file to write a new blob into, which is renamed to
+        `destination` only once it has all been written.
+        """
+        fd, incoming = tempfile.mkstemp(dir=str(self.root), prefix='.incoming-')
+        try:
+            with open(fd, 'wb') as target:
+                yield target
+            os.replace(incoming, str(destination))
+        except BaseException:
+            os.remove(incoming)
+            raise
+
+
+def _fsync(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def blob_name_for(artefact: Artefact) -> str:
+    if artefact.size == 0:
+        return _EMPTY_FILE
+
+    assert artefact.sha256 is not None
+    return base64.b64encode(
+            bytes.fromhex(artefact.sha256),
+            altchars=b'_-').decode('utf-8')
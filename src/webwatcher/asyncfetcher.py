@@ -0,0 +1,555 @@
+"""
+asyncfetcher.py - downloading very many pages at once.
+
+AsyncWebFetcher speaks HTTP/1.1 itself over non-blocking sockets, on an
+asyncio event loop running in a thread of its own, so thousands of
+downloads can be under way without a thread for each. Connections to a
+host are kept alive and reused from one request to the next. Hosts are
+held to the same HostLimiter as everything else, and downloads give the
+same FetchResults as WebFetcher's, so Observer can use either. Unlike
+WebFetcher, it doesn't go through proxies or keep cookies.
+"""
+import asyncio
+from concurrent.futures import Future, as_completed
+import random
+import ssl
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urljoin, urlsplit
+import zlib
+
+from requests.structures import CaseInsensitiveDict
+from requests.utils import DEFAULT_CA_BUNDLE_PATH, default_user_agent, \
+    requote_uri
+
+from webwatcher.artefact import Artefact, HashingWriter
+from webwatcher.hostlimiter import HostLimiter, retry_after_seconds, \
+    _host_of
+from webwatcher.webfetcher import FetchResult, _BACK_OFF_STATUSES, \
+    _CHUNK_SIZE, _FetchFailed, _TRANSIENT_STATUSES, _conditional_headers, \
+    _discard, _failure, _validators_from
+
+
+# Sent with every request, as requests would
+_DEFAULT_HEADERS = {
+    'User-Agent': default_user_agent(),
+    'Accept-Encoding': 'gzip, deflate',
+    'Accept': '*/*',
+    'Connection': 'keep-alive',
+}
+
+# The most redirects followed, as with requests
+_MAX_REDIRECTS = 30
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+_MAX_HEADERS = 100
+
+# How long the next request for a host that's as busy as it may be waits
+# before looking again, in case something other than this fetcher (such
+# as a screenshot) is what frees a slot
+_RECHECK_SECONDS = 0.5
+
+
+class _Connection:
+    def __init__(self,
+                 key: Tuple[str, str, int],
+                 reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter) -> None:
+        # The scheme, host and port it's connected to
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        # Whether it was kept from an earlier request, in which case the
+        # server may have closed it since
+        self.reused = False
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class _Response:
+    def __init__(self, version: str, status_code: int,
+                 headers: CaseInsensitiveDict) -> None:
+        self.version = version
+        self.status_code = status_code
+        self.headers = headers
+
+    @property
+    def reusable(self) -> bool:
+        return self.version == 'HTTP/1.1' and \
+            'close' not in self.headers.get('Connection', '').lower()
+
+
+class AsyncWebFetcher:
+    """
+    Takes the same `timeout`, `limiter`, `total_timeout`,
+    `max_body_size`, `retries` and `backoff` as WebFetcher. No more than
+    `max_connections` downloads are in progress at once, and up to
+    `max_idle_per_host` connections to each host are kept open between
+    them. fetch() can be called from any thread; fetch_all() starts a
+    whole set of downloads at once.
+    """
+
+    def __init__(self,
+                 temp,
+                 timeout=None,
+                 limiter=None,
+                 total_timeout: Optional[float]=None,
+                 max_body_size: Optional[int]=None,
+                 retries: int=0,
+                 backoff: float=0.5,
+                 max_connections: int=100,
+                 max_idle_per_host: int=4,
+                 rand=random.random) -> None:
+        self._temp = temp
+        if isinstance(timeout, tuple):
+            self._connect_timeout, self._read_timeout = timeout
+        else:
+            self._connect_timeout = self._read_timeout = timeout
+        self._limiter = limiter if limiter is not None else HostLimiter()
+        self._total_timeout = total_timeout
+        self._max_body_size = max_body_size
+        self._retries = retries
+        self._backoff = backoff
+        self._max_idle_per_host = max_idle_per_host
+        self._rand = rand
+        self._ssl = ssl.create_default_context(
+            cafile=DEFAULT_CA_BUNDLE_PATH)
+        # Open connections not in use, by scheme, host and port
+        self._idle = \
+            dict()  # type: Dict[Tuple[str, str, int], List[_Connection]]
+        # Requests for a host queue up for their turn to wait on the
+        # limiter, so only the first of them keeps looking
+        self._host_turns = dict()  # type: Dict[str, asyncio.Lock]
+        self._host_freed = dict()  # type: Dict[str, asyncio.Event]
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='async-fetch', daemon=True)
+        self._thread.start()
+        # Made on the loop, which older versions of asyncio tie it to
+        self._connections = self._run(
+            _semaphore(max_connections)).result()
+
+    def fetch(self, url, validators=None) -> FetchResult:
+        return self._run(self._fetch(url, validators)).result()
+
+    def fetch_all(self,
+                  wanted: Sequence[Tuple[str, Optional[Dict[str, str]]]]) \
+            -> Iterator[Tuple[int, Future]]:
+        """
+        Starts downloading every (url, validators) in `wanted` at once.
+        Yields the index of each as it finishes, with a future of its
+        FetchResult and how many seconds it took.
+        """
+        started = {self._run(self._timed_fetch(url, validators)): i
+                   for i, (url, validators) in enumerate(wanted)}
+        for future in as_completed(started):
+            yield started[future], future
+
+    def close(self) -> None:
+        self._run(self._close_idle()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def _run(self, coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    async def _close_idle(self) -> None:
+        for connections in self._idle.values():
+            for connection in connections:
+                connection.close()
+        self._idle.clear()
+
+    async def _timed_fetch(self, url, validators) \
+            -> Tuple[FetchResult, float]:
+        started = time.monotonic()
+        result = await self._fetch(url, validators)
+        return result, time.monotonic() - started
+
+    async def _fetch(self, url, validators) -> FetchResult:
+        failures = []  # type: List[Dict[str, object]]
+        for attempt in range(self._retries + 1):
+            if attempt:
+                # Full jitter: anywhere up to the exponential backoff
+                await asyncio.sleep(
+                    self._backoff * 2 ** (attempt - 1) * self._rand())
+
+            started = time.monotonic()
+            try:
+                await self._host_slot(url)
+                try:
+                    async with self._connections:
+                        result = await self._fetch_once(url, validators)
+                finally:
+                    self._release(url)
+            except _FetchFailed as failure:
+                failures.append(_failure(attempt, started,
+                                         failure.reason, failure.detail))
+                if failure.retry:
+                    continue
+                break
+
+            if result.status_code in _TRANSIENT_STATUSES:
+                failures.append(_failure(
+                    attempt, started, 'status',
+                    'HTTP {}'.format(result.status_code)))
+                if attempt < self._retries:
+                    _discard(result.raw_content)
+                    continue
+
+            result.failures = failures
+            return result
+
+        return FetchResult(False, None, failures=failures)
+
+    async def _host_slot(self, url: str) -> None:
+        host = _host_of(url)
+        if host not in self._host_turns:
+            self._host_turns[host] = asyncio.Lock()
+            self._host_freed[host] = asyncio.Event()
+        freed = self._host_freed[host]
+        async with self._host_turns[host]:
+            while True:
+                freed.clear()
+                wait = self._limiter.try_acquire(url)
+                if wait == 0:
+                    return
+                try:
+                    await asyncio.wait_for(
+                        freed.wait(),
+                        _RECHECK_SECONDS if wait is None else wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _release(self, url: str) -> None:
+        self._limiter.release(url)
+        self._host_freed[_host_of(url)].set()
+
+    async def _fetch_once(self, url, validators) -> FetchResult:
+        location = requote_uri(url)
+        headers = dict(_DEFAULT_HEADERS, **_conditional_headers(validators))
+        for _ in range(_MAX_REDIRECTS + 1):
+            connection, response = await self._request(location, headers)
+            if response.status_code not in _REDIRECT_STATUSES or \
+                    'Location' not in response.headers:
+                break
+            async for _ in self._body(connection, response):
+                pass
+            location = requote_uri(
+                urljoin(location, response.headers['Location']))
+        else:
+            raise _FetchFailed('request',
+                               'More than {} redirects'.format(
+                                   _MAX_REDIRECTS),
+                               retry=False)
+
+        if response.status_code in _BACK_OFF_STATUSES:
+            retry_after = retry_after_seconds(
+                response.headers.get('Retry-After'))
+            if retry_after is not None:
+                self._limiter.back_off(url, retry_after)
+
+        if validators and response.status_code == 304:
+            async for _ in self._body(connection, response):
+                pass
+            return FetchResult(
+                True,
+                None,
+                validators=_validators_from(response, validators),
+                not_modified=True,
+                status_code=304)
+
+        raw_content = await self._read_body(connection, response)
+
+        return FetchResult(
+            response.status_code in range(200, 300),
+            raw_content,
+            validators=_validators_from(response),
+            status_code=response.status_code)
+
+    async def _request(self, url: str, headers: Dict[str, str]) \
+            -> Tuple[_Connection, _Response]:
+        try:
+            parts = urlsplit(url)
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            request = _request_head(
+                (parts.path or '/') +
+                ('?' + parts.query if parts.query else ''),
+                parts.netloc.rpartition('@')[2],
+                headers)
+        except (ValueError, UnicodeError) as e:
+            raise _FetchFailed('request', repr(e), retry=False)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise _FetchFailed('request',
+                               'Not an http(s) url: {}'.format(url),
+                               retry=False)
+
+        key = (parts.scheme, parts.hostname, port)
+        while True:
+            connection = await self._connection(key)
+            try:
+                connection.writer.write(request)
+                await self._read(connection.writer.drain())
+                response = await self._read_head(connection)
+            except _FetchFailed as failure:
+                connection.close()
+                # Servers close idle connections whenever they like
+                if connection.reused and failure.reason == 'connection':
+                    continue
+                raise
+            return connection, response
+
+    async def _connection(self, key: Tuple[str, str, int]) -> _Connection:
+        idle = self._idle.get(key)
+        while idle:
+            connection = idle.pop()
+            if not connection.reader.at_eof():
+                connection.reused = True
+                return connection
+            connection.close()
+
+        scheme, host, port = key
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    host, port,
+                    ssl=self._ssl if scheme == 'https' else None),
+                self._connect_timeout)
+        except asyncio.TimeoutError:
+            raise _FetchFailed('connect_timeout',
+                               'No connection to {} within {}s'.format(
+                                   host, self._connect_timeout),
+                               retry=True)
+        except (OSError, ssl.CertificateError) as e:
+            raise _FetchFailed('connection', repr(e), retry=True)
+        return _Connection(key, reader, writer)
+
+    def _done_with(self, connection: _Connection,
+                   response: _Response) -> None:
+        idle = self._idle.setdefault(connection.key, [])
+        if response.reusable and len(idle) < self._max_idle_per_host:
+            idle.append(connection)
+        else:
+            connection.close()
+
+    async def _read(self, awaitable):
+        """
+        Waits for a read (or write) on a connection, giving up after
+        the read timeout.
+        """
+        try:
+            return await asyncio.wait_for(awaitable, self._read_timeout)
+        except asyncio.TimeoutError:
+            raise _FetchFailed('read_timeout',
+                               'Nothing for {}s'.format(self._read_timeout),
+                               retry=True)
+        except asyncio.IncompleteReadError:
+            raise _FetchFailed('connection', 'Connection closed early',
+                               retry=True)
+        except (OSError, ValueError) as e:
+            raise _FetchFailed('connection', repr(e), retry=True)
+
+    async def _read_head(self, connection: _Connection) -> _Response:
+        while True:
+            status_line = await self._read(connection.reader.readline())
+            if not status_line:
+                raise _FetchFailed('connection', 'Connection closed',
+                                   retry=True)
+            try:
+                version, status, *_ = \
+                    status_line.decode('iso-8859-1').split(None, 2)
+                status_code = int(status)
+            except ValueError:
+                raise _FetchFailed('connection',
+                                   'Bad status line {!r}'.format(status_line),
+                                   retry=True)
+
+            headers = CaseInsensitiveDict()  # type: CaseInsensitiveDict
+            for _ in range(_MAX_HEADERS):
+                line = await self._read(connection.reader.readline())
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, separator, value = \
+                    line.decode('iso-8859-1').partition(':')
+                if not separator:
+                    raise _FetchFailed('connection',
+                                       'Bad header {!r}'.format(line),
+                                       retry=True)
+                name, value = name.strip(), value.strip()
+                headers[name] = headers[name] + ', ' + value \
+                    if name in headers else value
+            else:
+                raise _FetchFailed('connection', 'Too many headers',
+                                   retry=True)
+
+            # Informational responses come before the real one
+            if not 100 <= status_code < 200:
+                return _Response(version, status_code, headers)
+
+    async def _body(self, connection: _Connection, response: _Response):
+        """
+        Yields the body of `response` as it arrives, decoded, then puts
+        the connection back to be reused if it can be.
+        """
+        decoder = _decoder(response.headers.get('Content-Encoding'))
+        try:
+            async for chunk in self._chunks(connection, response):
+                if decoder is not None:
+                    chunk = decoder.decompress(chunk)
+                if chunk:
+                    yield chunk
+            if decoder is not None:
+                rest = decoder.flush()
+                if rest:
+                    yield rest
+        except zlib.error as e:
+            connection.close()
+            raise _FetchFailed('decoding', repr(e), retry=False)
+        except _FetchFailed:
+            connection.close()
+            raise
+
+    async def _chunks(self, connection: _Connection, response: _Response):
+        reader = connection.reader
+        encoding = response.headers.get('Transfer-Encoding', '').lower()
+        length = response.headers.get('Content-Length')
+        if response.status_code in (204, 304):
+            pass
+        elif 'chunked' in encoding:
+            while True:
+                size_line = await self._read(reader.readline())
+                try:
+                    size = int(size_line.split(b';', 1)[0], 16)
+                except ValueError:
+                    raise _FetchFailed('connection',
+                                       'Bad chunk size {!r}'.format(
+                                           size_line),
+                                       retry=True)
+                if size == 0:
+                    # Then any trailers, which aren't needed
+                    while await self._read(reader.readline()) not in \
+                            (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                while size:
+                    chunk = await self._read(
+                        reader.read(min(size, _CHUNK_SIZE)))
+                    if not chunk:
+                        raise _FetchFailed('connection',
+                                           'Connection closed early',
+                                           retry=True)
+                    size -= len(chunk)
+                    yield chunk
+                await self._read(reader.readexactly(2))
+        elif length is not None:
+            try:
+                remaining = int(length)
+            except ValueError:
+                raise _FetchFailed('connection',
+                                   'Bad Content-Length {!r}'.format(length),
+                                   retry=True)
+            while remaining > 0:
+                chunk = await self._read(
+                    reader.read(min(remaining, _CHUNK_SIZE)))
+                if not chunk:
+                    raise _FetchFailed('connection',
+                                       'Connection closed early',
+                                       retry=True)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            # Runs until the server closes the connection
+            while True:
+                chunk = await self._read(reader.read(_CHUNK_SIZE))
+                if not chunk:
+                    break
+                yield chunk
+            connection.close()
+            return
+
+        self._done_with(connection, response)
+
+    async def _read_body(self, connection: _Connection,
+                         response: _Response) -> Artefact:
+        declared = response.headers.get('Content-Length')
+        if self._max_body_size is not None and declared is not None and \
+                declared.isdigit() and int(declared) > self._max_body_size:
+            connection.close()
+            raise _FetchFailed('too_large',
+                               'Content-Length {}'.format(declared),
+                               retry=False)
+
+        deadline = time.monotonic() + self._total_timeout \
+            if self._total_timeout is not None else None
+        with self._temp.new_file(delete=False) as raw_content_file:
+            raw_content = HashingWriter(raw_content_file)
+            try:
+                async for chunk in self._body(connection, response):
+                    raw_content.write(chunk)
+                    if self._max_body_size is not None and \
+                            raw_content.size > self._max_body_size:
+                        raise _FetchFailed(
+                            'too_large',
+                            'over {} bytes'.format(self._max_body_size),
+                            retry=False)
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise _FetchFailed(
+                            'total_timeout',
+                            'body took over {}s'.format(self._total_timeout),
+                            retry=False)
+            except _FetchFailed:
+                connection.close()
+                _discard(raw_content.artefact())
+                raise
+        return raw_content.artefact(disposable=True)
+
+
+async def _semaphore(value: int) -> asyncio.Semaphore:
+    return asyncio.Semaphore(value)
+
+
+def _request_head(target: str, host: str, headers: Dict[str, str]) -> bytes:
+    lines = ['GET {} HTTP/1.1'.format(target), 'Host: {}'.format(host)]
+    lines.extend('{}: {}'.format(name, value)
+                 for name, value in headers.items())
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+
+
+def _decoder(content_encoding: Optional[str]):
+    encoding = (content_encoding or '').strip().lower()
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return _DeflateDecoder()
+    return None
+
+
+class _DeflateDecoder:
+    """
+    Deflate bodies should come with a zlib header, but some servers
+    leave it out; which it is only shows once decompressing starts.
+    """
+
+    def __init__(self) -> None:
+        self._decompressor = zlib.decompressobj()
+        self._seen = b''  # type: Optional[bytes]
+
+    def decompress(self, data: bytes) -> bytes:
+        if self._seen is None:
+            return self._decompressor.decompress(data)
+        self._seen += data
+        try:
+            decompressed = self._decompressor.decompress(data)
+        except zlib.error:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            seen, self._seen = self._seen, None
+            return self._decompressor.decompress(seen)
+        if decompressed:
+            self._seen = None
+        return decompressed
+
+    def flush(self) -> bytes:
+        return self._decompressor.flush()
@@ -0,0 +1,215 @@
+"""
+browserpool.py - long-lived headless Firefox instances, driven over
+Marionette, for taking screenshots without paying browser start-up for
+every page.
+"""
+import base64
+import json
+import logging
+import queue
+import socket
+import subprocess
+import time
+from typing import Dict, List, Optional
+
+
+class BrowserFailureException(Exception):
+    def __init__(self, msg, *args, **kwargs):
+        self.msg = msg
+
+
+class PageLoadTimeoutException(BrowserFailureException):
+    pass
+
+
+class MarionetteClient:
+    """
+    Speaks just enough of the Marionette protocol to navigate and take
+    screenshots. Each packet is framed as `<length>:<json>`; commands are
+    `[0, id, name, params]` and responses `[1, id, error, result]`.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float) -> None:
+        self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._buffer = b''
+        self._next_id = 0
+        self.hello = self._read_packet()
+
+    def send(self, name: str, params: Optional[Dict]=None,
+             timeout: Optional[float]=30):
+        self._next_id += 1
+        message_id = self._next_id
+        payload = json.dumps([0, message_id, name, params or {}]) \
+            .encode('utf-8')
+        self._sock.settimeout(timeout)
+        self._sock.sendall(str(len(payload)).encode('ascii') + b':' + payload)
+
+        while True:
+            response = self._read_packet()
+            if response[0] == 1 and response[1] == message_id:
+                break
+
+        _, _, error, result = response
+        if error:
+            if error.get('error') == 'timeout':
+                raise PageLoadTimeoutException(error.get('message'))
+            raise BrowserFailureException(
+                '{}: {}'.format(error.get('error'), error.get('message')))
+        return result
+
+    def _read_packet(self):
+        while b':' not in self._buffer:
+            self._receive()
+        length, _, self._buffer = self._buffer.partition(b':')
+        length = int(length)
+        while len(self._buffer) < length:
+            self._receive()
+        packet, self._buffer = self._buffer[:length], self._buffer[length:]
+        return json.loads(packet.decode('utf-8'))
+
+    def _receive(self):
+        data = self._sock.recv(65536)
+        if not data:
+            raise BrowserFailureException('Marionette connection closed')
+        self._buffer += data
+
+    def close(self):
+        self._sock.close()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class _Browser:
+    def __init__(self, firefox_path, profile_dir, startup_timeout) -> None:
+        port = _free_port()
+        with open('{}/user.js'.format(profile_dir), 'w') as prefs:
+            prefs.write('user_pref("marionette.port", {});\n'.format(port))
+
+        self._process = subprocess.Popen(
+            [str(firefox_path), '--headless', '--marionette', '--no-remote',
+             '--profile', profile_dir],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+
+        try:
+            self._client = self._connect(port, startup_timeout)
+            self._client.send('WebDriver:NewSession', {
+                'capabilities': {
+                    'alwaysMatch': {'acceptInsecureCerts': True}}})
+        except Exception:
+            self.kill()
+            raise
+
+    def _connect(self, port, startup_timeout) -> MarionetteClient:
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            try:
+                return MarionetteClient(
+                    '127.0.0.1', port, timeout=startup_timeout)
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline or \
+                        self._process.poll() is not None:
+                    raise BrowserFailureException(
+                        'Firefox did not start listening for Marionette')
+                time.sleep(0.1)
+
+    def screenshot(self, url: str, page_timeout: float) -> bytes:
+        self._client.send('WebDriver:SetTimeouts',
+                          {'pageLoad': int(page_timeout * 1000)})
+        self._client.send('WebDriver:Navigate', {'url': url},
+                          timeout=page_timeout + 5)
+        result = self._client.send('WebDriver:TakeScreenshot',
+                                   {'full': True, 'hash': False},
+                                   timeout=page_timeout + 5)
+        return base64.b64decode(result['value'])
+
+    def quit(self):
+        try:
+            self._client.send('Marionette:Quit', {'flags': ['eForceQuit']},
+                              timeout=5)
+            self._client.close()
+            self._process.wait(timeout=5)
+        except Exception:
+            self.kill()
+
+    def kill(self):
+        self._process.kill()
+        self._process.wait()
+
+
+class _Slot:
+    def __init__(self, profile_dir: str) -> None:
+        self.profile_dir = profile_dir
+        self.browser = None  # type: Optional[_Browser]
+        self.pages_served = 0
+
+
+class BrowserPool:
+    """
+    A fixed number of browser slots, each with its own profile directory
+    that lives as long as the pool. Browsers are started on first use,
+    restarted (in the same profile) after `recycle_after` pages, and
+    thrown away if anything goes wrong with them.
+    """
+
+    def __init__(self,
+                 temp_storage,
+                 firefox_path,
+                 size: int=2,
+                 recycle_after: int=50,
+                 page_timeout: float=10,
+                 startup_timeout: float=30) -> None:
+        self._firefox_path = firefox_path
+        self._recycle_after = recycle_after
+        self._page_timeout = page_timeout
+        self._startup_timeout = startup_timeout
+        self._slots = queue.Queue()  # type: queue.Queue
+        self._all_slots = []  # type: List[_Slot]
+        for _ in range(size):
+            slot = _Slot(temp_storage.new_folder().name)
+            self._all_slots.append(slot)
+            self._slots.put(slot)
+
+    def screenshot(self, url: str) -> bytes:
+        slot = self._slots.get()
+        try:
+            if slot.browser is None:
+                slot.browser = _Browser(
+                    self._firefox_path,
+                    slot.profile_dir,
+                    self._startup_timeout)
+                slot.pages_served = 0
+
+            try:
+                return slot.browser.screenshot(url, self._page_timeout)
+            except PageLoadTimeoutException:
+                raise
+            except Exception:
+                logging.warning('Discarding browser after failure on %s', url)
+                slot.browser.kill()
+                slot.browser = None
+                raise
+            finally:
+                slot.pages_served += 1
+                if slot.browser is not None and \
+                        slot.pages_served >= self._recycle_after:
+                    slot.browser.quit()
+                    slot.browser = None
+        finally:
+            self._slots.put(slot)
+
+    def close(self) -> None:
+        for slot in self._all_slots:
+            if slot.browser is not None:
+                slot.browser.quit()
+                slot.browser = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
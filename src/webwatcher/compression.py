@@ -0,0 +1,145 @@
+"""
+compression.py - how artefacts are compressed at rest.
+
+A compressed artefact keeps the name of its uncompressed contents and
+gains a suffix saying how it was compressed, so that open_artefact can
+hand back the original bytes whatever the file looks like on disk.
+gzip is always available; zstd needs the `zstandard` package
+(`pip install webwatcher[zstd]`).
+"""
+import gzip
+import io
+import shutil
+from typing import IO, Dict, Optional
+
+from webwatcher.delta import DELTA_SUFFIX, rebuild
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the environment
+    zstandard = None  # type: ignore
+
+
+# Formats that are already compressed, by their first bytes; squeezing
+# them again costs time and saves next to nothing
+_ALREADY_COMPRESSED = (
+    b'\x89PNG',
+    b'\xff\xd8\xff',  # JPEG
+    b'GIF8',
+    b'\x1f\x8b',  # gzip
+    b'\x28\xb5\x2f\xfd',  # zstd
+    b'PK\x03\x04',  # zip
+)
+
+# Not worth the bother below this
+_MIN_SIZE = 256
+
+_CHUNK_SIZE = 65536
+
+
+class Codec:
+    def __init__(self, name: str, suffix: str) -> None:
+        self.name = name
+        self.suffix = suffix
+
+    def compress(self, source: IO[bytes], target: IO[bytes]) -> None:
+        raise NotImplementedError
+
+    def open(self, path: str) -> IO[bytes]:
+        raise NotImplementedError
+
+
+class _Gzip(Codec):
+    def __init__(self, level: int=6) -> None:
+        super().__init__('gzip', '.gz')
+        self._level = level
+
+    def compress(self, source, target):
+        # mtime=0 so that the same contents always compress the same way
+        with gzip.GzipFile(fileobj=target, mode='wb',
+                           compresslevel=self._level, mtime=0) as z:
+            shutil.copyfileobj(source, z, _CHUNK_SIZE)
+
+    def open(self, path):
+        return gzip.open(path, 'rb')
+
+
+class _Zstd(Codec):
+    def __init__(self, level: int=10) -> None:
+        super().__init__('zstd', '.zst')
+        self._level = level
+
+    def compress(self, source, target):
+        _require_zstd()
+        compressor = zstandard.ZstdCompressor(level=self._level)
+        compressor.copy_stream(source, target, read_size=_CHUNK_SIZE)
+
+    def open(self, path):
+        _require_zstd()
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), closefd=True)
+
+
+def _require_zstd():
+    if zstandard is None:
+        raise RuntimeError('zstd compression needs the zstandard package')
+
+
+_CODECS = {c.name: c for c in (_Gzip(), _Zstd())}  # type: Dict[str, Codec]
+
+COMPRESSIONS = ('none',) + tuple(sorted(_CODECS))
+
+SUFFIXES = tuple(c.suffix for c in _CODECS.values())
+
+
+def zstd_available() -> bool:
+    return zstandard is not None
+
+
+def codec_named(name: str) -> Optional[Codec]:
+    if name == 'none':
+        return None
+    try:
+        return _CODECS[name]
+    except KeyError:
+        raise ValueError(
+            'Unknown compression: {name} (expected one of {known})'
+            .format(name=name, known=', '.join(COMPRESSIONS)))
+
+
+def codec_for_path(path: str) -> Optional[Codec]:
+    for codec in _CODECS.values():
+        if path.endswith(codec.suffix):
+            return codec
+    return None
+
+
+def worth_compressing(path: str, size: int) -> bool:
+    if size < _MIN_SIZE:
+        return False
+    with open(path, 'rb') as f:
+        start = f.read(8)
+    return not start.startswith(_ALREADY_COMPRESSED)
+
+
+def is_encoded(path: str) -> bool:
+    """
+    Whether the bytes on disk at `path` differ from the artefact's
+    contents: it's compressed, or stored as a delta.
+    """
+    return codec_for_path(path) is not None or path.endswith(DELTA_SUFFIX)
+
+
+def open_artefact(path: str) -> IO[bytes]:
+    """
+    Opens a stored (or any other) artefact for reading, giving back its
+    original contents whether it was compressed, stored as a delta from
+    another version, or neither.
+    """
+    path = str(path)
+    if path.endswith(DELTA_SUFFIX):
+        return io.BytesIO(rebuild(path, open_artefact))
+    codec = codec_for_path(path)
+    if codec is None:
+        return open(path, 'rb')
+    return codec.open(path)
@@ -0,0 +1,290 @@
+"""
+contentdiff.py - comparing the stored HTML of two observations.
+
+Pages are read as a stream of tokens (tags and the text between them),
+normalised to drop noise that changes on every load, and compared by
+token hash. Only the hashes of each page are held in memory; the text of
+changed tokens is read back from disk afterwards, and only for the few
+that get reported.
+"""
+from bisect import bisect_left
+import codecs
+from difflib import SequenceMatcher
+import re
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, \
+    Sequence, Set, Tuple
+
+from webwatcher.compression import open_artefact
+
+
+_CHUNK_SIZE = 65536
+
+# Stretches of tokens with nothing unique to anchor on are matched token
+# by token until a diff has spent about this many comparisons on them;
+# after that, such stretches are reported as changed wholesale
+_MATCHING_BUDGET = 1000000
+
+_SCRIPT_OPEN = re.compile(r'<script\b', re.IGNORECASE)
+_SCRIPT_CLOSE = re.compile(r'</script\s*>', re.IGNORECASE)
+
+_TIMESTAMP = re.compile(
+    r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?'
+    r'|\b\d{1,2}:\d{2}(:\d{2})?(\s?[AaPp][Mm])?\b'
+    r'|\b\d{1,2} (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\w* \d{4}\b'
+    r'|\b1[5-9]\d{8}(\d{3})?\b')
+
+_CSRF_NAME = re.compile(
+    r'csrf|xsrf|authenticity_token|requestverificationtoken|[_-]token\b',
+    re.IGNORECASE)
+_TOKEN_VALUE = re.compile(r'''\b(value|content)\s*=\s*("[^"]*"|'[^']*')''',
+                          re.IGNORECASE)
+_NONCE = re.compile(r'''\bnonce\s*=\s*("[^"]*"|'[^']*')''', re.IGNORECASE)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _strip_timestamps(token: str) -> str:
+    return _TIMESTAMP.sub('<timestamp>', token)
+
+
+def _strip_csrf_tokens(token: str) -> str:
+    if not token.startswith('<'):
+        return token
+    token = _NONCE.sub('nonce=""', token)
+    if _CSRF_NAME.search(token):
+        token = _TOKEN_VALUE.sub(r'\1=""', token)
+    return token
+
+
+def _collapse_whitespace(token: str) -> str:
+    return _WHITESPACE.sub(' ', token).strip()
+
+
+# Rules applied to each token, in order. `scripts` is handled by the
+# tokenizer itself, as it removes whole runs of tokens.
+_TOKEN_RULES = {
+    'timestamps': _strip_timestamps,
+    'csrf': _strip_csrf_tokens,
+    'whitespace': _collapse_whitespace,
+}  # type: Dict[str, Callable[[str], str]]
+
+NORMALISATION_RULES = ('scripts',) + tuple(sorted(_TOKEN_RULES))
+
+
+def _raw_tokens(path: str) -> Iterator[str]:
+    """
+    Splits a file into tags and the runs of text between them,
+    reading a chunk at a time.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buffer = ''
+    with open_artefact(path) as f:
+        while True:
+            chunk = f.read(_CHUNK_SIZE)
+            buffer += decoder.decode(chunk, final=not chunk)
+            position = 0
+            while True:
+                if buffer.startswith('<', position):
+                    end = buffer.find('>', position)
+                    if end < 0:
+                        break
+                    yield buffer[position:end + 1]
+                    position = end + 1
+                else:
+                    end = buffer.find('<', position)
+                    if end < 0:
+                        break
+                    yield buffer[position:end]
+                    position = end
+            buffer = buffer[position:]
+            if not chunk:
+                break
+    if buffer:
+        yield buffer
+
+
+class ContentDiff:
+    def __init__(self,
+                 old: str,
+                 new: str,
+                 removed: int,
+                 added: int,
+                 examples: Sequence[str]) -> None:
+        self.old = old
+        self.new = new
+        self.removed = removed
+        self.added = added
+        self.examples = examples
+
+    def __str__(self):
+        return ('ContentDiff(-{removed} +{added} tokens,'
+                ' new={new}, e.g. {examples})').format(
+                    removed=self.removed,
+                    added=self.added,
+                    new=self.new,
+                    examples=list(self.examples))
+
+
+class ContentDiffer:
+    def __init__(self,
+                 normalisation: Iterable[str]=NORMALISATION_RULES,
+                 examples: int=3) -> None:
+        normalisation = list(normalisation)
+        unknown = set(normalisation) - set(NORMALISATION_RULES)
+        if unknown:
+            raise ValueError('Unknown normalisation rules: {}'.format(
+                ', '.join(sorted(unknown))))
+        self._strip_scripts = 'scripts' in normalisation
+        self._rules = [_TOKEN_RULES[r] for r in normalisation
+                       if r in _TOKEN_RULES]
+        self._examples = examples
+
+    def tokens(self, path: str) -> Iterator[str]:
+        in_script = False
+        for token in _raw_tokens(path):
+            if self._strip_scripts:
+                if in_script:
+                    in_script = not _SCRIPT_CLOSE.match(token)
+                    continue
+                if _SCRIPT_OPEN.match(token):
+                    in_script = not token.endswith('/>')
+                    continue
+            for rule in self._rules:
+                token = rule(token)
+            if token:
+                yield token
+
+    def _token_hashes(self, path: str) -> List[int]:
+        return [hash(t) for t in self.tokens(path)]
+
+    def equivalent(self, old_path: str, new_path: str) -> bool:
+        return self._token_hashes(old_path) == self._token_hashes(new_path)
+
+    def diff(self, old_path: str, new_path: str) -> Optional[ContentDiff]:
+        old = self._token_hashes(old_path)
+        new = self._token_hashes(new_path)
+        if old == new:
+            return None
+
+        removed = added = 0
+        changed_positions = []  # type: List[int]
+        for i1, i2, j1, j2 in _changed_stretches(old, new):
+            removed += i2 - i1
+            added += j2 - j1
+            if len(changed_positions) < self._examples:
+                changed_positions.extend(
+                    range(j1, min(j2, j1 + self._examples)))
+
+        return ContentDiff(
+            old=old_path,
+            new=new_path,
+            removed=removed,
+            added=added,
+            examples=self._tokens_at(
+                new_path, changed_positions[:self._examples]))
+
+    def _tokens_at(self, path: str, positions: Sequence[int]) -> List[str]:
+        wanted = set(positions)
+        found = []  # type: List[str]
+        if not wanted:
+            return found
+        for i, token in enumerate(self.tokens(path)):
+            if i in wanted:
+                found.append(token)
+                if len(found) == len(wanted):
+                    break
+        return found
+
+
+def _changed_stretches(old: Sequence[int],
+                       new: Sequence[int]) -> List[Tuple[int, int, int, int]]:
+    """
+    A patience diff of two token sequences: tokens that occur exactly
+    once on each side are matched up first, and the stretches between
+    those anchors are diffed in turn. Unlike matching every token
+    against every other, repetitive markup (rows of the same tags)
+    can't make this quadratic. Returns the (i1, i2, j1, j2) bounds of
+    each changed stretch, in order.
+    """
+    changed = []  # type: List[Tuple[int, int, int, int]]
+    budget = _MATCHING_BUDGET
+    stack = [(0, len(old), 0, len(new))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        while alo < ahi and blo < bhi and old[alo] == new[blo]:
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and old[ahi - 1] == new[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        if alo == ahi or blo == bhi:
+            if alo < ahi or blo < bhi:
+                changed.append((alo, ahi, blo, bhi))
+            continue
+
+        anchors = _anchors(old, alo, ahi, new, blo, bhi)
+        work = (ahi - alo) * (bhi - blo)
+        if anchors:
+            bounds = [(alo - 1, blo - 1)] + anchors + [(ahi, bhi)]
+            # Pushed last first, so stretches come off the stack in order
+            for (i, j), (k, m) in reversed(list(zip(bounds, bounds[1:]))):
+                stack.append((i + 1, k, j + 1, m))
+        elif work <= budget:
+            budget -= work
+            matcher = SequenceMatcher(None, old[alo:ahi], new[blo:bhi],
+                                      autojunk=False)
+            for op, i1, i2, j1, j2 in matcher.get_opcodes():
+                if op != 'equal':
+                    changed.append((alo + i1, alo + i2, blo + j1, blo + j2))
+        else:
+            changed.append((alo, ahi, blo, bhi))
+    return changed
+
+
+def _anchors(old: Sequence[int], alo: int, ahi: int,
+             new: Sequence[int], blo: int, bhi: int) -> List[Tuple[int, int]]:
+    """
+    Positions of the tokens unique to both stretches, keeping the
+    longest run of them that appears in the same order on both sides.
+    """
+    in_new = _unique_positions(new, blo, bhi)
+    pairs = sorted((i, in_new[token])
+                   for token, i in _unique_positions(old, alo, ahi).items()
+                   if token in in_new)
+
+    # Longest increasing subsequence of the new positions
+    tails = []  # type: List[int]
+    tail_pairs = []  # type: List[int]
+    previous = []  # type: List[int]
+    for n, (_, j) in enumerate(pairs):
+        k = bisect_left(tails, j)
+        previous.append(tail_pairs[k - 1] if k else -1)
+        if k == len(tails):
+            tails.append(j)
+            tail_pairs.append(n)
+        else:
+            tails[k] = j
+            tail_pairs[k] = n
+
+    anchors = []  # type: List[Tuple[int, int]]
+    n = tail_pairs[-1] if tail_pairs else -1
+    while n >= 0:
+        anchors.append(pairs[n])
+        n = previous[n]
+    anchors.reverse()
+    return anchors
+
+
+def _unique_positions(tokens: Sequence[int],
+                      lo: int,
+                      hi: int) -> Dict[int, int]:
+    positions = dict()  # type: Dict[int, int]
+    repeated = set()  # type: Set[int]
+    for i in range(lo, hi):
+        if tokens[i] in positions:
+            repeated.add(tokens[i])
+        else:
+            positions[tokens[i]] = i
+    for token in repeated:
+        del positions[token]
+    return positions
@@ -0,0 +1,207 @@
+"""
+delta.py - storing a page as the changes from its previous version.
+
+A delta blob holds the name of the blob it's based on and a list of
+instructions for rebuilding the new contents from it: copy this range of
+bytes from the base, or insert these new bytes. Bases may themselves be
+deltas; `depth` counts how many there are to go through before reaching
+a full copy, so that reading never has to follow too long a chain.
+
+Pages are compared as runs of text ending in `>` or a newline, which for
+HTML is close to comparing tag by tag.
+"""
+from bisect import bisect_left
+import gzip
+import json
+from pathlib import Path
+import re
+from typing import IO, Callable, Dict, List, Tuple, Union
+
+
+DELTA_SUFFIX = '.delta'
+
+_MAGIC = b'WWDELTA1\n'
+
+_PIECE_END = re.compile(b'[>\\n]')
+
+# Where in the base to try continuing from, for each piece of the new
+# contents; more would find longer matches in very repetitive pages, at
+# the cost of comparing more
+_CANDIDATES = 4
+
+# (base_start, base_end) to copy, or bytes to insert
+Instruction = Union[Tuple[int, int], bytes]
+
+
+class DeltaHeader:
+    def __init__(self, base: str, depth: int, size: int) -> None:
+        self.base = base
+        self.depth = depth
+        self.size = size
+
+
+def _pieces(data: bytes) -> List[bytes]:
+    pieces = []
+    start = 0
+    for end in _PIECE_END.finditer(data):
+        pieces.append(data[start:end.end()])
+        start = end.end()
+    if start < len(data):
+        pieces.append(data[start:])
+    return pieces
+
+
+def make_delta(base: bytes, new: bytes) -> List[Instruction]:
+    """
+    Instructions for rebuilding `new` from `base`. Each piece of `new`
+    is looked up among the pieces of `base`, and the match that runs on
+    the longest (from a few near where the last one ended) is copied;
+    pieces with no match are inserted. As no piece is compared more than
+    a few times, this stays linear in the size of the pages, however
+    repetitive they are.
+    """
+    old_pieces = _pieces(base)
+    new_pieces = _pieces(new)
+
+    old_offsets = [0]
+    for p in old_pieces:
+        old_offsets.append(old_offsets[-1] + len(p))
+    positions = dict()  # type: Dict[bytes, List[int]]
+    for i, p in enumerate(old_pieces):
+        positions.setdefault(p, []).append(i)
+
+    instructions = []  # type: List[Instruction]
+    inserting = []  # type: List[bytes]
+
+    def copy(start, end):
+        if inserting:
+            instructions.append(b''.join(inserting))
+            del inserting[:]
+        begin, finish = old_offsets[start], old_offsets[end]
+        last = instructions[-1] if instructions else None
+        if isinstance(last, tuple) and last[1] == begin:
+            instructions[-1] = (last[0], finish)
+        else:
+            instructions.append((begin, finish))
+
+    def run_length(i, j):
+        n = 0
+        while i + n < len(old_pieces) and j + n < len(new_pieces) and \
+                old_pieces[i + n] == new_pieces[j + n]:
+            n += 1
+        return n
+
+    j = 0
+    expected = 0
+    while j < len(new_pieces):
+        found = positions.get(new_pieces[j], [])
+        nearby = bisect_left(found, expected)
+        best, best_length = -1, 0
+        # Failing anything further on, the last ones before it
+        for i in found[nearby:nearby + _CANDIDATES] or found[-_CANDIDATES:]:
+            length = run_length(i, j)
+            if length > best_length:
+                best, best_length = i, length
+        if best_length:
+            copy(best, best + best_length)
+            j += best_length
+            expected = best + best_length
+        else:
+            inserting.append(new_pieces[j])
+            j += 1
+    if inserting:
+        instructions.append(b''.join(inserting))
+    return instructions
+
+
+def apply_delta(base: bytes, instructions: List[Instruction]) -> bytes:
+    return b''.join(base[i[0]:i[1]] if isinstance(i, tuple) else i
+                    for i in instructions)
+
+
+def write_delta(target: IO[bytes],
+                header: DeltaHeader,
+                instructions: List[Instruction]) -> None:
+    with gzip.GzipFile(fileobj=target, mode='wb', mtime=0) as z:
+        z.write(_MAGIC)
+        z.write(json.dumps({'base': header.base,
+                            'depth': header.depth,
+                            'size': header.size}).encode('utf-8'))
+        z.write(b'\n')
+        for i in instructions:
+            if isinstance(i, tuple):
+                z.write('C {} {}\n'.format(i[0], i[1]).encode('ascii'))
+            else:
+                z.write('I {}\n'.format(len(i)).encode('ascii'))
+                z.write(i)
+
+
+def _read_header(z) -> DeltaHeader:
+    if z.readline() != _MAGIC:
+        raise ValueError('Not a delta')
+    header = json.loads(z.readline().decode('utf-8'))
+    return DeltaHeader(header['base'], header['depth'], header['size'])
+
+
+def read_header(path: str) -> DeltaHeader:
+    with gzip.open(path, 'rb') as z:
+        return _read_header(z)
+
+
+def read_delta(path: str) -> Tuple[DeltaHeader, List[Instruction]]:
+    instructions = []  # type: List[Instruction]
+    with gzip.open(path, 'rb') as z:
+        header = _read_header(z)
+        while True:
+            line = z.readline()
+            if not line:
+                break
+            kind, *numbers = line.split()
+            if kind == b'C':
+                instructions.append((int(numbers[0]), int(numbers[1])))
+            elif kind == b'I':
+                length = int(numbers[0])
+                instructions.append(z.read(length))
+            else:
+                raise ValueError('Corrupt delta {}'.format(path))
+    return header, instructions
+
+
+def depth_of(path: str) -> int:
+    """
+    How many deltas deep the blob at `path` is; 0 for a full copy.
+    """
+    if not path.endswith(DELTA_SUFFIX):
+        return 0
+    return read_header(path).depth
+
+
+def rebuild(path: str, open_blob: Callable[[str], IO[bytes]]) -> bytes:
+    """
+    The full contents of the delta at `path`, where `open_blob` opens
+    its base (the name of which is relative to the delta's directory).
+    """
+    header, instructions = read_delta(path)
+    base_path = str(_sibling(path, header.base))
+    with open_blob(base_path) as f:
+        base = f.read()
+    return apply_delta(base, instructions)
+
+
+def bases_of(path: str) -> List[str]:
+    """
+    The names of every blob the delta at `path` needs, nearest first.
+    """
+    bases = []
+    while path.endswith(DELTA_SUFFIX):
+        try:
+            base = read_header(path).base
+        except (OSError, ValueError):
+            break
+        bases.append(base)
+        path = str(_sibling(path, base))
+    return bases
+
+
+def _sibling(path: str, name: str) -> Path:
+    return Path(path).parent / name
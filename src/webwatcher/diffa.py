@@ -1,9 +1,12 @@
 from hashlib import sha256
 import subprocess
-from typing import Dict, Optional
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
 
-from webwatcher.filehash import file_hash
+from webwatcher.contentdiff import ContentDiffer
+from webwatcher.imagediff import PixelDiffer, Region
 from webwatcher.observation import PageObservation
+from webwatcher.perceptualhash import PerceptualHashIndex, hamming_distance
 
 
 class ComparisonFailureException(Exception):
@@ -29,20 +32,51 @@ class PageDiff:
 
 
 class ScreenshotDiff:
-    def __init__(self, old, new, diff_file):
+    def __init__(self, old, new, diff_file, changed_ratio=None, regions=()):
         self.old = old
         self.new = new
         self.comparison = diff_file
+        self.changed_ratio = changed_ratio
+        self.regions = regions
+        # When earlier observations looked like the new one
+        self.resembles = []  # type: List[datetime]
 
     def __str__(self):
-        return ('ScreenshotDiff('
-                'old(hash)={},'
-                ' new={},'
-                ' comparison={})')\
-            .format(self.old, self.new, self.comparison)
-
-
-def _do_diff_on_screenshots(old_screenshot, new_screenshot):
+        if self.changed_ratio is None:
+            description = ('ScreenshotDiff('
+                           'old(hash)={},'
+                           ' new={},'
+                           ' comparison={})')\
+                .format(self.old, self.new, self.comparison)
+        else:
+            description = ('ScreenshotDiff('
+                           'old(hash)={},'
+                           ' new={},'
+                           ' changed={:.2%} in {} regions,'
+                           ' comparison={})')\
+                .format(self.old, self.new, self.changed_ratio,
+                        len(self.regions), self.comparison)
+        if self.resembles:
+            description += ' looks like it did at {}'.format(
+                ', '.join(str(t) for t in self.resembles))
+        return description
+
+
+def _looks_the_same(old_screenshot, new_screenshot, max_distance) -> bool:
+    if old_screenshot is None or new_screenshot is None:
+        return False
+    if old_screenshot.perceptual_hash is None or \
+            new_screenshot.perceptual_hash is None:
+        return False
+    return hamming_distance(old_screenshot.perceptual_hash,
+                            new_screenshot.perceptual_hash) <= max_distance
+
+
+def _do_diff_on_screenshots(old_screenshot,
+                            new_screenshot,
+                            pixel_differ=None,
+                            ignore_regions=(),
+                            perceptual_threshold=None):
     if old_screenshot == new_screenshot:
         return None
 
@@ -53,20 +87,93 @@ def _do_diff_on_screenshots(old_screenshot, new_screenshot):
 
     if new_screenshot is not None:
         new_path = new_screenshot.content_path
-        new_hash = file_hash(new_path).digest()
+        new_hash = new_screenshot.content_hash
     else:
         new_path = new_hash = None
 
     if old_hash == new_hash:
         return None
 
+    if perceptual_threshold is not None and \
+            _looks_the_same(old_screenshot, new_screenshot,
+                            perceptual_threshold):
+        return None
+
+    if pixel_differ is not None and new_path is not None and \
+            old_screenshot is not None and \
+            old_screenshot.content_path is not None:
+        comparison = pixel_differ.compare(
+            old_screenshot.content_path, new_path, ignore_regions)
+        if comparison is None:
+            return None
+        return ScreenshotDiff(old_hash,
+                              new_path,
+                              comparison.comparison_path,
+                              changed_ratio=comparison.changed_ratio,
+                              regions=comparison.regions)
+
     return ScreenshotDiff(old_hash, new_path, None)
 
 
+def _do_diff_on_content(content_differ, old_observation, new_observation):
+    if content_differ is None:
+        return None
+
+    old_path = old_observation.raw_content_location
+    new_path = new_observation.raw_content_location
+    if old_path is None or new_path is None:
+        return None
+
+    if old_observation.raw_content_hash is not None and \
+            old_observation.raw_content_hash == \
+            new_observation.raw_content_hash:
+        return None
+
+    return content_differ.diff(old_path, new_path)
+
+
 class Diffa:
+    def __init__(self,
+                 content_differ: Optional[ContentDiffer]=None,
+                 pixel_differ: Optional[PixelDiffer]=None,
+                 perceptual_threshold: Optional[int]=None,
+                 perceptual_index: Optional[PerceptualHashIndex]=None) \
+            -> None:
+        self.content_differ = content_differ
+        self.pixel_differ = pixel_differ
+        self.perceptual_threshold = perceptual_threshold
+        self.perceptual_index = perceptual_index
+
+    def _earlier_lookalikes(self, observation: PageObservation):
+        if self.perceptual_index is None or \
+                self.perceptual_threshold is None:
+            return []
+        phash = observation.screenshot.perceptual_hash \
+            if observation.screenshot is not None else None
+        if phash is None:
+            return []
+        return [seen_at for _, seen_at in self.perceptual_index.near(
+            observation.url, phash, self.perceptual_threshold)]
+
+    def _remember(self, observation: PageObservation) -> None:
+        if self.perceptual_index is None or observation.screenshot is None:
+            return
+        phash = observation.screenshot.perceptual_hash
+        if phash is not None:
+            self.perceptual_index.add(
+                observation.url, phash, observation.observation_time)
+
     def diff(self,
              new_observation: PageObservation,
-             old_observation: Optional[PageObservation]) -> Optional[PageDiff]:
+             old_observation: Optional[PageObservation],
+             ignore_regions: Sequence[Region]=()) -> Optional[PageDiff]:
+        try:
+            return self._diff(new_observation, old_observation,
+                              ignore_regions)
+        finally:
+            self._remember(new_observation)
+
+    def _diff(self, new_observation, old_observation, ignore_regions):
 
         if old_observation is None:
             print('No previous found')
@@ -81,11 +188,22 @@ class Diffa:
 
         screenshot_diff = _do_diff_on_screenshots(
             old_observation.screenshot,
-            new_observation.screenshot)
+            new_observation.screenshot,
+            self.pixel_differ,
+            ignore_regions,
+            self.perceptual_threshold)
+        if screenshot_diff is not None:
+            screenshot_diff.resembles = \
+                self._earlier_lookalikes(new_observation)
+
+        content_diff = _do_diff_on_content(
+            self.content_differ,
+            old_observation,
+            new_observation)
 
         d = PageDiff(
             availability=availability,
             screenshot_diff=screenshot_diff,
-            content_diff=None)
+            content_diff=content_diff)
 
         return d if d.differences() else None
@@ -0,0 +1,178 @@
+"""
+hostlimiter.py - being polite to the sites we watch.
+
+Fetches and screenshots of pages on the same host share one limiter, so
+that however many pages of a site are watched, and however many workers
+are watching them, the site sees no more than a set number of requests
+at once and no more than a set rate of new ones. Hosts that ask us to
+back off (429 or 503 with Retry-After) aren't contacted again until
+they said we could.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional
+from urllib.parse import urlparse
+
+
+class _Host:
+    def __init__(self,
+                 rate: Optional[float],
+                 max_in_flight: Optional[int],
+                 burst: float,
+                 now: float) -> None:
+        self.rate = rate
+        self.max_in_flight = max_in_flight
+        self.burst = burst
+        self.tokens = burst
+        self.refilled_at = now
+        self.in_flight = 0
+        self.blocked_until = 0.0
+
+
+class HostLimiter:
+    """
+    A token bucket and a count of requests in flight for each host.
+    `rate` is in requests per second, with up to `burst` made back to
+    back; None means no limit. Hosts can be given their own limits with
+    `configure`. No host is ever held off for longer than `max_back_off`
+    seconds, whatever it asks for.
+    """
+
+    def __init__(self,
+                 rate: Optional[float]=None,
+                 max_in_flight: Optional[int]=None,
+                 burst: float=1,
+                 max_back_off: float=600,
+                 clock: Callable[[], float]=time.monotonic) -> None:
+        self._rate = rate
+        self._max_in_flight = max_in_flight
+        self._burst = burst
+        self._max_back_off = max_back_off
+        self._clock = clock
+        self._hosts = dict()  # type: Dict[str, _Host]
+        self._changed = threading.Condition()
+
+    def _host(self, host: str) -> _Host:
+        if host not in self._hosts:
+            self._hosts[host] = _Host(self._rate, self._max_in_flight,
+                                      self._burst, self._clock())
+        return self._hosts[host]
+
+    def configure(self,
+                  url: str,
+                  rate: Optional[float]=None,
+                  max_in_flight: Optional[int]=None) -> None:
+        """
+        Sets limits for the host of `url`. Where several sites on one
+        host ask for limits, the strictest applies.
+        """
+        with self._changed:
+            host = self._host(_host_of(url))
+            if rate is not None:
+                host.rate = rate if host.rate is None \
+                    else min(host.rate, rate)
+            if max_in_flight is not None:
+                host.max_in_flight = max_in_flight \
+                    if host.max_in_flight is None \
+                    else min(host.max_in_flight, max_in_flight)
+
+    @contextmanager
+    def slot(self, url: str) -> Iterator[None]:
+        """
+        Waits until a request to the host of `url` is allowed, and
+        counts it as in flight until the block exits.
+        """
+        with self._changed:
+            host = self._host(_host_of(url))
+            while True:
+                wait = self._wait_needed(host)
+                if wait == 0:
+                    break
+                self._changed.wait(wait)
+            self._take(host)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+    def try_acquire(self, url: str) -> Optional[float]:
+        """
+        Like slot(), but never waits: counts a request to the host of
+        `url` as in flight and returns 0 if it's allowed now, or else
+        returns how long to wait before trying again (None: until
+        another request finishes). Acquired requests must be released.
+        """
+        with self._changed:
+            host = self._host(_host_of(url))
+            wait = self._wait_needed(host)
+            if wait == 0:
+                self._take(host)
+            return wait
+
+    def release(self, url: str) -> None:
+        with self._changed:
+            self._host(_host_of(url)).in_flight -= 1
+            self._changed.notify_all()
+
+    def _take(self, host: _Host) -> None:
+        host.in_flight += 1
+        if host.rate is not None:
+            host.tokens -= 1
+
+    def _wait_needed(self, host: _Host) -> Optional[float]:
+        """
+        0 if a request can go now; otherwise how long to wait before
+        looking again (None: until another request finishes).
+        """
+        now = self._clock()
+        if host.blocked_until > now:
+            return host.blocked_until - now
+        if host.max_in_flight is not None and \
+                host.in_flight >= host.max_in_flight:
+            return None
+        if host.rate is not None:
+            host.tokens = min(host.burst,
+                              host.tokens + (now - host.refilled_at) *
+                              host.rate)
+            host.refilled_at = now
+            if host.tokens < 1:
+                return (1 - host.tokens) / host.rate
+        return 0
+
+    def back_off(self, url: str, seconds: float) -> None:
+        """
+        Holds off all requests to the host of `url` for `seconds`.
+        """
+        with self._changed:
+            host = self._host(_host_of(url))
+            host.blocked_until = max(
+                host.blocked_until,
+                self._clock() + min(seconds, self._max_back_off))
+
+
+def retry_after_seconds(value: Optional[str],
+                        now: Optional[datetime]=None) -> Optional[float]:
+    """
+    Reads a Retry-After header, which is either a number of seconds or
+    an HTTP date.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    now = now or datetime.now(timezone.utc)
+    return max(0.0, (when - now).total_seconds())
+
+
+def _host_of(url: str) -> str:
+    return urlparse(url).netloc.lower()
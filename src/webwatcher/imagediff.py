@@ -0,0 +1,158 @@
+"""
+imagediff.py - pixel-level comparison of screenshots.
+
+Needs numpy and Pillow (`pip install webwatcher[imagediff]`); without
+them, screenshots can only be compared by hash.
+"""
+import logging
+import os
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+from webwatcher.compression import open_artefact
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:  # pragma: no cover - depends on the environment
+    np = None  # type: ignore
+    Image = None  # type: ignore
+
+
+Region = Tuple[int, int, int, int]  # left, top, right, bottom
+
+
+def pixel_diff_available() -> bool:
+    return np is not None and Image is not None
+
+
+class PixelComparison:
+    def __init__(self,
+                 changed_ratio: float,
+                 regions: Sequence[Region],
+                 comparison_path: Optional[str]) -> None:
+        self.changed_ratio = changed_ratio
+        self.regions = regions
+        self.comparison_path = comparison_path
+
+
+class PixelDiffer:
+    """
+    Decodes two screenshots and counts the pixels that differ by more
+    than `tolerance` in any channel, outside any ignored regions. Changes
+    affecting no more than `threshold` of the page are not reported.
+    """
+
+    def __init__(self,
+                 output_dir: Path,
+                 threshold: float=0.001,
+                 tolerance: int=16,
+                 cell_size: int=16) -> None:
+        if not pixel_diff_available():
+            raise RuntimeError(
+                'Pixel comparison needs numpy and Pillow installed')
+        self._output_dir = output_dir
+        self._threshold = threshold
+        self._tolerance = tolerance
+        self._cell_size = cell_size
+
+    def compare(self,
+                old_path: str,
+                new_path: str,
+                ignore_regions: Sequence[Region]=()) \
+            -> Optional[PixelComparison]:
+        old = _decode(old_path)
+        new = _decode(new_path)
+
+        height = max(old.shape[0], new.shape[0])
+        width = max(old.shape[1], new.shape[1])
+        old = _pad_to(old, height, width)
+        new = _pad_to(new, height, width)
+
+        difference = np.abs(old.astype(np.int16) - new.astype(np.int16))
+        changed = difference.max(axis=2) > self._tolerance
+        for left, top, right, bottom in ignore_regions:
+            changed[top:bottom, left:right] = False
+
+        changed_ratio = float(changed.mean()) if changed.size else 0.0
+        if changed_ratio <= self._threshold or not changed.any():
+            return None
+
+        regions = _changed_regions(changed, self._cell_size)
+        comparison_path = self._write_comparison(
+            new, changed, regions, old_path, new_path)
+        return PixelComparison(changed_ratio, regions, comparison_path)
+
+    def _write_comparison(self, new, changed, regions,
+                          old_path, new_path) -> Optional[str]:
+        highlighted = (new * 0.35).astype(np.uint8)
+        highlighted[changed] = (255, 0, 0)
+        for left, top, right, bottom in regions:
+            highlighted[top:bottom, [left, right - 1]] = (255, 255, 0)
+            highlighted[[top, bottom - 1], left:right] = (255, 255, 0)
+
+        name = '{}-{}.png'.format(Path(old_path).stem[:16],
+                                  Path(new_path).stem[:16])
+        try:
+            os.makedirs(str(self._output_dir), exist_ok=True)
+            path = self._output_dir / name
+            Image.fromarray(highlighted).save(str(path))
+        except OSError:
+            logging.warning('Unable to save screenshot comparison %s', name)
+            return None
+        return str(path)
+
+
+def _decode(path: str):
+    with open_artefact(path) as f:
+        image = Image.open(f)
+        return np.asarray(image.convert('RGB'))
+
+
+def _pad_to(image, height, width):
+    if image.shape[0] == height and image.shape[1] == width:
+        return image
+    # Area that only exists in one of the images shows up as changed
+    # against a background that no real pixel is likely to match exactly
+    padded = np.full((height, width, 3), (255, 0, 255), dtype=np.uint8)
+    padded[:image.shape[0], :image.shape[1]] = image
+    return padded
+
+
+def _changed_regions(changed, cell_size: int) -> List[Region]:
+    """
+    Bounding boxes of connected areas of change, found on a grid of
+    `cell_size` pixel cells rather than on individual pixels.
+    """
+    height, width = changed.shape
+    rows = -(-height // cell_size)
+    cols = -(-width // cell_size)
+    padded = np.zeros((rows * cell_size, cols * cell_size), dtype=bool)
+    padded[:height, :width] = changed
+    cells = np.any(padded.reshape(rows, cell_size, cols, cell_size),
+                   axis=(1, 3))
+
+    seen = np.zeros_like(cells)
+    regions = []
+    for start in zip(*np.nonzero(cells)):
+        if seen[start]:
+            continue
+        seen[start] = True
+        stack = [start]
+        top, left = start
+        bottom, right = start
+        while stack:
+            r, c = stack.pop()
+            top, bottom = min(top, r), max(bottom, r)
+            left, right = min(left, c), max(right, c)
+            for nr, nc in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)):
+                if 0 <= nr < rows and 0 <= nc < cols and \
+                        cells[nr, nc] and not seen[nr, nc]:
+                    seen[nr, nc] = True
+                    stack.append((nr, nc))
+        regions.append((
+            int(left * cell_size),
+            int(top * cell_size),
+            int(min((right + 1) * cell_size, width)),
+            int(min((bottom + 1) * cell_size, height))))
+    return regions
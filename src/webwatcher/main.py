@@ -2,86 +2,359 @@
 webwatcher
 
 Usage:
-    webwatcher [--config=<config>]
+    webwatcher [--config=<config>] [--storage=<backend>] [--workers=<n>]
+               [--compression=<codec>] [--delta-chain=<n>]
+               [--durability=<policy>] [--batch-size=<n>]
+               [--max-fetches=<n>] [--max-screenshots=<n>] [--async-fetch]
+               [--browser-pool=<n>] [--recycle-after=<n>]
+               [--page-timeout=<seconds>] [--always-screenshot]
+               [--normalise=<rules>] [--pixel-diff]
+               [--pixel-threshold=<ratio>] [--perceptual-hash=<bits>]
+               [--daemon] [--interval=<duration>] [--jitter=<ratio>]
+               [--host-rate=<per-second>] [--host-in-flight=<n>]
+               [--connect-timeout=<seconds>] [--read-timeout=<seconds>]
+               [--total-timeout=<seconds>] [--max-body-size=<bytes>]
+               [--retries=<n>] [--metrics=<file>]
+               [--metrics-format=<format>] [--profile=<file>]
+               [--profile-stages=<stages>] [--shard=<i/n>]
+    webwatcher gc [--storage=<backend>] [--keep=<n>] [--keep-days=<days>]
+    webwatcher merge [--storage=<backend>]
+    webwatcher convert --to=<backend> [--storage=<backend>]
     webwatcher --show-config-template
 
 Options:
     --config=<config>           Specify a path to a configuration file that 
                                 tells webwatcher which parts of the web to 
                                 watch
+    --storage=<backend>         How observation records are kept: `jsonlines`
+                                (a flat record file), `sqlite` (indexed;
+                                existing records are migrated on first use)
+                                or `binary` (a compact file that's quicker to
+                                read; see `convert`) [default: jsonlines]
+    --compression=<codec>       How to compress newly stored page content:
+                                `gzip`, `zstd` (needs the zstandard package)
+                                or `none`; already-compressed formats such as
+                                PNG screenshots are stored as they are
+                                [default: gzip]
+    --delta-chain=<n>           Store page content as the changes from the
+                                previous version of the page, keeping enough
+                                full copies that reading any version back
+                                never means applying more than <n> sets of
+                                changes; 0 always stores full copies
+                                [default: 0]
+    --durability=<policy>       `fsync` to make sure each batch of
+                                observations is on disk before carrying on,
+                                or `none` to leave it to the operating system
+                                [default: fsync]
+    --batch-size=<n>            Write out observations in batches of up to
+                                this many, or those finished within a second
+                                of each other if fewer, so that one fsync
+                                covers them all [default: 64]
+    --workers=<n>               How many pages to observe at once
+                                [default: 1]
+    --max-fetches=<n>           Upper limit on concurrent page downloads
+                                (defaults to the number of workers)
+    --max-screenshots=<n>       Upper limit on concurrent browser processes
+                                (defaults to the number of workers)
+    --async-fetch               Download pages over non-blocking connections
+                                on one thread, rather than each on a worker
+                                of its own: every page is requested at once,
+                                up to --max-fetches at a time (100 if not
+                                set), and handed to the workers as soon as
+                                it arrives. Doesn't go through proxies
+    --browser-pool=<n>          Keep this many headless browsers running and
+                                reuse them for screenshots; 0 starts a fresh
+                                browser for every page [default: 0]
+    --recycle-after=<n>         Restart a pooled browser after it has taken
+                                this many screenshots [default: 50]
+    --page-timeout=<seconds>    Give up on a screenshot if the page takes
+                                longer than this to load [default: 10]
+    --always-screenshot         Take a fresh screenshot of every page, even
+                                when its content is byte-for-byte the same as
+                                last time (see also `force_screenshot` in
+                                the site configuration)
+    --normalise=<rules>         Comma-separated list of things to ignore when
+                                comparing page content: any of `scripts`,
+                                `timestamps`, `csrf` (tokens and nonces) and
+                                `whitespace`, or `none`
+                                [default: scripts,timestamps,csrf,whitespace]
+    --pixel-diff                Compare screenshots pixel by pixel rather than
+                                by hash, and save an image highlighting what
+                                changed (needs numpy and Pillow)
+    --pixel-threshold=<ratio>   With --pixel-diff, the fraction of a page's
+                                pixels that must change before it counts as
+                                a difference [default: 0.001]
+    --perceptual-hash=<bits>    Record a perceptual hash of each screenshot,
+                                and treat screenshots whose hashes are at
+                                most <bits> apart (of 256) as unchanged
+                                (needs numpy and Pillow)
+    --daemon                    Keep running, checking each page again once
+                                its interval has passed, rather than checking
+                                every page once and exiting. Connections and
+                                pooled browsers stay open between checks
+    --interval=<duration>       With --daemon, how often to check pages that
+                                don't set their own `interval` (seconds, or
+                                e.g. `15m`, `2h`, `1d`) [default: 1h]
+    --jitter=<ratio>            With --daemon, vary each interval by up to
+                                this fraction, so checks don't bunch up
+                                [default: 0.1]
+    --host-rate=<per-second>    Most requests per second to start against any
+                                one host, counting both downloads and
+                                screenshots (see also `rate_limit` in the
+                                site configuration)
+    --host-in-flight=<n>        Most downloads and screenshots to have going
+                                against any one host at once (see also
+                                `max_in_flight`) [default: 4]
+    --connect-timeout=<seconds> Give up connecting to a server after this long
+                                [default: 10]
+    --read-timeout=<seconds>    Give up on a download when the server sends
+                                nothing for this long [default: 30]
+    --total-timeout=<seconds>   Give up on a download that takes longer than
+                                this overall [default: 120]
+    --max-body-size=<bytes>     Don't keep pages bigger than this
+                                [default: 52428800]
+    --retries=<n>               Try this many more times when a download
+                                fails in a way that might not happen again
+                                (a dropped connection, a timeout, or a 429,
+                                500, 502, 503 or 504 response) [default: 2]
+    --metrics=<file>            Write how long each stage of observing pages
+                                took (p50, p95 and max, per stage), bytes
+                                fetched and deduplication hits to <file>, at
+                                the end of the run or, with --daemon, after
+                                every check
+    --metrics-format=<format>   `jsonlines` (appended to) or `prometheus` (a
+                                textfile for node_exporter's collector, kept
+                                up to date) [default: jsonlines]
+    --profile=<file>            Profile the run with cProfile and save the
+                                statistics to <file>, for pstats or snakeviz
+    --profile-stages=<stages>   With --profile, comma-separated list of the
+                                stages to profile: any of `page`, `previous`,
+                                `fetch`, `screenshot`, `diff` and `persist`
+                                [default: page]
+    --shard=<i/n>               Only watch the i-th of n roughly equal shares
+                                of the configured pages (split by url), and
+                                keep their records in a segment of their own,
+                                so that n webwatchers can share the work.
+                                Queries read every segment; `merge` folds
+                                them back together
+    --to=<backend>              The record store backend to convert to
+    --keep=<n>                  When collecting garbage, always keep the
+                                newest <n> observations of each page
+                                [default: 10]
+    --keep-days=<days>          When collecting garbage, also keep every
+                                observation from the last <days> days
     --show-config-template      Print out a sample configuration file
 
+Commands:
+    gc                          Throw away old observations (other than those
+                                where a page changed) and any stored content
+                                they no longer need
+    merge                       Move the records kept by sharded runs into
+                                the main record store, once they've finished
+    convert                     Rewrite the records kept with the --storage
+                                backend using another, keeping the old files
+                                as *.converted
+
 """
 
 from typing import Collection
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime, timezone
 import functools
+import logging
 import os
 import re
 import shutil
+import signal
 import subprocess
 import sys
 import tarfile
 import tempfile
-from typing import Iterable, Optional
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import docopt
 import requests
 from requests.exceptions import ConnectionError
 
-from webwatcher.diffa import Diffa
+from webwatcher.artefact import Artefact
+from webwatcher.asyncfetcher import AsyncWebFetcher
+from webwatcher.compression import zstd_available
+from webwatcher.contentdiff import ContentDiffer, NORMALISATION_RULES
+from webwatcher.diffa import Diffa, PageDiff
+from webwatcher.environment import cache_folder, data_folder
+from webwatcher.hostlimiter import HostLimiter
+from webwatcher.imagediff import PixelDiffer, pixel_diff_available
+from webwatcher.metrics import METRICS_FORMATS, ProfilerHook, RunMetrics
 from webwatcher.observation import PageObservation, Screenshot
-from webwatcher.screenshotter import Screenshotter
+from webwatcher.perceptualhash import PerceptualHashIndex, \
+    perceptual_hash_available
+from webwatcher.recordstore import convert_records
+from webwatcher.retention import RetentionPolicy
+from webwatcher.scheduler import Scheduler
+from webwatcher.screenshotter import Screenshotter, browser_pool
+from webwatcher.sharding import Shard
 from webwatcher.storage import Storage
 from webwatcher.temporarystorage import temporary_storage
-from webwatcher.webfetcher import WebFetcher
+from webwatcher.webfetcher import FetchResult, WebFetcher
 from webwatcher.watchconfiguration import \
-    PageUnderObsevation, watched_pages, print_config_template
+    PageUnderObsevation, parse_duration, watched_pages, print_config_template
 
 
 def get_previous_observation(storage: Storage, page: PageUnderObsevation) \
         -> Optional[PageObservation]:
-    persisted_data = storage.find(url=page.url) \
-        .having('timestamp') \
-        .order_by('timestamp',
-                  desc=True) \
-        .fetch()
-    if not persisted_data:
+    persisted_data = storage.latest(page.url)
+    if persisted_data is None:
         return None
+
+    raw_content_location = persisted_data.fetch_local('raw_content')
+    if raw_content_location is not None:
+        raw_content : Optional[Artefact] = Artefact(
+            raw_content_location,
+            sha256=persisted_data['raw_content_hash'],
+            size=persisted_data['raw_content_size'])
     else:
-        persisted_data = persisted_data[0]
+        raw_content = None
 
     screenshot_content_hash = persisted_data['screenshot_content']
     if screenshot_content_hash is not None:
-        screenshot : Optional[Screenshot] = Screenshot(content_hash=screenshot_content_hash)
+        screenshot : Optional[Screenshot] = Screenshot(
+            content_hash=screenshot_content_hash,
+            content_path=persisted_data.fetch_local('screenshot'),
+            perceptual_hash=persisted_data['screenshot_phash'])
     else:
         screenshot = None
 
+    validators = {k: persisted_data[k] for k in ('etag', 'last_modified')
+                  if persisted_data[k] is not None}
+
     return PageObservation(
         url=persisted_data['url'],
         observation_time=persisted_data['timestamp'],
         availability=persisted_data['was_available'],
         screenshot=screenshot,
-        raw_content_location=persisted_data.fetch_local('raw_content')
+        raw_content=raw_content,
+        validators=validators
     )
 
 
+class _Unlimited:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def _concurrency_limit(limit: Optional[int]):
+    if limit is None:
+        return _Unlimited()
+    return threading.BoundedSemaphore(limit)
+
+
 class Observer:
-    def __init__(self, screenshotter, webfetcher):
+    def __init__(self,
+                 screenshotter,
+                 webfetcher,
+                 max_fetches: Optional[int]=None,
+                 max_screenshots: Optional[int]=None,
+                 reuse_unchanged_screenshots: bool=True,
+                 metrics: Optional[RunMetrics]=None) -> None:
         self.screenshotter = screenshotter
         self.webfetcher = webfetcher
+        self.reuse_unchanged_screenshots = reuse_unchanged_screenshots
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self._fetch_slots = _concurrency_limit(max_fetches)
+        self._screenshot_slots = _concurrency_limit(max_screenshots)
+
+    def observe(self,
+                page: PageUnderObsevation,
+                previous: Optional[PageObservation]=None,
+                fetched: Optional[FetchResult]=None) -> PageObservation:
+        """
+        Fetches the page, unless it's been `fetched` already (with the
+        validators _reusable_validators() gives), and screenshots it if
+        need be.
+        """
+        if fetched is None:
+            validators = self._reusable_validators(page, previous)
+            with self._fetch_slots, self.metrics.span('fetch', page.url):
+                fetched = self.webfetcher.fetch(page.url,
+                                                validators=validators)
+        if fetched.raw_content is not None and \
+                fetched.raw_content.size is not None:
+            self.metrics.count('bytes_fetched', fetched.raw_content.size)
 
-    def observe(self, page: PageUnderObsevation) -> PageObservation:
-        was_available, raw_content = self.webfetcher.fetch(page.url)
-        screenshot = self.screenshotter.take_screenshot_of(page.url)
+        # Conditional requests are only sent with a previous observation
+        if fetched.not_modified and previous is not None:
+            self.metrics.count('not_modified')
+            # The server vouches that nothing changed since `previous`,
+            # so its stored content and screenshot stand for this one too
+            return PageObservation(
+                url=page.url,
+                observation_time=datetime.now(timezone.utc),
+                availability=True,
+                screenshot=previous.screenshot,
+                raw_content=previous.raw_content,
+                validators=fetched.validators,
+                fetch_failures=fetched.failures)
+
+        if previous is not None and \
+                self._content_unchanged(page, fetched, previous):
+            screenshot = previous.screenshot
+            self.metrics.count('screenshots_reused')
+        else:
+            with self._screenshot_slots, \
+                    self.metrics.span('screenshot', page.url):
+                screenshot = self.screenshotter.take_screenshot_of(page.url)
 
         return PageObservation(
             url=page.url,
             observation_time=datetime.now(timezone.utc),
-            availability=was_available,
+            availability=fetched.was_available,
             screenshot=screenshot,
-            raw_content_location=raw_content)
+            raw_content=fetched.raw_content,
+            validators=fetched.validators,
+            fetch_failures=fetched.failures)
+
+    def _may_reuse_screenshots(self, page: PageUnderObsevation) -> bool:
+        return self.reuse_unchanged_screenshots and not page.force_screenshot
+
+    def _reusable_validators(self, page, previous):
+        if not self._may_reuse_screenshots(page):
+            return None
+        if previous is None or not previous.availability:
+            return None
+        if previous.raw_content_location is None:
+            return None
+        if previous.screenshot is None or \
+                previous.screenshot.content_path is None:
+            return None
+        return previous.validators or None
+
+    def _content_unchanged(self, page, fetched, previous) -> bool:
+        if not self._may_reuse_screenshots(page):
+            return False
+        if not fetched.was_available or fetched.raw_content is None:
+            return False
+        if previous.availability != fetched.was_available:
+            return False
+        if previous.screenshot is None or \
+                previous.screenshot.content_path is None:
+            return False
+        return previous.raw_content_hash == fetched.raw_content.sha256
+
+
+def storage_counters(storage: Storage) -> Dict[str, float]:
+    stats = storage.artefact_stats
+    return {
+        'artefact_dedup_hits': stats.hits,
+        'artefact_writes': stats.writes,
+        'bytes_deduplicated': stats.bytes_deduplicated,
+        'bytes_written': stats.bytes_written,
+    }
 
 
 def _raise_first(errors: Iterable[Exception]):
@@ -89,30 +362,86 @@ def _raise_first(errors: Iterable[Exception]):
         raise e
 
 
+def _observe_page(
+        diffa: Diffa,
+        storage: Storage,
+        watcher: Observer,
+        page: PageUnderObsevation,
+        fetched_ahead: Optional[
+            Tuple[Optional[PageObservation], FetchResult]]=None) \
+        -> Optional[PageDiff]:
+    metrics = watcher.metrics
+    with metrics.span('page', page.url):
+        if fetched_ahead is None:
+            with metrics.span('previous', page.url):
+                previous_observation = get_previous_observation(storage, page)
+            fetched = None
+        else:
+            previous_observation, fetched = fetched_ahead
+        observation = watcher.observe(page, previous_observation,
+                                      fetched=fetched)
+        with metrics.span('diff', page.url):
+            diff = diffa.diff(observation, previous_observation,
+                              ignore_regions=page.ignore_regions)
+        with metrics.span('persist', page.url):
+            storage.persist(observation)
+    return diff
+
+
 def observe_the_web(
         diffa: Diffa,
         storage: Storage,
         watcher: Observer,
-        under_observation: Iterable[PageUnderObsevation]) -> None:
+        under_observation: Iterable[PageUnderObsevation],
+        workers: int=1) -> None:
 
     diffs = dict()
-    errors = dict()
+    errors = dict()  # type: Dict[str, Exception]
 
-    for page in under_observation:
-        try:
-            observation = watcher.observe(page)
-            previous_observation = get_previous_observation(storage, page)
-            diff = diffa.diff(observation, previous_observation)
-            if diff:
-                diffs[page.url] = diff
-            storage.persist(observation)
-        except Exception as ex:
-            errors[page.url] = ex
+    if isinstance(watcher.webfetcher, AsyncWebFetcher):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            def observe(page, fetched_ahead):
+                return executor.submit(_observe_page, diffa, storage,
+                                       watcher, page, fetched_ahead)
+
+            in_flight = _fetch_ahead(storage, watcher, under_observation,
+                                     errors, observe)
+            for page, future in in_flight:
+                try:
+                    diff = future.result()
+                    if diff:
+                        diffs[page.url] = diff
+                except Exception as ex:
+                    errors[page.url] = ex
+    elif workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = [
+                (page, executor.submit(
+                    _observe_page, diffa, storage, watcher, page))
+                for page in under_observation]
+            for page, future in in_flight:
+                try:
+                    diff = future.result()
+                    if diff:
+                        diffs[page.url] = diff
+                except Exception as ex:
+                    errors[page.url] = ex
+    else:
+        for page in under_observation:
+            try:
+                diff = _observe_page(diffa, storage, watcher, page)
+                if diff:
+                    diffs[page.url] = diff
+            except Exception as ex:
+                errors[page.url] = ex
 
     for url, diff in diffs.items():
-        print('Differences in {url}'.format(url=url))
-        for k, v in diff.differences().items():
-            print('\t{k}: {v}'.format(**locals()))
+        _report_diff(url, diff)
+
+    # Only differences and errors go to stdout, which cron mails out
+    logging.info('Storage: %s', storage.artefact_stats)
+    for line in watcher.metrics.describe(storage_counters(storage)):
+        logging.info('Timings: %s', line)
 
     if errors:
         print('Errors:')
@@ -122,23 +451,313 @@ def observe_the_web(
     _raise_first(errors.values())
 
 
-def run_web_watcher(config_file) -> None:
-    with temporary_storage() as temp_storage:
-        diffa = Diffa()
-        storage = Storage()
-        screenshotter = Screenshotter(temp_storage)
-        fetcher = WebFetcher(temp_storage)
-        watcher = Observer(screenshotter, fetcher)
+def _fetch_ahead(
+        storage: Storage,
+        watcher: Observer,
+        under_observation: Iterable[PageUnderObsevation],
+        errors: Dict[str, Exception],
+        observe: Callable[..., Future]) \
+        -> List[Tuple[PageUnderObsevation, Future]]:
+    """
+    Starts downloading every page at once, then has each observed, by
+    `observe(page, (previous, fetched))`, as soon as it has arrived.
+    """
+    metrics = watcher.metrics
+    wanted = []
+    for page in under_observation:
+        try:
+            with metrics.span('previous', page.url):
+                wanted.append(
+                    (page, get_previous_observation(storage, page)))
+        except Exception as ex:
+            errors[page.url] = ex
+
+    in_flight = []
+    for i, fetching in watcher.webfetcher.fetch_all(
+            [(page.url, watcher._reusable_validators(page, previous))
+             for page, previous in wanted]):
+        page, previous = wanted[i]
+        try:
+            fetched, seconds = fetching.result()
+        except Exception as ex:
+            errors[page.url] = ex
+            continue
+        metrics.record('fetch', seconds)
+        in_flight.append((page, observe(page, (previous, fetched))))
+    return in_flight
+
+
+def _report_diff(url: str, diff: PageDiff) -> None:
+    print('Differences in {url}'.format(url=url))
+    for k, v in diff.differences().items():
+        print('\t{k}: {v}'.format(**locals()))
 
-        under_observation = watched_pages(config_file)
-        if under_observation is None:
-            sys.exit(1)
+
+def watch_the_web(
+        diffa: Diffa,
+        storage: Storage,
+        watcher: Observer,
+        scheduler: Scheduler,
+        workers: int=1,
+        stop: Optional[threading.Event]=None,
+        after_check: Optional[Callable[[], None]]=None) -> None:
+    """
+    Checks pages as the scheduler says they fall due, until `stop` is
+    set. Unlike observe_the_web, errors are reported as they happen and
+    the page is tried again at its next interval. `after_check` is called
+    whenever a page has been checked, such as to export metrics.
+    """
+    stop = stop or threading.Event()
+    wakeup = threading.Event()
+
+    def check(page):
+        try:
+            diff = _observe_page(diffa, storage, watcher, page)
+            if diff:
+                _report_diff(page.url, diff)
+        except Exception:
+            logging.exception('While inspecting %s', page.url)
+        finally:
+            scheduler.reschedule(page)
+            wakeup.set()
+        if after_check is not None:
+            try:
+                after_check()
+            except Exception:
+                logging.exception('After checking %s', page.url)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while not stop.is_set():
+            for page in scheduler.due():
+                executor.submit(check, page)
+            # A finished check wakes us early, as it's been put back in
+            # the queue and might now be the next one due
+            next_due = scheduler.seconds_until_next()
+            wakeup.wait(_DAEMON_POLL_SECONDS if next_due is None
+                        else min(next_due, _DAEMON_POLL_SECONDS))
+            wakeup.clear()
+
+
+# Downloads in progress at once with --async-fetch, unless --max-fetches
+# says otherwise
+_ASYNC_MAX_FETCHES = 100
+
+# Upper limit on how long the daemon sleeps before checking for a stop
+_DAEMON_POLL_SECONDS = 5.0
+
+
+def _stop_on_signals(stop: threading.Event) -> None:
+    def handler(signum, frame):
+        logging.info('Stopping after the checks in progress')
+        stop.set()
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+
+def run_web_watcher(config_file,
+                    storage_backend='jsonlines',
+                    workers=1,
+                    compression='gzip',
+                    max_delta_chain=0,
+                    max_fetches=None,
+                    max_screenshots=None,
+                    async_fetch=False,
+                    browser_pool_size=0,
+                    recycle_browsers_after=50,
+                    page_timeout=10,
+                    always_screenshot=False,
+                    normalisation=NORMALISATION_RULES,
+                    pixel_threshold=None,
+                    perceptual_threshold=None,
+                    daemon=False,
+                    default_interval=3600.0,
+                    jitter=0.1,
+                    host_rate=None,
+                    host_in_flight=4,
+                    connect_timeout=10.0,
+                    read_timeout=30.0,
+                    total_timeout=120.0,
+                    max_body_size=50 * 1024 * 1024,
+                    retries=2,
+                    metrics_file=None,
+                    metrics_format='jsonlines',
+                    profile_file=None,
+                    profile_stages=('page',),
+                    shard=None,
+                    durability='fsync',
+                    batch_size=64) -> None:
+    if perceptual_threshold is not None and \
+            not perceptual_hash_available():
+        logging.warning('numpy and Pillow are needed for --perceptual-hash')
+        perceptual_threshold = None
+
+    under_observation = watched_pages(config_file)
+    if under_observation is None:
+        sys.exit(1)
+    under_observation = list(under_observation)
+    if shard is not None:
+        under_observation = [page for page in under_observation
+                             if shard.contains(page.url)]
+        logging.info('Shard %s watches %d pages', shard,
+                     len(under_observation))
+
+    limiter = HostLimiter(rate=host_rate, max_in_flight=host_in_flight)
+    for page in under_observation:
+        limiter.configure(page.url,
+                          rate=page.rate_limit,
+                          max_in_flight=page.max_in_flight)
+
+    if metrics_format not in METRICS_FORMATS:
+        raise ValueError(
+            'Unknown metrics format: {name} (expected one of {known})'
+            .format(name=metrics_format, known=', '.join(METRICS_FORMATS)))
+
+    metrics = RunMetrics()
+    if profile_file is not None:
+        profiler = ProfilerHook(profile_stages)
+        metrics.add_hook(profiler)
+
+    with ExitStack() as resources:
+        if profile_file is not None:
+            resources.callback(profiler.write, profile_file)
+        temp_storage = resources.enter_context(temporary_storage())
+        storage = Storage(backend=storage_backend,
+                          compression=_usable_compression(compression),
+                          max_delta_chain=max_delta_chain,
+                          segment=shard.segment if shard is not None
+                          else None,
+                          durability=durability)
+        resources.enter_context(storage.batch(max_records=batch_size))
+        diffa = Diffa(
+            content_differ=ContentDiffer(normalisation),
+            pixel_differ=_pixel_differ(pixel_threshold),
+            perceptual_threshold=perceptual_threshold,
+            perceptual_index=PerceptualHashIndex.from_storage(storage)
+            if perceptual_threshold is not None else None)
+        if browser_pool_size > 0:
+            pool = resources.enter_context(browser_pool(
+                temp_storage,
+                size=browser_pool_size,
+                recycle_after=recycle_browsers_after,
+                page_timeout=page_timeout))
+        else:
+            pool = None
+        screenshotter = Screenshotter(
+            temp_storage,
+            pool=pool,
+            timeout=page_timeout,
+            perceptual_hashes=perceptual_threshold is not None,
+            limiter=limiter)
+        if async_fetch:
+            async_fetcher = AsyncWebFetcher(
+                temp_storage,
+                timeout=(connect_timeout, read_timeout),
+                limiter=limiter,
+                total_timeout=total_timeout,
+                max_body_size=max_body_size,
+                retries=retries,
+                max_connections=max_fetches or _ASYNC_MAX_FETCHES)
+            resources.callback(async_fetcher.close)
+            fetcher = \
+                async_fetcher  # type: Union[AsyncWebFetcher, WebFetcher]
+        else:
+            fetcher = WebFetcher(temp_storage,
+                                 timeout=(connect_timeout, read_timeout),
+                                 limiter=limiter,
+                                 total_timeout=total_timeout,
+                                 max_body_size=max_body_size,
+                                 retries=retries)
+        watcher = Observer(screenshotter,
+                           fetcher,
+                           max_fetches=max_fetches,
+                           max_screenshots=max_screenshots,
+                           reuse_unchanged_screenshots=not always_screenshot,
+                           metrics=metrics)
+
+        export_metrics = None
+        if metrics_file is not None:
+            write_metrics = METRICS_FORMATS[metrics_format]
+
+            def export_metrics():
+                write_metrics(metrics, metrics_file, storage_counters(storage))
+
+            if not daemon:
+                resources.callback(export_metrics)
+
+        if daemon:
+            stop = threading.Event()
+            _stop_on_signals(stop)
+            watch_the_web(
+                diffa,
+                storage,
+                watcher,
+                Scheduler(under_observation,
+                          default_interval=default_interval,
+                          jitter=jitter),
+                workers=workers,
+                stop=stop,
+                after_check=export_metrics)
+            return
 
         observe_the_web(
             diffa,
             storage,
             watcher,
-            under_observation)
+            under_observation,
+            workers=workers)
+
+
+def collect_garbage(storage_backend, keep_last, keep_days) -> None:
+    storage = Storage(backend=storage_backend)
+    policy = RetentionPolicy(keep_last=keep_last, keep_days=keep_days)
+    print(storage.compact(policy.select))
+
+
+def merge_segments(storage_backend) -> None:
+    storage = Storage(backend=storage_backend)
+    print('Merged {} records'.format(storage.merge_segments()))
+
+
+def convert_storage(storage_backend, target_backend) -> None:
+    converted = convert_records(data_folder('storage'),
+                                storage_backend, target_backend)
+    print('Converted {} records to {}'.format(converted, target_backend))
+
+
+def _pixel_differ(threshold: Optional[float]) -> Optional[PixelDiffer]:
+    if threshold is None:
+        return None
+    if not pixel_diff_available():
+        logging.warning('numpy and Pillow are needed for --pixel-diff; '
+                        'comparing screenshots by hash instead')
+        return None
+    return PixelDiffer(cache_folder('comparisons'), threshold=threshold)
+
+
+def _usable_compression(compression: str) -> str:
+    if compression == 'zstd' and not zstd_available():
+        logging.warning('The zstandard package is needed for zstd '
+                        'compression; using gzip instead')
+        return 'gzip'
+    return compression
+
+
+def _normalisation_rules(arg: str) -> List[str]:
+    if arg == 'none':
+        return []
+    return [rule.strip() for rule in arg.split(',') if rule.strip()]
+
+
+def _stage_list(arg: str) -> List[str]:
+    return [stage.strip() for stage in arg.split(',') if stage.strip()]
+
+
+def _optional_int(arg: Optional[str]) -> Optional[int]:
+    return int(arg) if arg is not None else None
+
+
+def _optional_float(arg: Optional[str]) -> Optional[float]:
+    return float(arg) if arg is not None else None
 
 
 def main() -> None:
@@ -146,8 +765,53 @@ def main() -> None:
     if args['--show-config-template']:
         print_config_template()
         sys.exit(0)
+    elif args['gc']:
+        collect_garbage(storage_backend=args['--storage'],
+                        keep_last=int(args['--keep']),
+                        keep_days=_optional_float(args['--keep-days']))
+    elif args['merge']:
+        merge_segments(storage_backend=args['--storage'])
+    elif args['convert']:
+        convert_storage(storage_backend=args['--storage'],
+                        target_backend=args['--to'])
     else:
-        run_web_watcher(config_file=args['--config'])
+        run_web_watcher(config_file=args['--config'],
+                        storage_backend=args['--storage'],
+                        workers=int(args['--workers']),
+                        compression=args['--compression'],
+                        max_delta_chain=int(args['--delta-chain']),
+                        durability=args['--durability'],
+                        batch_size=int(args['--batch-size']),
+                        max_fetches=_optional_int(args['--max-fetches']),
+                        max_screenshots=_optional_int(
+                            args['--max-screenshots']),
+                        async_fetch=args['--async-fetch'],
+                        browser_pool_size=int(args['--browser-pool']),
+                        recycle_browsers_after=int(args['--recycle-after']),
+                        page_timeout=float(args['--page-timeout']),
+                        always_screenshot=args['--always-screenshot'],
+                        normalisation=_normalisation_rules(
+                            args['--normalise']),
+                        pixel_threshold=float(args['--pixel-threshold'])
+                        if args['--pixel-diff'] else None,
+                        perceptual_threshold=_optional_int(
+                            args['--perceptual-hash']),
+                        daemon=args['--daemon'],
+                        default_interval=parse_duration(args['--interval']),
+                        jitter=float(args['--jitter']),
+                        host_rate=_optional_float(args['--host-rate']),
+                        host_in_flight=int(args['--host-in-flight']),
+                        connect_timeout=float(args['--connect-timeout']),
+                        read_timeout=float(args['--read-timeout']),
+                        total_timeout=float(args['--total-timeout']),
+                        max_body_size=int(args['--max-body-size']),
+                        retries=int(args['--retries']),
+                        metrics_file=args['--metrics'],
+                        metrics_format=args['--metrics-format'],
+                        profile_file=args['--profile'],
+                        profile_stages=_stage_list(args['--profile-stages']),
+                        shard=Shard.parse(args['--shard'])
+                        if args['--shard'] else None)
 
 
 if __name__ == '__main__':
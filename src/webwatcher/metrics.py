@@ -0,0 +1,230 @@
+"""
+metrics.py - where the time goes during a run.
+
+Each page's trip through the watcher is split into stages (looking up
+the previous observation, fetching, taking a screenshot, diffing and
+persisting), each timed as a span. Spans are summarised per stage at the
+end of a run, and can be exported as JSON lines or as a Prometheus
+textfile. Hooks get to wrap every span, which is how a profiler can be
+attached to just the stages of interest.
+"""
+from collections import deque
+from contextlib import ExitStack, contextmanager
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from typing import Callable, ContextManager, Deque, Dict, Iterator, List, \
+    Optional, Sequence
+
+
+STAGES = ('page', 'previous', 'fetch', 'screenshot', 'diff', 'persist')
+
+# Latency percentiles come from (at most) this many of the most recent
+# spans of each stage, so a long-running daemon doesn't grow forever
+_SAMPLES_KEPT = 10000
+
+# Given a stage and url, returns a context manager to run around the span
+SpanHook = Callable[[str, Optional[str]], ContextManager]
+
+
+def _percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class _Stage:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=_SAMPLES_KEPT)  # type: Deque[float]
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def summary(self) -> Dict[str, float]:
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': _percentile(samples, 0.50),
+            'p95': _percentile(samples, 0.95),
+            'max': self.max,
+        }
+
+
+class RunMetrics:
+    def __init__(self, clock: Callable[[], float]=time.perf_counter) -> None:
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._stages = dict()  # type: Dict[str, _Stage]
+        self._counters = dict()  # type: Dict[str, float]
+        self._hooks = []  # type: List[SpanHook]
+
+    def add_hook(self, hook: SpanHook) -> None:
+        self._hooks.append(hook)
+
+    @contextmanager
+    def span(self, stage: str, url: Optional[str]=None) -> Iterator[None]:
+        with ExitStack() as hooks:
+            for hook in self._hooks:
+                hooks.enter_context(hook(stage, url))
+            started = self._clock()
+            try:
+                yield
+            finally:
+                self.record(stage, self._clock() - started)
+
+    def record(self, stage: str, seconds: float) -> None:
+        """
+        Adds a span timed some other way, such as on an event loop,
+        where hooks can't wrap it.
+        """
+        with self._lock:
+            self._stages.setdefault(stage, _Stage()).add(seconds)
+
+    def count(self, counter: str, amount: float=1) -> None:
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def summary(self, extra_counters: Optional[Dict[str, float]]=None) \
+            -> Dict[str, Dict]:
+        with self._lock:
+            stages = {name: stage.summary()
+                      for name, stage in self._stages.items()}
+            counters = dict(self._counters)
+        counters.update(extra_counters or {})
+        return {'stages': stages, 'counters': counters}
+
+    def describe(self, extra_counters: Optional[Dict[str, float]]=None) \
+            -> List[str]:
+        summary = self.summary(extra_counters)
+        lines = []
+        for name in _ordered(summary['stages']):
+            s = summary['stages'][name]
+            lines.append(
+                '{name}: n={count} p50={p50:.3f}s p95={p95:.3f}s '
+                'max={max:.3f}s total={total:.3f}s'.format(name=name, **s))
+        for name, value in sorted(summary['counters'].items()):
+            lines.append('{}: {:g}'.format(name, value))
+        return lines
+
+    def write_json_lines(self,
+                         path: str,
+                         extra_counters: Optional[Dict[str, float]]=None) \
+            -> None:
+        """
+        Appends one line per stage and one of counters, all stamped
+        with the time they were written.
+        """
+        summary = self.summary(extra_counters)
+        written_at = time.time()
+        with open(path, 'a', encoding='utf-8') as f:
+            for name in _ordered(summary['stages']):
+                line = dict(summary['stages'][name])
+                line.update({'time': written_at, 'stage': name})
+                f.write(json.dumps(line, sort_keys=True) + '\n')
+            f.write(json.dumps({'time': written_at,
+                                'counters': summary['counters']},
+                               sort_keys=True) + '\n')
+
+    def write_prometheus(self,
+                         path: str,
+                         extra_counters: Optional[Dict[str, float]]=None) \
+            -> None:
+        """
+        Writes the Prometheus text format, replacing the file in one go
+        so that a node_exporter textfile collector never reads half of it.
+        """
+        summary = self.summary(extra_counters)
+        lines = [
+            '# HELP webwatcher_stage_seconds Time spent in each stage of '
+            'observing a page.',
+            '# TYPE webwatcher_stage_seconds summary',
+        ]
+        for name in _ordered(summary['stages']):
+            s = summary['stages'][name]
+            for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'),
+                                  ('1', 'max')):
+                lines.append(
+                    'webwatcher_stage_seconds{{stage="{}",quantile="{}"}} '
+                    '{!r}'.format(name, quantile, s[key]))
+            lines.append('webwatcher_stage_seconds_sum{{stage="{}"}} {!r}'
+                         .format(name, s['total']))
+            lines.append('webwatcher_stage_seconds_count{{stage="{}"}} {}'
+                         .format(name, s['count']))
+        for name, value in sorted(summary['counters'].items()):
+            metric = 'webwatcher_{}_total'.format(name)
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{} {!r}'.format(metric, value))
+
+        replacement = path + '.updating'
+        with open(replacement, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(replacement, path)
+
+
+METRICS_FORMATS = {
+    'jsonlines': RunMetrics.write_json_lines,
+    'prometheus': RunMetrics.write_prometheus,
+}
+
+
+def _ordered(stages) -> List[str]:
+    known = [s for s in STAGES if s in stages]
+    return known + sorted(s for s in stages if s not in STAGES)
+
+
+class ProfilerHook:
+    """
+    Runs cProfile during spans of the given stages (or all of them), on
+    whichever threads they happen, and writes the combined statistics
+    for pstats or snakeviz to read.
+    """
+
+    def __init__(self, stages: Optional[Sequence[str]]=None) -> None:
+        self._stages = set(stages) if stages else None
+        self._lock = threading.Lock()
+        self._profiles = []  # type: List[cProfile.Profile]
+        self._local = threading.local()
+
+    @contextmanager
+    def __call__(self, stage: str, url: Optional[str]) -> Iterator[None]:
+        if self._stages is not None and stage not in self._stages:
+            yield
+            return
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        # Spans nest (a page contains its fetch); only the outermost one
+        # switches the profiler on and off
+        if depth == 0:
+            profile.enable()
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                profile.disable()
+
+    def write(self, path: str) -> None:
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
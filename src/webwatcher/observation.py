@@ -1,10 +1,17 @@
 from datetime import datetime
+from typing import Dict, List, Optional
+
+from webwatcher.artefact import Artefact
 
 
 class Screenshot:
-    def __init__(self, content_hash, content_path=None):
+    def __init__(self, content_hash, content_path=None, size=None,
+                 disposable=False, perceptual_hash=None):
         self.content_hash = content_hash
         self.content_path = content_path
+        self.size = size
+        self.disposable = disposable
+        self.perceptual_hash = perceptual_hash
 
     def __hash__(self):
         return hash(self.content_hash)
@@ -25,19 +32,41 @@ class PageObservation:
                  observation_time: datetime,
                  availability: bool,
                  screenshot,
-                 raw_content_location: str) -> None:
+                 raw_content: Optional[Artefact],
+                 validators: Optional[Dict[str, str]]=None,
+                 fetch_failures: Optional[List[Dict[str, object]]]=None) \
+            -> None:
         self.url = url
         self.observation_time = observation_time
         self.availability = availability
         self.screenshot = screenshot
-        self.raw_content_location = raw_content_location
+        self.raw_content = raw_content
+        self.validators = validators or dict()
+        self.fetch_failures = fetch_failures or []
+
+    @property
+    def raw_content_location(self) -> Optional[str]:
+        return self.raw_content.path if self.raw_content else None
+
+    @property
+    def raw_content_hash(self) -> Optional[str]:
+        return self.raw_content.sha256 if self.raw_content else None
+
+    @property
+    def raw_content_size(self) -> Optional[int]:
+        return self.raw_content.size if self.raw_content else None
 
-    def artefacts(self):
+    def artefacts(self) -> Dict[str, Artefact]:
         artefacts = dict()
-        if self.screenshot is not None:
-            artefacts['screenshot'] = self.screenshot.content_path
-        if self.raw_content_location is not None:
-            artefacts['raw_content'] = self.raw_content_location
+        if self.screenshot is not None and \
+                self.screenshot.content_path is not None:
+            artefacts['screenshot'] = Artefact(
+                self.screenshot.content_path,
+                sha256=self.screenshot.content_hash,
+                size=self.screenshot.size,
+                disposable=self.screenshot.disposable)
+        if self.raw_content is not None:
+            artefacts['raw_content'] = self.raw_content
 
         return artefacts
 
@@ -50,4 +79,15 @@ class PageObservation:
         }
         if self.screenshot:
             meta['screenshot_content'] = self.screenshot.content_hash
+            if self.screenshot.perceptual_hash is not None:
+                meta['screenshot_phash'] = self.screenshot.perceptual_hash
+        if self.raw_content_hash is not None:
+            meta['raw_content_hash'] = self.raw_content_hash
+        if self.raw_content_size is not None:
+            meta['raw_content_size'] = self.raw_content_size
+        for validator in ('etag', 'last_modified'):
+            if validator in self.validators:
+                meta[validator] = self.validators[validator]
+        if self.fetch_failures:
+            meta['fetch_failures'] = self.fetch_failures
         return meta
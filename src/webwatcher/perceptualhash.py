@@ -0,0 +1,125 @@
+"""
+perceptualhash.py - small fingerprints of what a screenshot looks like.
+
+Screenshots that look alike have difference hashes (dHash) a few bits
+apart, however their bytes differ, so "has this page visibly changed?"
+becomes a popcount rather than a pixel-by-pixel comparison. Like
+imagediff, computing hashes needs numpy and Pillow.
+"""
+import threading
+from typing import Dict, Generic, List, Optional, Tuple, TypeVar
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:  # pragma: no cover - depends on the environment
+    np = None  # type: ignore
+    Image = None  # type: ignore
+
+
+# Pillow 9.1 moved its resampling filters into an enum
+_LANCZOS = getattr(Image, 'Resampling', Image).LANCZOS if Image else None
+
+
+def perceptual_hash_available() -> bool:
+    return np is not None and Image is not None
+
+
+def dhash(image_file, hash_size: int=16) -> Optional[str]:
+    """
+    Shrinks the image to (hash_size + 1) x hash_size greyscale pixels
+    and records, for each pixel, whether it is brighter than its right
+    hand neighbour. Returns the bits as hex, or None when the image can't
+    be read or numpy/Pillow aren't installed.
+    """
+    if not perceptual_hash_available():
+        return None
+    try:
+        with Image.open(image_file) as image:
+            small = image.convert('L').resize(
+                (hash_size + 1, hash_size), _LANCZOS)
+    except OSError:
+        return None
+
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return np.packbits(bits).tobytes().hex()
+
+
+def hamming_distance(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+T = TypeVar('T')
+
+
+class _Node(Generic[T]):
+    __slots__ = ('value', 'items', 'children')
+
+    def __init__(self, value: int, item: T) -> None:
+        self.value = value
+        self.items = [item]
+        self.children = dict()  # type: Dict[int, _Node[T]]
+
+
+class PerceptualHashIndex(Generic[T]):
+    """
+    A BK-tree per url: finding every earlier screenshot within a given
+    Hamming distance of a new one only visits the parts of the tree the
+    triangle inequality can't rule out.
+    """
+
+    def __init__(self) -> None:
+        self._roots = dict()  # type: Dict[str, _Node[T]]
+        self._lock = threading.Lock()
+
+    def add(self, url: str, phash: str, item: T) -> None:
+        value = int(phash, 16)
+        with self._lock:
+            node = self._roots.get(url)
+            if node is None:
+                self._roots[url] = _Node(value, item)
+                return
+            while True:
+                distance = bin(node.value ^ value).count('1')
+                if distance == 0:
+                    node.items.append(item)
+                    return
+                child = node.children.get(distance)
+                if child is None:
+                    node.children[distance] = _Node(value, item)
+                    return
+                node = child
+
+    def near(self, url: str, phash: str, max_distance: int) \
+            -> List[Tuple[int, T]]:
+        value = int(phash, 16)
+        found = []  # type: List[Tuple[int, T]]
+        with self._lock:
+            root = self._roots.get(url)
+            to_visit = [root] if root is not None else []
+            while to_visit:
+                node = to_visit.pop()
+                distance = bin(node.value ^ value).count('1')
+                if distance <= max_distance:
+                    found.extend((distance, item) for item in node.items)
+                for edge, child in node.children.items():
+                    if distance - max_distance <= edge \
+                            <= distance + max_distance:
+                        to_visit.append(child)
+        return sorted(found, key=lambda f: f[0])
+
+    @classmethod
+    def from_storage(cls, storage) -> 'PerceptualHashIndex':
+        """
+        An index of every stored observation that has a perceptual
+        hash, with observation times as the items.
+        """
+        index = cls()
+        for record in storage.find(type='observation') \
+                .having('url', 'timestamp', 'screenshot_phash') \
+                .stream():
+            index.add(record['url'],
+                      record['screenshot_phash'],
+                      record['timestamp'])
+        return index
@@ -0,0 +1,989 @@
+"""
+recordstore.py - backends for the metadata records kept by Storage.
+
+A record store only knows how to append records and hand them back;
+filtering and ordering semantics live in StorageQuery. Backends are free
+to use whatever indexes they have to narrow down the records they return
+but must never leave out a record that could match.
+
+Any number of processes may share a store: writes take a lock on
+record.lock in the storage directory.
+"""
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+import struct
+import threading
+from typing import ContextManager, Dict, Iterable, Iterator, List, \
+    Optional, Sequence, Tuple, Type
+from typing_extensions import Protocol
+
+from webwatcher.filelock import FileLock
+
+
+class RecordStore(Protocol):
+    def append(self, record: Dict[str, object]) -> None:
+        ...
+
+    def append_all(self,
+                   records: Sequence[Dict[str, object]],
+                   durable: bool=False) -> None:
+        """
+        Appends `records` in one go; if `durable`, they're on disk by
+        the time it returns.
+        """
+        ...
+
+    def scan(self,
+             filter_args: Dict[str, object],
+             required_fields: Sequence[str]) -> Iterator[Dict[str, object]]:
+        ...
+
+    def scan_raw(self,
+                 filter_args: Dict[str, object],
+                 required_fields: Sequence[str]) \
+            -> Iterator[Dict[str, object]]:
+        """
+        Like scan, but yields records as they were stored, leaving
+        values such as dates for the caller to decode if it needs them.
+        """
+        ...
+
+    def replace_all(self, records: Iterable[Dict[str, object]]) -> None:
+        ...
+
+    def latest(self, url: str) -> Optional[Dict[str, object]]:
+        """
+        The record for `url` with the greatest timestamp (the first
+        written, if there's a tie), or None if there isn't one.
+        """
+        ...
+
+    def exclusive(self) -> ContextManager:
+        """
+        Keeps every other writer, in this process or any other, from
+        changing the records until it's exited; for reading records and
+        then replacing them without losing any written in between.
+        """
+        ...
+
+
+class JsonLinesRecordStore:
+    """
+    The original append-only store: one JSON document per line
+    in record.dat. Every query reads the whole file, apart from looking
+    up the latest record for a url, which goes through a side index.
+
+    Each record is added with a single write to the end of the file, so
+    readers see either all of it or, for now, none of it; a record left
+    unfinished by a writer that died is skipped over.
+    """
+
+    filename = 'record.dat'
+
+    def __init__(self, storage_dir: Path) -> None:
+        self.path = storage_dir / self.filename
+        self._latest = _LatestIndex.load(storage_dir / 'record.latest')
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(str(storage_dir / 'record.lock'))
+
+    def exclusive(self):
+        return self._file_lock
+
+    def append(self, record):
+        self.append_all([record])
+
+    def append_all(self, records, durable=False):
+        lines = [(json.dumps(_json_safe(r)) + '\n').encode('utf-8')
+                 for r in records]
+        if not lines:
+            return
+        with self._file_lock, self._lock:
+            fd = os.open(str(self.path),
+                         os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                offset = os.lseek(fd, 0, os.SEEK_END)
+                if offset and _last_byte(fd) != b'\n':
+                    # Finish off the torn record, so that ours don't
+                    # become part of it
+                    lines[0] = b'\n' + lines[0]
+                _write_all(fd, b''.join(lines))
+                if durable:
+                    os.fsync(fd)
+                stat = os.fstat(fd)
+            finally:
+                os.close(fd)
+            file_id = (stat.st_dev, stat.st_ino)
+            if offset == 0:
+                self._latest = _LatestIndex(self._latest.path, file_id)
+            if self._latest.covers == offset and \
+                    self._latest.file_id == file_id:
+                # (never the case after finishing off a torn record,
+                # as the index stops short of those)
+                for record, line in zip(records, lines):
+                    self._latest.note(record, offset)
+                    offset += len(line)
+                self._latest.covers = offset
+                self._latest.save()
+
+    def scan(self, filter_args, required_fields):
+        for record in self.scan_raw(filter_args, required_fields):
+            yield _de_jsonsafe(record)
+
+    def scan_raw(self, filter_args, required_fields):
+        # A line can only match a string filter if it contains that
+        # string, encoded the same way; checking is far cheaper than
+        # parsing the line
+        must_contain = [json.dumps(v) for v in filter_args.values()
+                        if isinstance(v, str)]
+        try:
+            with open(self.path, mode='r', encoding='utf-8',
+                      errors='replace') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        # Still being written, or its writer died
+                        break
+                    if not all(s in line for s in must_contain):
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.warning('Skipping a torn record in %s',
+                                        self.path)
+                        continue
+                    yield record
+        except FileNotFoundError:
+            return
+
+    def replace_all(self, records):
+        replacement = Path(str(self.path) + '.compacting')
+        index = _LatestIndex(self._latest.path)
+        with self._file_lock:
+            with open(replacement, mode='wb') as f:
+                for record in records:
+                    index.note(record, f.tell())
+                    f.write((json.dumps(_json_safe(record)) + '\n')
+                            .encode('utf-8'))
+                index.covers = f.tell()
+                f.flush()
+                os.fsync(f.fileno())
+                stat = os.fstat(f.fileno())
+                index.file_id = (stat.st_dev, stat.st_ino)
+            with self._lock:
+                os.replace(str(replacement), str(self.path))
+                self._latest = index
+                self._latest.save()
+
+    def latest(self, url):
+        with self._lock:
+            self._catch_up()
+            found = self._read_latest(url)
+            if found is False:
+                # Someone else rewrote the file under us
+                self._latest = _LatestIndex(self._latest.path)
+                self._catch_up()
+                found = self._read_latest(url)
+        return found or None
+
+    def _read_latest(self, url):
+        offset = self._latest.offset_of(url)
+        if offset is None:
+            return None
+        with open(self.path, mode='rb') as f:
+            f.seek(offset)
+            line = f.readline()
+        try:
+            record = _de_jsonsafe(json.loads(line.decode('utf-8')))
+        except ValueError:
+            return False
+        return record if record.get('url') == url else False
+
+    def _catch_up(self):
+        """
+        Brings the index up to date with the end of record.dat,
+        starting again from the top if the file has been replaced or
+        has shrunk.
+        """
+        try:
+            f = open(str(self.path), mode='rb')
+        except FileNotFoundError:
+            self._latest = _LatestIndex(self._latest.path)
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            file_id = (stat.st_dev, stat.st_ino)
+            if file_id != self._latest.file_id or \
+                    stat.st_size < self._latest.covers:
+                self._latest = _LatestIndex(self._latest.path, file_id)
+            if stat.st_size == self._latest.covers:
+                return
+
+            offset = self._latest.covers
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = _de_jsonsafe(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    record = {}
+                self._latest.note(record, offset)
+                offset += len(line)
+        self._latest.covers = offset
+        self._latest.save()
+
+
+class _LatestIndex:
+    """
+    Where in record.dat to find the latest record for each url, along
+    with how many bytes of record.dat that takes into account, and
+    which file (device and inode) those bytes were in. Loaded from, and
+    saved to, a small JSON file next to the records.
+    """
+
+    def __init__(self,
+                 path: Path,
+                 file_id: Optional[Tuple[int, int]]=None) -> None:
+        self.path = path
+        self.file_id = file_id
+        self.covers = 0
+        self._entries = dict()  # type: Dict[str, Tuple[int, float]]
+
+    @classmethod
+    def load(cls, path: Path) -> '_LatestIndex':
+        index = cls(path)
+        try:
+            with open(path, mode='r', encoding='utf-8') as f:
+                saved = json.load(f)
+            entries = {url: (int(offset), float(timestamp))
+                       for url, (offset, timestamp)
+                       in saved['latest'].items()}
+            covers = int(saved['covers'])
+            device, inode = saved['file']
+            file_id = (int(device), int(inode))
+        except (OSError, ValueError, KeyError, TypeError):
+            return index
+        index._entries = entries
+        index.file_id = file_id
+        index.covers = covers
+        return index
+
+    def note(self, record: Dict[str, object], offset: int) -> None:
+        url = record.get('url')
+        timestamp = record.get('timestamp')
+        if not isinstance(url, str) or not isinstance(timestamp, datetime):
+            return
+        epoch = timestamp.timestamp()
+        current = self._entries.get(url)
+        if current is None or epoch > current[1]:
+            self._entries[url] = (offset, epoch)
+
+    def offset_of(self, url: str) -> Optional[int]:
+        entry = self._entries.get(url)
+        return entry[0] if entry is not None else None
+
+    def save(self) -> None:
+        # Named for the writer, as other processes may be saving theirs
+        replacement = Path('{}.{}-{}.updating'.format(
+            self.path, os.getpid(), threading.get_ident()))
+        try:
+            with open(replacement, mode='w', encoding='utf-8') as f:
+                json.dump({'file': self.file_id,
+                           'covers': self.covers,
+                           'latest': self._entries}, f)
+            os.replace(str(replacement), str(self.path))
+        except OSError:
+            # It's only an index; it gets caught up next time
+            pass
+
+
+_SCAN_BATCH_SIZE = 512
+
+
+class SqliteRecordStore:
+    """
+    Keeps records in an sqlite database, indexed by url and timestamp,
+    so that looking up the history of a single page doesn't need to
+    touch every record ever written.
+    """
+
+    _schema = '''
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT,
+            timestamp REAL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS records_by_url_and_timestamp
+            ON records (url, timestamp);
+        CREATE INDEX IF NOT EXISTS records_by_timestamp
+            ON records (timestamp);
+    '''
+
+    filename = 'record.sqlite'
+
+    def __init__(self, storage_dir: Path) -> None:
+        os.makedirs(str(storage_dir), exist_ok=True)
+        self.path = storage_dir / self.filename
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(str(storage_dir / 'record.lock'))
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._db:
+            self._db.executescript(self._schema)
+
+    def exclusive(self):
+        return self._file_lock
+
+    def append(self, record):
+        self.append_all([record])
+
+    def append_all(self, records, durable=False):
+        # sqlite syncs every transaction itself
+        with self._file_lock, self._lock, self._db:
+            self._db.executemany(
+                'INSERT INTO records (url, timestamp, data) VALUES (?, ?, ?)',
+                (_indexed_columns(r) for r in records))
+
+    def replace_all(self, records):
+        with self._file_lock, self._lock, self._db:
+            self._db.execute('DELETE FROM records')
+            self._db.executemany(
+                'INSERT INTO records (url, timestamp, data) VALUES (?, ?, ?)',
+                (_indexed_columns(r) for r in records))
+
+    def scan(self, filter_args, required_fields):
+        for record in self.scan_raw(filter_args, required_fields):
+            yield _de_jsonsafe(record)
+
+    def scan_raw(self, filter_args, required_fields):
+        clauses = []
+        params = []  # type: List[object]
+
+        url = filter_args.get('url')
+        if isinstance(url, str):
+            clauses.append('url = ?')
+            params.append(url)
+
+        if 'timestamp' in required_fields:
+            clauses.append('timestamp IS NOT NULL')
+
+        sql = 'SELECT data FROM records'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY id'
+
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(_SCAN_BATCH_SIZE)
+                if not rows:
+                    break
+                for (data,) in rows:
+                    yield json.loads(data)
+        finally:
+            cursor.close()
+
+    def latest(self, url):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM records WHERE url = ?'
+                ' AND timestamp IS NOT NULL'
+                ' ORDER BY timestamp DESC, id LIMIT 1', (url,)).fetchone()
+        return _de_jsonsafe(json.loads(row[0])) if row is not None else None
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM records LIMIT 1').fetchone()
+        return row is None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Each frame in record.bin is this header followed by `length` bytes:
+# kind, length, timestamp (microseconds since the epoch), the timestamp's
+# UTC offset (seconds), and the id of the url
+_FRAME = struct.Struct('<cIqiI')
+# Spells out the url with the frame's id, for the frames that follow
+_URL_FRAME = b'U'
+# A record, whose other fields are JSON
+_RECORD_FRAME = b'R'
+
+_NO_TIMESTAMP = -2 ** 63
+_NO_URL = 0xFFFFFFFF
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+class BinaryRecordStore:
+    """
+    Keeps records in record.bin, as frames with a fixed-size header and
+    a JSON body. A record's url and timestamp live in its header, the
+    url as a number standing for a url spelled out once in the file, so
+    reading records back doesn't mean parsing dates, and records for
+    other urls are skipped without parsing them at all. The latest
+    record for each url is found from the headers alone.
+    """
+
+    filename = 'record.bin'
+
+    def __init__(self, storage_dir: Path) -> None:
+        self.path = storage_dir / self.filename
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(str(storage_dir / 'record.lock'))
+        self._reset()
+
+    def _reset(self):
+        # How much of which file the rest has been read from
+        self._covers = 0
+        self._file_id = None  # type: Optional[Tuple[int, int]]
+        self._url_ids = dict()  # type: Dict[str, int]
+        # By url id: where its latest record is, and that record's time
+        self._latest = dict()  # type: Dict[int, Tuple[int, int]]
+
+    def exclusive(self):
+        return self._file_lock
+
+    def append(self, record):
+        self.append_all([record])
+
+    def append_all(self, records, durable=False):
+        if not records:
+            return
+        with self._file_lock, self._lock:
+            try:
+                with open(str(self.path), 'rb') as f:
+                    self._catch_up(f)
+            except FileNotFoundError:
+                self._reset()
+            url_ids = dict(self._url_ids)
+            data, latest = _encode(records, url_ids, self._covers)
+            fd = os.open(str(self.path),
+                         os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size > self._covers:
+                    # All that's beyond is a frame whose writer died
+                    # part way through, as we hold the lock
+                    os.ftruncate(fd, self._covers)
+                _write_all(fd, data)
+                if durable:
+                    os.fsync(fd)
+                stat = os.fstat(fd)
+            except BaseException:
+                self._reset()
+                raise
+            finally:
+                os.close(fd)
+            self._file_id = (stat.st_dev, stat.st_ino)
+            self._covers += len(data)
+            self._url_ids = url_ids
+            for url_id, entry in latest.items():
+                self._note(url_id, *entry)
+
+    def scan(self, filter_args, required_fields):
+        return self._scan(filter_args, required_fields, decode_dates=True)
+
+    def scan_raw(self, filter_args, required_fields):
+        return self._scan(filter_args, required_fields, decode_dates=False)
+
+    def _scan(self, filter_args, required_fields, decode_dates):
+        wanted_url = filter_args.get('url')
+        if not isinstance(wanted_url, str):
+            wanted_url = None
+        need_timestamp = 'timestamp' in required_fields
+        urls = dict()  # type: Dict[int, str]
+
+        def wanted(kind, micros, url_id):
+            if kind != _RECORD_FRAME:
+                return True
+            if wanted_url is not None and urls.get(url_id) != wanted_url:
+                return False
+            return micros != _NO_TIMESTAMP or not need_timestamp
+
+        try:
+            f = open(str(self.path), 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            for _, _, kind, micros, utc_offset, url_id, body in \
+                    _frames(f, 0, wanted):
+                if kind == _URL_FRAME:
+                    urls[url_id] = body.decode('utf-8')
+                elif body is not None:
+                    record = _decode(body, micros, utc_offset,
+                                     urls.get(url_id))
+                    # Most records have no dates but their timestamp
+                    if decode_dates and b'"__date"' in body:
+                        record = _de_jsonsafe(record)
+                    yield record
+
+    def replace_all(self, records):
+        replacement = Path(str(self.path) + '.compacting')
+        url_ids = dict()  # type: Dict[str, int]
+        with self._file_lock:
+            with open(str(replacement), mode='wb') as f:
+                for chunk in _chunks(records, _SCAN_BATCH_SIZE):
+                    data, _ = _encode(chunk, url_ids, f.tell())
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._lock:
+                os.replace(str(replacement), str(self.path))
+                self._reset()
+
+    def latest(self, url):
+        with self._lock:
+            try:
+                f = open(str(self.path), 'rb')
+            except FileNotFoundError:
+                self._reset()
+                return None
+            with f:
+                self._catch_up(f)
+                entry = self._latest.get(self._url_ids.get(url, _NO_URL))
+                if entry is None:
+                    return None
+                frame = _frame_at(f, entry[0])
+        if frame is None or frame[0] != _RECORD_FRAME:
+            return None
+        kind, micros, utc_offset, url_id, body = frame
+        return _de_jsonsafe(_decode(body, micros, utc_offset, url))
+
+    def _catch_up(self, f):
+        """
+        Reads the headers of frames added to `f` since last time, or
+        all of them if it's been replaced since.
+        """
+        stat = os.fstat(f.fileno())
+        if (stat.st_dev, stat.st_ino) != self._file_id or \
+                stat.st_size < self._covers:
+            self._reset()
+            self._file_id = (stat.st_dev, stat.st_ino)
+
+        def wanted(kind, micros, url_id):
+            return kind == _URL_FRAME
+
+        for offset, end, kind, micros, _, url_id, body in \
+                _frames(f, self._covers, wanted):
+            if kind == _URL_FRAME:
+                self._url_ids[body.decode('utf-8')] = url_id
+            elif url_id != _NO_URL and micros != _NO_TIMESTAMP:
+                self._note(url_id, offset, micros)
+            self._covers = end
+
+    def _note(self, url_id, offset, micros):
+        current = self._latest.get(url_id)
+        if current is None or micros > current[1]:
+            self._latest[url_id] = (offset, micros)
+
+
+_READ_SIZE = 1 << 20
+
+
+def _frames(f, offset, wanted):
+    """
+    The complete frames in `f` from `offset` on, as (offset, end, kind,
+    micros, utc_offset, url id, body); the body is None unless
+    wanted(kind, micros, url_id).
+    """
+    unpack = _FRAME.unpack_from
+    header_size = _FRAME.size
+    f.seek(offset)
+    buffer = b''
+    position = 0
+    while True:
+        # A frame left unfinished at the end is still being written,
+        # or its writer died
+        chunk = f.read(_READ_SIZE)
+        if not chunk:
+            return
+        buffer = buffer[position:] + chunk
+        position = 0
+        while position + header_size <= len(buffer):
+            kind, length, micros, utc_offset, url_id = \
+                unpack(buffer, position)
+            end = position + header_size + length
+            if end > len(buffer):
+                break
+            body = buffer[position + header_size:end] \
+                if wanted(kind, micros, url_id) else None
+            frame_end = offset + end - position
+            yield offset, frame_end, kind, micros, utc_offset, url_id, body
+            offset = frame_end
+            position = end
+
+
+def _frame_at(f, offset):
+    f.seek(offset)
+    header = f.read(_FRAME.size)
+    if len(header) < _FRAME.size:
+        return None
+    kind, length, micros, utc_offset, url_id = _FRAME.unpack(header)
+    body = f.read(length)
+    if len(body) < length:
+        return None
+    return kind, micros, utc_offset, url_id, body
+
+
+def _encode(records, url_ids, offset):
+    """
+    The frames for `records`, to go at `offset` in a file whose urls
+    have the ids in `url_ids` (which gains any new ones), along with the
+    offset and time of the latest record for each url among them.
+    """
+    frames = []
+    latest = dict()  # type: Dict[int, Tuple[int, int]]
+    for record in records:
+        body = dict(record)
+        url_id = _NO_URL
+        url = record.get('url')
+        if isinstance(url, str):
+            del body['url']
+            url_id = url_ids.get(url, _NO_URL)
+            if url_id == _NO_URL:
+                url_id = url_ids[url] = len(url_ids)
+                encoded = url.encode('utf-8')
+                frames.append(_FRAME.pack(_URL_FRAME, len(encoded), 0, 0,
+                                          url_id) + encoded)
+                offset += len(frames[-1])
+
+        micros, utc_offset = _NO_TIMESTAMP, 0
+        timestamp = record.get('timestamp')
+        if isinstance(timestamp, datetime) and \
+                timestamp.utcoffset() is not None:
+            del body['timestamp']
+            micros = (timestamp - _EPOCH) // _MICROSECOND
+            utc_offset = int(timestamp.utcoffset().total_seconds())
+
+        encoded = json.dumps(_json_safe(body),
+                             separators=(',', ':')).encode('utf-8')
+        frames.append(_FRAME.pack(_RECORD_FRAME, len(encoded), micros,
+                                  utc_offset, url_id) + encoded)
+        if url_id != _NO_URL and micros != _NO_TIMESTAMP:
+            current = latest.get(url_id)
+            if current is None or micros > current[1]:
+                latest[url_id] = (offset, micros)
+        offset += len(frames[-1])
+    return b''.join(frames), latest
+
+
+_zones = {0: timezone.utc}  # type: Dict[int, timezone]
+
+_decoder = json.JSONDecoder()
+
+
+def _decode(body, micros, utc_offset, url):
+    record = _decoder.raw_decode(body.decode('utf-8'))[0]
+    if url is not None:
+        record['url'] = url
+    if micros != _NO_TIMESTAMP:
+        timestamp = _EPOCH + timedelta(microseconds=micros)
+        if utc_offset:
+            zone = _zones.get(utc_offset)
+            if zone is None:
+                zone = _zones[utc_offset] = \
+                    timezone(timedelta(seconds=utc_offset))
+            timestamp = timestamp.astimezone(zone)
+        record['timestamp'] = timestamp
+    return record
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _indexed_columns(record):
+    url = record.get('url')
+    timestamp = record.get('timestamp')
+    return (
+        url if isinstance(url, str) else None,
+        timestamp.timestamp() if isinstance(timestamp, datetime) else None,
+        json.dumps(_json_safe(record)))
+
+
+def migrate_record_file(storage_dir: Path) -> bool:
+    """
+    One-shot import of an existing record.dat into the sqlite store.
+    The old file is kept around, renamed, once its contents are safely
+    committed. Returns whether there was anything to migrate.
+    """
+    legacy = JsonLinesRecordStore(storage_dir)
+    if not legacy.path.is_file():
+        return False
+
+    target = SqliteRecordStore(storage_dir)
+    try:
+        # Other webwatchers starting up may be migrating it too
+        with target.exclusive():
+            if not legacy.path.is_file() or not target.is_empty():
+                return False
+            target.append_all(legacy.scan({}, ()))
+            os.replace(str(legacy.path), str(legacy.path) + '.migrated')
+    finally:
+        target.close()
+    return True
+
+
+class _RecordFile(RecordStore, Protocol):
+    """
+    A backend keeping its records in one file, `filename`, in the
+    storage directory it's given.
+    """
+    filename = ''  # type: str
+
+    def __init__(self, storage_dir: Path) -> None:
+        ...
+
+    @property
+    def path(self) -> Path:
+        ...
+
+
+_RECORD_STORES = {
+    'jsonlines': JsonLinesRecordStore,
+    'sqlite': SqliteRecordStore,
+    'binary': BinaryRecordStore,
+}  # type: Dict[str, Type[_RecordFile]]
+
+
+# Where the segments of a storage directory live, one directory each
+SEGMENTS_DIR = 'segments'
+
+
+class SegmentedRecordStore:
+    """
+    The records in a storage directory together with those in each of
+    its segments, read as one store. New records go to the segment
+    named when it's opened, or to the directory's own records if none
+    is. Segments that appear while it's open are picked up as they do.
+    """
+
+    def __init__(self,
+                 backend: str,
+                 storage_dir: Path,
+                 segment: Optional[str]=None) -> None:
+        self._backend = backend
+        self._segments_dir = storage_dir / SEGMENTS_DIR
+        self._lock = threading.Lock()
+        self._main = open_record_store(backend, storage_dir)
+        self._segments = dict()  # type: Dict[str, RecordStore]
+        if segment is None:
+            self._writer = self._main
+        else:
+            os.makedirs(str(self._segments_dir / segment), exist_ok=True)
+            self._writer = self._segment(segment)
+
+    def append(self, record):
+        self._writer.append(record)
+
+    def append_all(self, records, durable=False):
+        self._writer.append_all(records, durable=durable)
+
+    def scan(self, filter_args, required_fields):
+        for store in self._stores():
+            yield from store.scan(filter_args, required_fields)
+
+    def scan_raw(self, filter_args, required_fields):
+        for store in self._stores():
+            yield from store.scan_raw(filter_args, required_fields)
+
+    def replace_all(self, records):
+        """
+        Replaces every record, in every segment, with `records`; these
+        all end up in the storage directory's own records.
+        """
+        self._main.replace_all(records)
+        for store in self._stores()[1:]:
+            store.replace_all([])
+
+    def latest(self, url):
+        found = None
+        for store in self._stores():
+            record = store.latest(url)
+            if record is not None and \
+                    (found is None or record['timestamp'] > found['timestamp']):
+                found = record
+        return found
+
+    @contextmanager
+    def exclusive(self):
+        with ExitStack() as locks:
+            for store in self._stores():
+                locks.enter_context(store.exclusive())
+            yield
+
+    def merge_segments(self) -> int:
+        """
+        Moves the records of every segment into the storage directory's
+        own, then removes the segments. Records already there are left
+        out, so running it again after being interrupted is safe.
+        Returns how many records were moved.
+        """
+        with self.exclusive():
+            return self._merge_segments()
+
+    def _merge_segments(self) -> int:
+        names = self._segment_names()
+        if not names:
+            return 0
+        present = {_identity(r) for r in self._main.scan_raw({}, ())}
+        missing = []
+        for name in names:
+            for record in self._segment(name).scan_raw({}, ()):
+                identity = _identity(record)
+                if identity not in present:
+                    present.add(identity)
+                    missing.append(_de_jsonsafe(record))
+        # On disk before any segment goes, so a crash can't lose them
+        self._main.append_all(missing, durable=True)
+
+        for name in names:
+            with self._lock:
+                store = self._segments.pop(name)
+            close = getattr(store, 'close', None)
+            if close is not None:
+                close()
+            shutil.rmtree(str(self._segments_dir / name))
+        return len(missing)
+
+    def _segment_names(self) -> List[str]:
+        try:
+            names = sorted(os.listdir(str(self._segments_dir)))
+        except FileNotFoundError:
+            return []
+        return [n for n in names if (self._segments_dir / n).is_dir()]
+
+    def _segment(self, name: str) -> RecordStore:
+        with self._lock:
+            store = self._segments.get(name)
+            if store is None:
+                store = self._segments[name] = open_record_store(
+                    self._backend, self._segments_dir / name)
+            return store
+
+    def _stores(self) -> List[RecordStore]:
+        return [self._main] + [self._segment(name)
+                               for name in self._segment_names()]
+
+
+def _last_byte(fd: int) -> bytes:
+    os.lseek(fd, -1, os.SEEK_END)
+    return os.read(fd, 1)
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _identity(record: Dict[str, object]) -> str:
+    return json.dumps(_json_safe(record), sort_keys=True)
+
+
+def open_record_store(backend: str, storage_dir: Path) -> RecordStore:
+    try:
+        store_type = _RECORD_STORES[backend]
+    except KeyError:
+        raise ValueError(
+            'Unknown storage backend: {backend} (expected one of {known})'
+            .format(backend=backend, known=', '.join(sorted(_RECORD_STORES))))
+
+    if store_type is SqliteRecordStore:
+        migrate_record_file(storage_dir)
+
+    return store_type(storage_dir)
+
+
+def convert_records(storage_dir: Path, source: str, target: str) -> int:
+    """
+    Rewrites the records kept by the `source` backend, in `storage_dir`
+    and each of its segments, into the `target` backend. The old files
+    are kept around, renamed, once the new ones are complete. Returns
+    how many records were converted.
+    """
+    for backend in (source, target):
+        if backend not in _RECORD_STORES:
+            raise ValueError(
+                'Unknown storage backend: {backend} (expected one of '
+                '{known})'.format(backend=backend,
+                                  known=', '.join(sorted(_RECORD_STORES))))
+    if source == target:
+        return 0
+    source_type, target_type = _RECORD_STORES[source], _RECORD_STORES[target]
+
+    segments_dir = storage_dir / SEGMENTS_DIR
+    directories = [storage_dir]
+    if segments_dir.is_dir():
+        directories += sorted(d for d in segments_dir.iterdir() if d.is_dir())
+
+    converted = 0
+    for directory in directories:
+        if not (directory / source_type.filename).is_file():
+            continue
+        old = source_type(directory)
+        new = target_type(directory)
+        try:
+            # Both lock the same file, which keeps out writers of either
+            with new.exclusive():
+                existing = new.scan_raw({}, ())
+                try:
+                    if next(existing, None) is not None:
+                        raise ValueError('{} already has {} records'
+                                         .format(directory, target))
+                finally:
+                    # Lets go of whatever the scan had open
+                    close = getattr(existing, 'close', None)
+                    if close is not None:
+                        close()
+                records = list(old.scan({}, ()))
+                new.replace_all(records)
+                converted += len(records)
+        finally:
+            for store in (old, new):
+                close = getattr(store, 'close', None)
+                if close is not None:
+                    close()
+        os.replace(str(old.path), str(old.path) + '.converted')
+    return converted
+
+
+_json_dateformat = '%Y-%m-%d %H:%M:%S.%f%z'
+
+
+def _de_jsonsafe(jsonsafe_data) -> Dict[str, object]:
+    return {k: _de_jsonsafe_value(v) for k, v in jsonsafe_data.items()}
+
+
+def _de_jsonsafe_value(v):
+    if isinstance(v, dict) and '__date' in v:
+        return datetime.strptime(v['__date'], _json_dateformat)
+    return v
+
+
+def _json_safe(v):
+    if v is None or type(v) in (str, int, float, bool):
+        return v
+    if isinstance(v, dict):
+        return {k: _json_safe(nested_val) for k, nested_val in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_json_safe(nested_val) for nested_val in v]
+
+    if isinstance(v, datetime):
+        return {'__date': v.strftime(_json_dateformat)}
+
+    raise RuntimeError('Don\'t know how to jsonize: {v}'.format(v=type(v)))
@@ -0,0 +1,68 @@
+"""
+retention.py - deciding which observations are worth keeping.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+
+# The parts of an observation that, when they differ from the one before,
+# mean something happened to the page
+_OBSERVED_STATE = ('was_available', 'screenshot_content', 'raw_content_hash')
+
+
+class RetentionPolicy:
+    """
+    For each url, keeps the most recent `keep_last` observations, every
+    observation from the last `keep_days` days, and every observation at
+    which the page was seen to change. Records that aren't observations
+    of a page are always kept.
+    """
+
+    def __init__(self,
+                 keep_last: Optional[int]=None,
+                 keep_days: Optional[float]=None) -> None:
+        self.keep_last = keep_last
+        self.keep_days = keep_days
+
+    def select(self,
+               records: List[Dict],
+               now: Optional[datetime]=None) -> List[Dict]:
+        now = now or datetime.now(timezone.utc)
+        cutoff = now - timedelta(days=self.keep_days) \
+            if self.keep_days is not None else None
+
+        by_url = defaultdict(list)
+        keep = set()
+        for i, record in enumerate(records):
+            if isinstance(record.get('url'), str) and \
+                    isinstance(record.get('timestamp'), datetime):
+                by_url[record['url']].append(i)
+            else:
+                keep.add(i)
+
+        for history in by_url.values():
+            history.sort(key=lambda i: records[i]['timestamp'])
+
+            previous_state = None
+            for i in history:
+                state = _observed_state(records[i])
+                if state != previous_state:
+                    keep.add(i)
+                previous_state = state
+
+            if self.keep_last:
+                keep.update(history[-self.keep_last:])
+            if cutoff is not None:
+                keep.update(i for i in history
+                            if records[i]['timestamp'] >= cutoff)
+
+        return [r for i, r in enumerate(records) if i in keep]
+
+
+def _observed_state(record):
+    state = tuple(record.get(k) for k in _OBSERVED_STATE)
+    if record.get('raw_content_hash') is None:
+        # Older records only know their content by where it was stored
+        state += (record.get('_storage', {}).get('raw_content'),)
+    return state
@@ -0,0 +1,77 @@
+"""
+scheduler.py - deciding when each watched page is next due a look.
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from webwatcher.watchconfiguration import PageUnderObsevation
+
+
+class Scheduler:
+    """
+    A priority queue of pages, ordered by when each is next due. Pages are
+    checked every `interval` seconds (their own, or `default_interval`),
+    give or take `jitter` of that interval, so that pages added together
+    drift apart rather than all being fetched at once forever.
+
+    Pages taken off the queue by `due()` stay off it until `reschedule()`
+    puts them back, so a slow check is never started twice.
+    """
+
+    def __init__(self,
+                 pages: List[PageUnderObsevation],
+                 default_interval: float,
+                 jitter: float=0.1,
+                 clock: Callable[[], float]=time.monotonic,
+                 rand: Callable[[], float]=random.random) -> None:
+        self._default_interval = default_interval
+        self._jitter = jitter
+        self._clock = clock
+        self._rand = rand
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._queue = []  # type: List[Tuple[float, int, PageUnderObsevation]]
+
+        now = clock()
+        for page in pages:
+            # Spread the first checks over the jitter window too
+            self._push(now + self._interval_of(page) * jitter * rand(), page)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._queue)
+
+    def _interval_of(self, page: PageUnderObsevation) -> float:
+        return page.interval if page.interval is not None \
+            else self._default_interval
+
+    def _push(self, when: float, page: PageUnderObsevation) -> None:
+        heapq.heappush(self._queue, (when, next(self._order), page))
+
+    def due(self) -> List[PageUnderObsevation]:
+        now = self._clock()
+        ready = []
+        with self._lock:
+            while self._queue and self._queue[0][0] <= now:
+                ready.append(heapq.heappop(self._queue)[2])
+        return ready
+
+    def reschedule(self, page: PageUnderObsevation) -> None:
+        interval = self._interval_of(page)
+        spread = interval * self._jitter * (2 * self._rand() - 1)
+        with self._lock:
+            self._push(self._clock() + interval + spread, page)
+
+    def seconds_until_next(self) -> Optional[float]:
+        """
+        How long until a page is due, or None if every page is
+        currently out being checked.
+        """
+        with self._lock:
+            if not self._queue:
+                return None
+            return max(0.0, self._queue[0][0] - self._clock())
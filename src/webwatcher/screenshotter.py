@@ -1,4 +1,6 @@
 import functools
+from hashlib import sha256
+import io
 import logging
 import os
 import re
@@ -8,10 +10,13 @@ import tarfile
 from typing import Optional
 import requests
 
+from webwatcher.browserpool import BrowserPool, PageLoadTimeoutException
 from webwatcher.environment import cache_folder
 from webwatcher.filehash import file_hash
+from webwatcher.hostlimiter import HostLimiter
 from webwatcher.http_session import http_session
 from webwatcher.observation import Screenshot
+from webwatcher.perceptualhash import dhash
 
 
 _FIREFOX_BETA_DOWNLOAD_URL = \
@@ -40,10 +45,26 @@ def _call_quietly(args, timeout) -> None:
 
 
 class Screenshotter:
-    def __init__(self, temp_storage):
+    def __init__(self,
+                 temp_storage,
+                 pool=None,
+                 timeout: float=2,
+                 perceptual_hashes: bool=False,
+                 limiter: Optional[HostLimiter]=None) -> None:
         self._temp = temp_storage
+        self._pool = pool
+        self._timeout = timeout
+        self._perceptual_hashes = perceptual_hashes
+        self._limiter = limiter if limiter is not None else HostLimiter()
 
     def take_screenshot_of(self, url: str) -> Optional[Screenshot]:
+        with self._limiter.slot(url):
+            return self._take_screenshot_of(url)
+
+    def _take_screenshot_of(self, url: str) -> Optional[Screenshot]:
+        if self._pool is not None:
+            return self._take_screenshot_with_pool(url)
+
         output = self._temp.new_file(leave_open=False, suffix='.png')
 
         ff_path = _path_to_modern_firefox()
@@ -58,8 +79,9 @@ class Screenshotter:
                     '--profile',
                     profile_dir
                 ]
-                _call_quietly(args, timeout=2)
+                _call_quietly(args, timeout=self._timeout)
             except subprocess.TimeoutExpired:
+                logging.warning('Timed out taking a screenshot of %s', url)
                 return None
             except:
                 logging.warn('Error while calling to firefox at: {}', ff_path)
@@ -67,7 +89,33 @@ class Screenshotter:
 
         return Screenshot(
             content_hash=file_hash(output.name).hexdigest(),
-            content_path=output.name)
+            content_path=output.name,
+            size=os.path.getsize(output.name),
+            disposable=True,
+            perceptual_hash=dhash(output.name)
+            if self._perceptual_hashes else None)
+
+    def _take_screenshot_with_pool(self, url: str) -> Optional[Screenshot]:
+        try:
+            png = self._pool.screenshot(url)
+        except PageLoadTimeoutException:
+            logging.warning('Timed out taking a screenshot of %s', url)
+            return None
+
+        with self._temp.new_file(delete=False, suffix='.png') as output:
+            output.write(png)
+
+        return Screenshot(
+            content_hash=sha256(png).hexdigest(),
+            content_path=output.name,
+            size=len(png),
+            disposable=True,
+            perceptual_hash=dhash(io.BytesIO(png))
+            if self._perceptual_hashes else None)
+
+
+def browser_pool(temp_storage, **kwargs) -> BrowserPool:
+    return BrowserPool(temp_storage, _path_to_modern_firefox(), **kwargs)
 
 
 def _download_firefox_package():
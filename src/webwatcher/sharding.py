@@ -0,0 +1,39 @@
+"""
+sharding.py - splitting the watch list between several webwatchers.
+
+Shard `i/N` watches the pages whose urls hash to it, so that N processes
+(on one machine or several) between them watch every page exactly once.
+Each keeps its records in its own segment of the storage, which is read
+together with the rest and can be merged back in once they're done.
+"""
+import zlib
+
+
+class Shard:
+    def __init__(self, index: int, count: int) -> None:
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError(
+                'Shard {}/{} doesn\'t exist; shards are numbered from 1 '
+                'to the number of shards'.format(index, count))
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, arg: str) -> 'Shard':
+        try:
+            index, count = arg.split('/')
+            return cls(int(index), int(count))
+        except ValueError as e:
+            raise ValueError(
+                'Expected a shard like 2/4, not {!r} ({})'.format(arg, e))
+
+    def contains(self, url: str) -> bool:
+        # crc32 rather than hash(), which differs from process to process
+        return zlib.crc32(url.encode('utf-8')) % self.count == self.index - 1
+
+    @property
+    def segment(self) -> str:
+        return 'shard-{}-of-{}'.format(self.index, self.count)
+
+    def __str__(self):
+        return '{}/{}'.format(self.index, self.count)
@@ -1,20 +1,29 @@
 
-from typing import Collection, Dict
+from typing import IO, Callable, Collection, Dict, Iterator, List, Mapping, \
+    Optional, Set, Tuple, Union
 from typing_extensions import Protocol
 
-import base64
-from datetime import datetime, date
-import json
-import os
-import shutil
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import logging
+from pathlib import Path
+import threading
+import time
 from urllib.parse import urlparse, unquote
 
+from webwatcher.artefact import Artefact
+from webwatcher.artefactstore import ArtefactStore, ArtefactStoreStats, \
+    EncodedDelta
+from webwatcher.compression import open_artefact
 from webwatcher.environment import data_folder
-from webwatcher.filehash import file_hash
+from webwatcher.recordstore import SegmentedRecordStore, _de_jsonsafe_value, \
+    _identity, _json_safe
 
 
 class Persistable(Protocol):
-    def artefacts(self) -> Dict[str, str]:
+    def artefacts(self) -> Mapping[str, Union[str, Artefact]]:
         ...
 
     def get_meta_info(self) -> Dict[str, object]:
@@ -26,53 +35,311 @@ class StorageFailureException(Exception):
         self.msg = msg
 
 
+DURABILITY = ('none', 'fsync')
+
+
 class Storage:
-    def __init__(self, storage_root=None):
+    """
+    Records of observations, and the artefacts they refer to. Given a
+    `segment`, new records are kept apart in that segment (see
+    sharding.py); queries always read every segment.
+
+    Persisted observations are committed one at a time or, within
+    batch(), several at once. With `durability='fsync'` a commit is on
+    disk when it finishes: new artefacts first, then the records that
+    refer to them, with a single fsync of the record file. 'none' leaves
+    writing them out to the operating system.
+    """
+
+    def __init__(self, storage_root=None, backend='jsonlines',
+                 compression='none', max_delta_chain=0, segment=None,
+                 durability='none'):
+        if durability not in DURABILITY:
+            raise ValueError(
+                'Unknown durability: {durability} (expected one of {known})'
+                .format(durability=durability, known=', '.join(DURABILITY)))
         if storage_root is None:
             self._storage_dir = data_folder('storage')
         else:
             self._storage_dir = storage_root
-        
-        self._meta_info_path = self._storage_dir / 'record.dat'
-        self._artefact_storage_dir = self._storage_dir / 'artefacts'
+
+        self._records = SegmentedRecordStore(backend, self._storage_dir,
+                                             segment=segment)
+        self._artefacts = ArtefactStore(self._storage_dir / 'artefacts',
+                                        compression=compression,
+                                        max_delta_chain=max_delta_chain)
+        self._delta_encoded = max_delta_chain > 0
+        self._fsync = durability == 'fsync'
+        self._write_lock = threading.Lock()
+        # Held while committing, so that commits land in order
+        self._commit_lock = threading.Lock()
+        # Records persisted but not yet committed, and new blobs that
+        # need syncing before they are
+        self._pending = []  # type: List[Dict[str, object]]
+        self._pending_blobs = []  # type: List[Path]
+        self._committer = None  # type: Optional[_GroupCommitter]
+        # Count commits as they start and once their records are no
+        # longer pending, so that a query can tell whether records it
+        # took as pending may have been written already
+        self._commits_started = 0
+        self._commits_finished = 0
+
+    @property
+    def artefact_stats(self) -> ArtefactStoreStats:
+        return self._artefacts.stats
 
     def persist(self, persistable: Persistable):
+        meta_info = dict(persistable.get_meta_info())
+        # Working out deltas reads whole pages, so is done before taking
+        # the lock
+        artefacts = self._prepare(meta_info, persistable)
+        with self._write_lock:
+            self._persist(meta_info, artefacts)
+            committer = self._committer
+            commit_now = committer is None or \
+                len(self._pending) >= committer.max_records
+        if commit_now:
+            self.commit()
+        elif committer is not None:
+            committer.notify()
+
+    def commit(self) -> None:
+        """
+        Writes out every record persisted so far. Those that can't be
+        written stay pending, and are tried again by the next commit.
+        """
+        with self._commit_lock:
+            with self._write_lock:
+                records = list(self._pending)
+                blobs = list(self._pending_blobs)
+                if records:
+                    self._commits_started += 1
+            if not records:
+                return
+            try:
+                if self._fsync:
+                    self._artefacts.sync(blobs)
+                self._records.append_all(records, durable=self._fsync)
+                # Only now, so that latest() sees them here or there
+                with self._write_lock:
+                    del self._pending[:len(records)]
+                    del self._pending_blobs[:len(blobs)]
+            finally:
+                with self._write_lock:
+                    self._commits_finished += 1
+
+    @contextmanager
+    def batch(self, max_records: int=64, max_delay: float=1.0):
+        """
+        Commits observations persisted within it together: once
+        `max_records` are waiting, `max_delay` seconds after the first
+        of them, and on leaving it. Until then they're only lost if the
+        process is, but they can be found like any others.
+        """
+        committer = _GroupCommitter(self, max_records, max_delay)
+        with self._write_lock:
+            if self._committer is not None:
+                raise RuntimeError('Already batching')
+            self._committer = committer
+        committer.start()
         try:
-            os.makedirs(self._artefact_storage_dir)
-        except FileExistsError:
-            pass
-
-        persisted_locations = dict()
+            yield self
+        finally:
+            committer.stop()
+            with self._write_lock:
+                self._committer = None
+            self.commit()
+
+    def _prepare(self, meta_info, persistable: Persistable) \
+            -> List[Tuple[str, Artefact, Optional[EncodedDelta]]]:
+        prepared = []
         for name, location in persistable.artefacts().items():
+            artefact = _as_artefact(location)
             try:
-                storage_filename = _storage_filename_for(location)
-                storage_location = \
-                    self._artefact_storage_dir / storage_filename
+                delta = self._artefacts.delta_for(
+                    artefact, self._delta_base(meta_info, name))
+            except:
+                raise StorageFailureException(
+                        msg='While persisting {}'.format(name))
+            prepared.append((name, artefact, delta))
+        return prepared
 
-                shutil.copy(location, storage_location)
+    def _persist(self, meta_info, artefacts):
+        persisted_locations = dict()
+        for name, artefact, delta in artefacts:
+            try:
+                storage_location = self._artefacts.put(
+                    artefact,
+                    delta=delta,
+                    written=self._pending_blobs if self._fsync else None)
                 persisted_locations[name] = storage_location.as_uri()
             except:
                 raise StorageFailureException(
                         msg='While persisting {}'.format(name))
 
-        meta_info = _json_safe(persistable.get_meta_info())
         if persisted_locations:
             meta_info['_storage'] = persisted_locations
 
-        with open(self._meta_info_path, mode='a', encoding='utf-8') as f:
-            f.write(json.dumps(meta_info))
-            f.write('\n')
+        # Refuse what can't be stored now, rather than when committing
+        _json_safe(meta_info)
+        self._pending.append(meta_info)
+
+    def _delta_base(self, meta_info, name) -> Optional[Path]:
+        """
+        Page content is stored as the changes from the last version
+        stored for the same url.
+        """
+        if not self._delta_encoded or name != 'raw_content':
+            return None
+        url = meta_info.get('url')
+        if not isinstance(url, str):
+            return None
+        previous = self.latest(url)
+        if previous is None:
+            return None
+        location = previous.fetch_local('raw_content')
+        return Path(location) if location is not None else None
 
     def find(self, **kwargs):
         return StorageQuery(self, kwargs)
 
+    def latest(self, url: str) -> Optional['FromPersistence']:
+        """
+        The most recent timestamped record for `url`; the same as the
+        first result of find(url=url).having('timestamp')
+        .order_by('timestamp', desc=True), without reading the history.
+        """
+        # Pending records before committed ones: a record moves from
+        # one to the other only after being written
+        pending = [r for r in list(self._pending)
+                   if r.get('url') == url and
+                   isinstance(r.get('timestamp'), datetime)]
+        record = self._records.latest(url)
+        for candidate in pending:
+            if record is None or candidate['timestamp'] > record['timestamp']:
+                record = candidate
+        return FromPersistence(record) if record is not None else None
+
+    def _scan_raw(self, filter_args, required_fields) \
+            -> Iterator[Dict[str, object]]:
+        """
+        Every stored record, as scan_raw() gives them, then those
+        persisted but not yet committed. Ones a commit writes meanwhile,
+        whether it started before or while the store is read, are only
+        given once.
+        """
+        with self._write_lock:
+            pending = list(self._pending)
+            commits_started = self._commits_started
+            committing = commits_started != self._commits_finished
+        found = set()  # type: Set[str]
+        for record in self._records.scan_raw(filter_args, required_fields):
+            if pending and (committing or
+                            self._commits_started != commits_started):
+                found.add(_identity(record))
+            yield record
+        for record in pending:
+            if not found or _identity(record) not in found:
+                yield _json_safe(record)
+
+    def compact(self,
+                select: Callable[[List[Dict]], List[Dict]],
+                grace_period: timedelta=timedelta(hours=1)) \
+            -> 'CompactionReport':
+        """
+        Rewrites the records to just those chosen by `select`, then
+        deletes any artefacts that no remaining record refers to.
+        """
+        started = time.time()
+        self.commit()
+        with self._write_lock, self._records.exclusive():
+            records = list(self._records.scan({}, ()))
+            kept = select(records)
+            self._records.replace_all(kept)
+
+            referenced = {
+                Path(FromPersistence(r).fetch_local(name)).name
+                for r in kept
+                for name in r.get('_storage', {})}
+            removed, removed_bytes = self._artefacts.sweep(
+                referenced,
+                unless_newer_than=started - grace_period.total_seconds())
+
+        return CompactionReport(
+            records_before=len(records),
+            records_after=len(kept),
+            artefacts_removed=removed,
+            bytes_removed=removed_bytes)
+
+    def merge_segments(self) -> int:
+        """
+        Folds the records of every segment back into the main record
+        store, returning how many were moved. Meant for after sharded
+        runs have finished.
+        """
+        self.commit()
+        with self._write_lock:
+            return self._records.merge_segments()
+
+
+class _GroupCommitter(threading.Thread):
+    """
+    Commits a batch's records in the background, a little while after
+    they start to wait.
+    """
+
+    def __init__(self, storage: Storage, max_records: int,
+                 max_delay: float) -> None:
+        super().__init__(name='storage-commit', daemon=True)
+        self.max_records = max_records
+        self._storage = storage
+        self._max_delay = max_delay
+        self._waiting = threading.Event()
+        self._stopping = threading.Event()
+
+    def notify(self) -> None:
+        self._waiting.set()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._waiting.set()
+        self.join()
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._waiting.wait()
+            self._stopping.wait(self._max_delay)
+            self._waiting.clear()
+            try:
+                self._storage.commit()
+            except Exception:
+                logging.exception('While committing records')
+
+
+class CompactionReport:
+    def __init__(self, records_before, records_after,
+                 artefacts_removed, bytes_removed):
+        self.records_before = records_before
+        self.records_after = records_after
+        self.artefacts_removed = artefacts_removed
+        self.bytes_removed = bytes_removed
+
+    def __str__(self):
+        return ('Kept {after} of {before} records; '
+                'removed {artefacts} artefacts ({bytes} bytes)').format(
+                    after=self.records_after,
+                    before=self.records_before,
+                    artefacts=self.artefacts_removed,
+                    bytes=self.bytes_removed)
+
 
 class FromPersistence:
     def __init__(self, data):
         self.data = data
 
     def __getitem__(self, key):
-        return self.data.get(key)
+        # Dates are only parsed for the fields that get looked at
+        return _de_jsonsafe_value(self.data.get(key))
 
     def fetch_local(self, key):
         if '_storage' not in self.data:
@@ -84,6 +351,16 @@ class FromPersistence:
         local_path = urlparse(storage_url).path
         return unquote(local_path)
 
+    def open(self, key) -> Optional[IO[bytes]]:
+        """
+        The original contents of a stored artefact, decompressed as
+        they're read if need be.
+        """
+        local_path = self.fetch_local(key)
+        if local_path is None:
+            return None
+        return open_artefact(local_path)
+
 
 class StorageQuery:
     def __init__(self, backing_storage, filter_args):
@@ -92,6 +369,7 @@ class StorageQuery:
         self.required_fields = []
         self.order_fields = []
         self.desc = False
+        self.max_results = None  # type: Optional[int]
 
     def having(self, *args):
         self.required_fields = args
@@ -102,48 +380,58 @@ class StorageQuery:
         self.desc = desc
         return self
 
-    def fetch(self):
-        try:
-
-            all_data = []
-            with open(self.storage._meta_info_path,
-                      mode='r',
-                      encoding='utf-8') as f:
-
-                for line in f:
-                    all_data.append(_de_jsonsafe(json.loads(line)))
-
-        except FileNotFoundError:
-            return []
-
-        filtered = [d for d in all_data
-                    if _filter_match(self.filter_args, d) and
-                    all(required in d for required in self.required_fields)]
-
-        sorted_data = sorted(filtered,
-                             key=lambda d: [d[k] for k in self.order_fields],
-                             reverse=self.desc)
-
-        return [FromPersistence(d) for d in sorted_data]
-
-
-_json_dateformat = '%Y-%m-%d %H:%M:%S.%f%z'
-
+    def limit(self, max_results: int):
+        self.max_results = max_results
+        return self
 
-def _de_jsonsafe(jsonsafe_data) -> Dict[str, object]:
-    result = dict()
-    for k, v in jsonsafe_data.items():
-        if isinstance(v, dict):
-            if '__date' in v:
-                v = datetime.strptime(v['__date'], _json_dateformat)
-        result[k] = v
-    return result
+    def fetch(self) -> List['FromPersistence']:
+        return list(self.stream())
+
+    def first(self) -> Optional['FromPersistence']:
+        return next(self._stream(1), None)
+
+    def stream(self) -> Iterator['FromPersistence']:
+        """
+        Yields matching records as they're found. Without an ordering,
+        nothing is read beyond the last result wanted; ordering with a
+        limit holds no more than `limit` records at a time.
+        """
+        return self._stream(self.max_results)
+
+    def _stream(self, max_results):
+        if max_results is not None and max_results <= 0:
+            return
+
+        candidates = (
+            d for d in self.storage._scan_raw(
+                self.filter_args, self.required_fields)
+            if _filter_match(self.filter_args, d) and
+            all(required in d for required in self.required_fields))
+
+        if self.order_fields:
+            def order_key(d):
+                return [_de_jsonsafe_value(d[k]) for k in self.order_fields]
+
+            # Both are documented as equivalent to sorted(...)[:n],
+            # so ties keep the order they were written in
+            if max_results is None:
+                candidates = iter(sorted(candidates, key=order_key,
+                                         reverse=self.desc))
+            elif self.desc:
+                candidates = iter(heapq.nlargest(max_results, candidates,
+                                                 key=order_key))
+            else:
+                candidates = iter(heapq.nsmallest(max_results, candidates,
+                                                  key=order_key))
+
+        for d in itertools.islice(candidates, max_results):
+            yield FromPersistence(d)
 
 
 def _filter_match(filters, data):
     for filter_key, filter_value in filters.items():
         try:
-            if data[filter_key] != filter_value:
+            if _de_jsonsafe_value(data[filter_key]) != filter_value:
                 return False
         except KeyError:
             return False
@@ -151,32 +439,8 @@ def _filter_match(filters, data):
         return True
 
 
-def _json_safe(v):
-    if type(v) in (str, int, float, bool):
-        return v
-    if isinstance(v, dict):
-        return {k: _json_safe(nested_val) for k, nested_val in v.items()}
-
-    if isinstance(v, datetime):
-        return {'__date': v.strftime(_json_dateformat)}
-
-    raise RuntimeError('Don\'t know how to jsonize: {v}'.format(v=type(v)))
-
-
-def _read_file_chunks(fileobject):
-    while True:
-        chunk = fileobject.read(8192)
-        if not chunk:
-            break
-        yield chunk
-
-
-def _storage_filename_for(existing_file):
-    if os.path.getsize(existing_file) == 0:
-        return '_empty_file'
-
-    hasher = file_hash(existing_file)
+def _as_artefact(location: Union[str, Artefact]) -> Artefact:
+    if isinstance(location, Artefact):
+        return location
+    return Artefact(str(location))
 
-    return base64.b64encode(
-            hasher.digest(),
-            altchars=b'_-').decode('utf-8')
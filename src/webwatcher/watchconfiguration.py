@@ -13,8 +13,37 @@ _CONFIG_PATH_ENV_VAR = 'WEBWATCHER_CONFIG_PATH'
 
 
 class PageUnderObsevation:
-    def __init__(self, url):
+    def __init__(self, url, force_screenshot=False, ignore_regions=(),
+                 interval=None, rate_limit=None, max_in_flight=None):
         self.url = url
+        self.force_screenshot = force_screenshot
+        self.ignore_regions = [tuple(r) for r in ignore_regions]
+        # Seconds between checks when running as a daemon
+        self.interval = interval
+        # Limits on requests to this page's host, over the global ones
+        self.rate_limit = rate_limit
+        self.max_in_flight = max_in_flight
+
+
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_duration(value: Union[int, float, str]) -> float:
+    """
+    A number of seconds, or a string such as `90s`, `15m`, `2h` or `1d`.
+    """
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        value = value.strip()
+        unit = _DURATION_UNITS.get(value[-1:].lower())
+        try:
+            seconds = float(value[:-1]) * unit if unit else float(value)
+        except ValueError:
+            raise ValueError('Not a duration: {}'.format(value))
+    if seconds <= 0:
+        raise ValueError('Durations must be positive: {}'.format(value))
+    return seconds
 
 
 def _if_exists_or_none(p: Optional[Union[Path, str]]) -> Optional[Path]:
@@ -43,10 +72,23 @@ def _config_to_page_specification(sites: Dict[str, Dict]) \
 
     for name, data in sites.items():
         try:
-            yield PageUnderObsevation(url=data['url'])
-        except:
-            logging.warn('No url specified for {}', name)
+            url = data['url']
+        except KeyError:
+            logging.warning('No url specified for %s', name)
+            raise
+        try:
+            interval = parse_duration(data['interval']) \
+                if 'interval' in data else None
+        except ValueError:
+            logging.warning('Bad interval for %s: %s', name, data['interval'])
             raise
+        yield PageUnderObsevation(
+            url=url,
+            force_screenshot=data.get('force_screenshot', False),
+            ignore_regions=data.get('ignore_regions', ()),
+            interval=interval,
+            rate_limit=data.get('rate_limit'),
+            max_in_flight=data.get('max_in_flight'))
 
 
 def _print_err(msg: str='') -> None:
@@ -1,24 +1,230 @@
 
-import requests
-from requests.exceptions import ConnectionError
-import shutil
-import tempfile
+import os
+import random
+import time
+from typing import Callable, Dict, List, Optional
 
+from requests.exceptions import ConnectionError, ConnectTimeout, \
+    RequestException, Timeout
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+from webwatcher.artefact import Artefact, HashingWriter
+from webwatcher.hostlimiter import HostLimiter, retry_after_seconds
 from webwatcher.http_session import http_session
 
 
+class FetchResult:
+    def __init__(self,
+                 was_available: bool,
+                 raw_content: Optional[Artefact],
+                 validators: Optional[Dict[str, str]]=None,
+                 not_modified: bool=False,
+                 failures: Optional[List[Dict[str, object]]]=None,
+                 status_code: Optional[int]=None) -> None:
+        self.was_available = was_available
+        self.raw_content = raw_content
+        self.validators = validators or dict()
+        self.not_modified = not_modified
+        self.status_code = status_code
+        # What went wrong with each attempt that didn't succeed
+        self.failures = failures or []
+
+    @property
+    def raw_content_location(self) -> Optional[str]:
+        return self.raw_content.path if self.raw_content else None
+
+
+# Statuses with which a server may ask us to come back later
+_BACK_OFF_STATUSES = (429, 503)
+
+# Statuses worth trying again, as they're usually over by the next try
+_TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+
+_CHUNK_SIZE = 65536
+
+
+class _FetchFailed(Exception):
+    def __init__(self, reason: str, detail: str, retry: bool) -> None:
+        self.reason = reason
+        self.detail = detail
+        self.retry = retry
+
+
 class WebFetcher:
-    def __init__(self, temp):
+    """
+    Downloads a page, giving up on connecting after `timeout[0]`
+    seconds, on a stalled read after `timeout[1]`, and on the whole body
+    after `total_timeout`; bodies over `max_body_size` bytes aren't
+    kept. Errors likely to be temporary are tried again up to `retries`
+    times, after exponentially growing, randomly jittered pauses.
+    """
+
+    def __init__(self,
+                 temp,
+                 session=None,
+                 timeout=None,
+                 limiter=None,
+                 total_timeout: Optional[float]=None,
+                 max_body_size: Optional[int]=None,
+                 retries: int=0,
+                 backoff: float=0.5,
+                 sleep: Callable[[float], None]=time.sleep,
+                 rand: Callable[[], float]=random.random) -> None:
         self._temp = temp
+        self._session = session if session is not None else http_session
+        self._timeout = timeout
+        self._limiter = limiter if limiter is not None else HostLimiter()
+        self._total_timeout = total_timeout
+        self._max_body_size = max_body_size
+        self._retries = retries
+        self._backoff = backoff
+        self._sleep = sleep
+        self._rand = rand
+
+    def fetch(self, url, validators=None) -> FetchResult:
+        failures = []  # type: List[Dict[str, object]]
+        for attempt in range(self._retries + 1):
+            if attempt:
+                # Full jitter: anywhere up to the exponential backoff
+                self._sleep(self._backoff * 2 ** (attempt - 1) * self._rand())
+
+            started = time.monotonic()
+            try:
+                with self._limiter.slot(url):
+                    result = self._fetch(url, validators)
+            except _FetchFailed as failure:
+                failures.append(_failure(attempt, started,
+                                         failure.reason, failure.detail))
+                if failure.retry:
+                    continue
+                break
+
+            if result.status_code in _TRANSIENT_STATUSES:
+                failures.append(_failure(
+                    attempt, started, 'status',
+                    'HTTP {}'.format(result.status_code)))
+                if attempt < self._retries:
+                    _discard(result.raw_content)
+                    continue
+
+            result.failures = failures
+            return result
 
-    def fetch(self, url):
+        return FetchResult(False, None, failures=failures)
+
+    def _fetch(self, url, validators) -> FetchResult:
         try:
-            response = http_session.get(url, stream=True)
-        except ConnectionError:
-            return False, None
-        else:
-            was_available = response.status_code in range(200, 300)
-            raw_content_file = self._temp.new_file(delete=False)
-            shutil.copyfileobj(response.raw, raw_content_file)
-            raw_content_file.flush()
-            return True, raw_content_file.name
+            response = self._session.get(
+                url,
+                stream=True,
+                timeout=self._timeout,
+                headers=_conditional_headers(validators))
+        except ConnectTimeout as e:
+            raise _FetchFailed('connect_timeout', repr(e), retry=True)
+        except Timeout as e:
+            raise _FetchFailed('read_timeout', repr(e), retry=True)
+        except ConnectionError as e:
+            raise _FetchFailed('connection', repr(e), retry=True)
+        except RequestException as e:
+            raise _FetchFailed('request', repr(e), retry=False)
+
+        with response:
+            if response.status_code in _BACK_OFF_STATUSES:
+                retry_after = retry_after_seconds(
+                    response.headers.get('Retry-After'))
+                if retry_after is not None:
+                    self._limiter.back_off(url, retry_after)
+
+            if validators and response.status_code == 304:
+                return FetchResult(
+                    True,
+                    None,
+                    validators=_validators_from(response, validators),
+                    not_modified=True,
+                    status_code=304)
+
+            raw_content = self._read_body(response)
+
+        return FetchResult(
+            response.status_code in range(200, 300),
+            raw_content,
+            validators=_validators_from(response),
+            status_code=response.status_code)
+
+    def _read_body(self, response) -> Artefact:
+        declared = response.headers.get('Content-Length')
+        if self._max_body_size is not None and declared is not None and \
+                declared.isdigit() and int(declared) > self._max_body_size:
+            raise _FetchFailed('too_large',
+                               'Content-Length {}'.format(declared),
+                               retry=False)
+
+        deadline = time.monotonic() + self._total_timeout \
+            if self._total_timeout is not None else None
+        with self._temp.new_file(delete=False) as raw_content_file:
+            raw_content = HashingWriter(raw_content_file)
+            try:
+                while True:
+                    chunk = response.raw.read(_CHUNK_SIZE,
+                                              decode_content=True)
+                    if not chunk:
+                        break
+                    raw_content.write(chunk)
+                    if self._max_body_size is not None and \
+                            raw_content.size > self._max_body_size:
+                        raise _FetchFailed(
+                            'too_large',
+                            'over {} bytes'.format(self._max_body_size),
+                            retry=False)
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise _FetchFailed(
+                            'total_timeout',
+                            'body took over {}s'.format(self._total_timeout),
+                            retry=False)
+            except _FetchFailed:
+                _discard(raw_content.artefact())
+                raise
+            except (ReadTimeoutError, ProtocolError, OSError) as e:
+                _discard(raw_content.artefact())
+                raise _FetchFailed('read_timeout'
+                                   if isinstance(e, ReadTimeoutError)
+                                   else 'connection', repr(e), retry=True)
+        return raw_content.artefact(disposable=True)
+
+
+def _failure(attempt: int, started: float, reason: str, detail: str) \
+        -> Dict[str, object]:
+    return {
+        'attempt': attempt + 1,
+        'reason': reason,
+        'detail': detail,
+        'seconds': round(time.monotonic() - started, 3),
+    }
+
+
+def _discard(artefact: Optional[Artefact]) -> None:
+    if artefact is None:
+        return
+    try:
+        os.unlink(artefact.path)
+    except OSError:
+        pass
+
+
+def _conditional_headers(validators) -> Dict[str, str]:
+    headers = dict()
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def _validators_from(response, previous=None) -> Dict[str, str]:
+    validators = dict(previous or {})
+    if 'ETag' in response.headers:
+        validators['etag'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        validators['last_modified'] = response.headers['Last-Modified']
+    return validators
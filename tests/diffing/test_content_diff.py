@@ -0,0 +1,88 @@
+
+import time
+
+from webwatcher import contentdiff
+from webwatcher.contentdiff import ContentDiffer
+
+
+def _page(tmpdir, name, html):
+    f = tmpdir.join(name)
+    f.write(html)
+    return str(f)
+
+
+def test_identical_pages_have_no_diff(tmpdir):
+    html = '<html><body><p>Hello</p></body></html>'
+    old = _page(tmpdir, 'old', html)
+    new = _page(tmpdir, 'new', html)
+
+    assert ContentDiffer().diff(old, new) is None
+
+
+def test_reports_changed_text(tmpdir):
+    old = _page(tmpdir, 'old', '<ul><li>one</li><li>two</li></ul>')
+    new = _page(tmpdir, 'new', '<ul><li>one</li><li>three</li></ul>')
+
+    diff = ContentDiffer().diff(old, new)
+
+    assert diff.removed == 1
+    assert diff.added == 1
+    assert diff.examples == ['three']
+
+
+def test_noise_is_normalised_away(tmpdir):
+    old = _page(tmpdir, 'old', '''
+        <script>var now = 1; if (a < b) {}</script>
+        <p>Generated at 2020-01-01 12:00:00</p>
+        <input type="hidden" name="csrf_token" value="abc123">
+        <p>Same   text</p>''')
+    new = _page(tmpdir, 'new', '''
+        <script>var now = 2; if (a < b) {}</script>
+        <p>Generated at 2020-01-02 13:30:00</p>
+        <input type="hidden" name="csrf_token" value="zzz999">
+        <p>Same text</p>''')
+
+    assert ContentDiffer().diff(old, new) is None
+    assert ContentDiffer(normalisation=[]).diff(old, new) is not None
+
+
+def test_tokens_span_read_boundaries(tmpdir, monkeypatch):
+    monkeypatch.setattr(contentdiff, '_CHUNK_SIZE', 3)
+    page = _page(tmpdir, 'page', '<p class="x">héllo</p><br/>tail')
+
+    tokens = list(ContentDiffer(normalisation=[]).tokens(page))
+
+    assert tokens == ['<p class="x">', 'héllo', '</p>', '<br/>', 'tail']
+
+
+def _table(rows, text):
+    return '<table>\n{}</table>\n'.format(''.join(
+        '<tr><td>{}</td><td>cell</td></tr>\n'.format(text(i))
+        for i in range(rows)))
+
+
+def test_changes_are_found_between_unchanged_rows(tmpdir):
+    old = _page(tmpdir, 'old', _table(1000, lambda i: 'row {}'.format(i)))
+    new = _page(tmpdir, 'new', _table(1000, lambda i: 'row {}'.format(
+        {100: 'one hundred', 900: 'nine hundred'}.get(i, i))))
+
+    diff = ContentDiffer().diff(old, new)
+
+    assert (diff.removed, diff.added) == (2, 2)
+    assert diff.examples == ['row one hundred', 'row nine hundred']
+
+
+def test_repetitive_pages_are_diffed_quickly(tmpdir):
+    # Markup that repeats the same few tokens, changed all over, used
+    # to take minutes to match up token by token
+    old = _page(tmpdir, 'old', _table(
+        4000, lambda i: 'old' if i % 97 == 0 else 'same'))
+    new = _page(tmpdir, 'new', _table(
+        4000, lambda i: 'new' if i % 89 == 0 else 'same'))
+
+    started = time.monotonic()
+    diff = ContentDiffer().diff(old, new)
+
+    assert time.monotonic() - started < 5
+    assert diff.examples[0] == 'new'
+    assert diff.removed >= 42 and diff.added >= 45
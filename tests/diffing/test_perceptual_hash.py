@@ -0,0 +1,88 @@
+from datetime import datetime, timezone
+
+import pytest
+
+np = pytest.importorskip('numpy')
+Image = pytest.importorskip('PIL.Image')
+
+from webwatcher.diffa import Diffa  # noqa: E402
+from webwatcher.observation import PageObservation, Screenshot  # noqa: E402
+from webwatcher.perceptualhash import (  # noqa: E402
+    PerceptualHashIndex, dhash, hamming_distance)
+
+
+def _png(tmpdir, name, pixels):
+    path = str(tmpdir.join(name))
+    Image.fromarray(pixels).save(path)
+    return path
+
+
+def _page(height=200, width=100):
+    pixels = np.full((height, width, 3), 255, dtype=np.uint8)
+    pixels[20:60, 10:90] = (0, 0, 0)
+    pixels[100:180, 30:50] = (40, 80, 200)
+    return pixels
+
+
+def _observation(when, phash, content_hash):
+    return PageObservation(
+        'http://example.com', when, True,
+        Screenshot(content_hash, perceptual_hash=phash), None)
+
+
+def test_similar_screenshots_have_close_hashes(tmpdir):
+    tweaked = _page()
+    tweaked[5, 5] = (0, 0, 0)
+    different = np.full((200, 100, 3), 255, dtype=np.uint8)
+    different[:, 50:] = (0, 0, 0)
+
+    original = dhash(_png(tmpdir, 'a.png', _page()))
+    assert hamming_distance(original,
+                            dhash(_png(tmpdir, 'b.png', tweaked))) <= 4
+    assert hamming_distance(original,
+                            dhash(_png(tmpdir, 'c.png', different))) > 32
+
+
+def test_unreadable_image_has_no_hash(tmpdir):
+    path = tmpdir.join('broken.png')
+    path.write('not an image')
+
+    assert dhash(str(path)) is None
+
+
+def test_index_finds_hashes_within_distance():
+    index = PerceptualHashIndex()
+    index.add('u', '00', 'zero')
+    index.add('u', '01', 'one-bit')
+    index.add('u', '0f', 'four-bits')
+    index.add('u', 'ff', 'eight-bits')
+    index.add('other', '00', 'elsewhere')
+
+    assert index.near('u', '00', 1) == [(0, 'zero'), (1, 'one-bit')]
+    assert [item for _, item in index.near('u', '00', 4)] == \
+        ['zero', 'one-bit', 'four-bits']
+    assert index.near('missing', '00', 8) == []
+
+
+def test_close_perceptual_hashes_are_not_a_change():
+    first = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    second = datetime(2026, 1, 2, tzinfo=timezone.utc)
+    diffa = Diffa(perceptual_threshold=2)
+
+    assert diffa.diff(_observation(second, 'ff00', 'b' * 64),
+                      _observation(first, 'ff01', 'a' * 64)) is None
+
+
+def test_reports_earlier_lookalikes():
+    index = PerceptualHashIndex()
+    diffa = Diffa(perceptual_threshold=2, perceptual_index=index)
+    times = [datetime(2026, 1, d, tzinfo=timezone.utc) for d in (1, 2, 3)]
+
+    diffa.diff(_observation(times[0], 'ff00', 'a' * 64), None)
+    page_diff = diffa.diff(_observation(times[1], '00ff', 'b' * 64),
+                           _observation(times[0], 'ff00', 'a' * 64))
+    assert page_diff.screenshot_diff.resembles == []
+
+    page_diff = diffa.diff(_observation(times[2], 'ff00', 'c' * 64),
+                           _observation(times[1], '00ff', 'b' * 64))
+    assert page_diff.screenshot_diff.resembles == [times[0]]
@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip('numpy')
+Image = pytest.importorskip('PIL.Image')
+
+from webwatcher.imagediff import PixelDiffer  # noqa: E402
+
+
+def _png(tmpdir, name, pixels):
+    path = str(tmpdir.join(name))
+    Image.fromarray(pixels).save(path)
+    return path
+
+
+def _blank(height=200, width=100):
+    return np.full((height, width, 3), 255, dtype=np.uint8)
+
+
+@pytest.fixture
+def differ(tmpdir):
+    return PixelDiffer(Path(str(tmpdir.join('out'))), threshold=0.001)
+
+
+def test_identical_screenshots_are_unchanged(tmpdir, differ):
+    old = _png(tmpdir, 'old.png', _blank())
+    new = _png(tmpdir, 'new.png', _blank())
+
+    assert differ.compare(old, new) is None
+
+
+def test_changes_below_threshold_are_ignored(tmpdir, differ):
+    changed = _blank()
+    changed[5, 5] = (0, 0, 0)  # a blinking cursor
+    old = _png(tmpdir, 'old.png', _blank())
+    new = _png(tmpdir, 'new.png', changed)
+
+    assert differ.compare(old, new) is None
+
+
+def test_reports_changed_regions(tmpdir, differ):
+    changed = _blank()
+    changed[10:20, 10:30] = (0, 0, 0)
+    changed[150:160, 60:70] = (0, 0, 0)
+    old = _png(tmpdir, 'old.png', _blank())
+    new = _png(tmpdir, 'new.png', changed)
+
+    comparison = differ.compare(old, new)
+
+    assert comparison.changed_ratio == pytest.approx(300 / 20000)
+    assert sorted(comparison.regions) == [(0, 0, 32, 32), (48, 144, 80, 160)]
+    assert Path(comparison.comparison_path).exists()
+
+
+def test_ignored_regions_do_not_count(tmpdir, differ):
+    changed = _blank()
+    changed[10:20, 10:30] = (0, 0, 0)
+    old = _png(tmpdir, 'old.png', _blank())
+    new = _png(tmpdir, 'new.png', changed)
+
+    assert differ.compare(old, new, ignore_regions=[(0, 0, 50, 50)]) is None
+
+
+def test_screenshots_of_different_sizes_compare(tmpdir, differ):
+    old = _png(tmpdir, 'old.png', _blank(height=200))
+    new = _png(tmpdir, 'new.png', _blank(height=220))
+
+    comparison = differ.compare(old, new)
+
+    assert comparison.changed_ratio == pytest.approx(20 / 220)
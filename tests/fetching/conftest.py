@@ -0,0 +1,86 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+import pytest
+
+from webwatcher.temporarystorage import TemporaryStorage
+
+
+class _Pages(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.most_in_flight = max(server.most_in_flight,
+                                        server.in_flight)
+        server.requests.append((self.path, dict(self.headers)))
+        server.clients.add(self.client_address)
+        try:
+            time.sleep(server.delay)
+            with server.lock:
+                upcoming = server.sequences.get(self.path)
+                scripted = upcoming.pop(0) if upcoming else None
+            status, body = scripted or \
+                server.pages.get(self.path, (404, b'not found'))
+            etag = server.etags.get(self.path)
+            if etag is not None and self.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+            self.send_response(status)
+            if etag is not None:
+                self.send_header('ETag', etag)
+            for name, value in server.headers.get(self.path, {}).items():
+                self.send_header(name, value)
+            if self.path in server.chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for i in range(0, len(body), 5):
+                    piece = body[i:i + 5]
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(piece), piece))
+                self.wfile.write(b'0\r\n\r\n')
+            else:
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer, which needs Python 3.7
+    daemon_threads = True
+
+
+@pytest.fixture
+def web_server():
+    server = _Server(('127.0.0.1', 0), _Pages)
+    server.lock = threading.Lock()
+    server.in_flight = server.most_in_flight = 0
+    server.delay = 0
+    server.pages = dict()
+    server.etags = dict()
+    server.headers = dict()
+    # Responses to give, in order, before falling back to `pages`
+    server.sequences = dict()
+    server.requests = []
+    # Where requests came from, one address per connection
+    server.clients = set()
+    # Paths whose bodies are sent in chunks
+    server.chunked = set()
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def temp_storage(tmpdir):
+    return TemporaryStorage(dir=str(tmpdir))
@@ -0,0 +1,187 @@
+import gzip
+from hashlib import sha256
+from pathlib import Path
+import socket
+import time
+import zlib
+
+import pytest
+
+from webwatcher.asyncfetcher import AsyncWebFetcher
+from webwatcher.diffa import Diffa
+from webwatcher.hostlimiter import HostLimiter
+from webwatcher.main import Observer, observe_the_web
+from webwatcher.observation import Screenshot
+from webwatcher.storage import Storage
+from webwatcher.watchconfiguration import PageUnderObsevation
+
+
+@pytest.fixture
+def async_fetcher(temp_storage):
+    fetchers = []
+
+    def make(**kwargs):
+        fetcher = AsyncWebFetcher(temp_storage, **kwargs)
+        fetchers.append(fetcher)
+        return fetcher
+
+    yield make
+    for fetcher in fetchers:
+        fetcher.close()
+
+
+def _content(result):
+    with open(result.raw_content_location, 'rb') as f:
+        return f.read()
+
+
+def test_fetches_like_web_fetcher(web_server, async_fetcher):
+    web_server.pages['/page'] = (200, b'content')
+    web_server.etags['/page'] = '"v1"'
+    fetcher = async_fetcher()
+
+    first = fetcher.fetch(web_server.url + '/page')
+    second = fetcher.fetch(web_server.url + '/page',
+                           validators=first.validators)
+    missing = fetcher.fetch(web_server.url + '/missing')
+
+    assert first.was_available
+    assert _content(first) == b'content'
+    assert first.raw_content.sha256 == sha256(b'content').hexdigest()
+    assert first.validators == {'etag': '"v1"'}
+    assert second.not_modified
+    assert second.raw_content_location is None
+    assert web_server.requests[1][1]['If-None-Match'] == '"v1"'
+    assert not missing.was_available
+    assert missing.status_code == 404
+
+
+def test_connections_are_kept_alive(web_server, async_fetcher):
+    web_server.pages['/page'] = (200, b'content')
+    fetcher = async_fetcher()
+
+    for _ in range(5):
+        assert fetcher.fetch(web_server.url + '/page').was_available
+
+    assert len(web_server.clients) == 1
+
+
+def test_fetches_many_pages_at_once(web_server, async_fetcher):
+    web_server.delay = 0.2
+    limiter = HostLimiter(max_in_flight=10)
+    fetcher = async_fetcher(limiter=limiter, max_connections=8)
+    urls = []
+    for i in range(40):
+        web_server.pages['/{}'.format(i)] = (200, str(i).encode('ascii'))
+        urls.append(web_server.url + '/{}'.format(i))
+
+    started = time.monotonic()
+    finished = [(i, future.result()[0])
+                for i, future in fetcher.fetch_all([(url, None)
+                                                    for url in urls])]
+
+    assert time.monotonic() - started < 4
+    assert sorted(i for i, _ in finished) == list(range(40))
+    assert all(_content(result) == str(i).encode('ascii')
+               for i, result in finished)
+    assert web_server.most_in_flight == 8
+
+
+def test_limits_requests_in_flight_per_host(web_server, async_fetcher):
+    web_server.delay = 0.1
+    web_server.pages['/page'] = (200, b'hello')
+    limiter = HostLimiter(max_in_flight=4)
+    limiter.configure(web_server.url, max_in_flight=2)
+    fetcher = async_fetcher(limiter=limiter)
+
+    results = [future.result()[0] for _, future in
+               fetcher.fetch_all([(web_server.url + '/page', None)] * 6)]
+
+    assert all(r.was_available for r in results)
+    assert web_server.most_in_flight == 2
+
+
+def test_decodes_chunked_and_compressed_bodies(web_server, async_fetcher):
+    body = b'<p>hello</p>' * 20
+    web_server.pages['/chunked'] = (200, body)
+    web_server.chunked.add('/chunked')
+    web_server.pages['/gzip'] = (200, gzip.compress(body))
+    web_server.headers['/gzip'] = {'Content-Encoding': 'gzip'}
+    web_server.pages['/deflate'] = (200, zlib.compress(body))
+    web_server.headers['/deflate'] = {'Content-Encoding': 'deflate'}
+    raw_deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    web_server.pages['/raw-deflate'] = \
+        (200, raw_deflate.compress(body) + raw_deflate.flush())
+    web_server.headers['/raw-deflate'] = {'Content-Encoding': 'deflate'}
+    fetcher = async_fetcher()
+
+    for path in ('/chunked', '/gzip', '/deflate', '/raw-deflate'):
+        assert _content(fetcher.fetch(web_server.url + path)) == body
+    assert len(web_server.clients) == 1
+
+
+def test_follows_redirects(web_server, async_fetcher):
+    web_server.pages['/old'] = (301, b'moved')
+    web_server.headers['/old'] = {'Location': '/new'}
+    web_server.pages['/new'] = (200, b'here now')
+
+    result = async_fetcher().fetch(web_server.url + '/old')
+
+    assert result.was_available
+    assert _content(result) == b'here now'
+
+
+def test_failures_are_recorded_and_retried(web_server, async_fetcher):
+    web_server.sequences['/page'] = [(503, b'busy')]
+    web_server.pages['/page'] = (200, b'hello')
+    web_server.pages['/big'] = (200, b'x' * 100)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    closed_port = listener.getsockname()[1]
+    listener.close()
+    fetcher = async_fetcher(retries=1, backoff=0, max_body_size=50)
+
+    retried = fetcher.fetch(web_server.url + '/page')
+    too_large = fetcher.fetch(web_server.url + '/big')
+    refused = fetcher.fetch('http://127.0.0.1:{}/'.format(closed_port))
+
+    assert retried.was_available
+    assert [f['detail'] for f in retried.failures] == ['HTTP 503']
+    assert [f['reason'] for f in too_large.failures] == ['too_large']
+    assert not refused.was_available
+    assert [f['reason'] for f in refused.failures] == \
+        ['connection', 'connection']
+
+
+def test_read_timeouts_are_recorded(web_server, async_fetcher):
+    web_server.delay = 0.5
+    web_server.pages['/slow'] = (200, b'eventually')
+    fetcher = async_fetcher(retries=1, backoff=0, timeout=(1, 0.1))
+
+    result = fetcher.fetch(web_server.url + '/slow')
+
+    assert not result.was_available
+    assert result.raw_content is None
+    assert [f['reason'] for f in result.failures] == \
+        ['read_timeout', 'read_timeout']
+
+
+class _Screenshotter:
+    def take_screenshot_of(self, url):
+        return Screenshot(content_hash=sha256(url.encode()).hexdigest())
+
+
+def test_pages_are_observed_as_they_arrive(web_server, async_fetcher,
+                                           tmpdir):
+    for i in range(10):
+        web_server.pages['/{}'.format(i)] = (200, b'page')
+    storage = Storage(storage_root=Path(str(tmpdir.mkdir('storage'))))
+    watcher = Observer(_Screenshotter(), async_fetcher())
+    pages = [PageUnderObsevation(url=web_server.url + '/{}'.format(i))
+             for i in range(10)]
+
+    observe_the_web(Diffa(), storage, watcher, pages, workers=3)
+
+    assert sorted(r['url'] for r in storage.find().fetch()) == \
+        sorted(page.url for page in pages)
+    assert watcher.metrics.summary()['stages']['fetch']['count'] == 10
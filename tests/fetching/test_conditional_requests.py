@@ -0,0 +1,60 @@
+from hashlib import sha256
+from pathlib import Path
+
+from webwatcher.diffa import Diffa
+from webwatcher.main import Observer, observe_the_web
+from webwatcher.observation import Screenshot
+from webwatcher.storage import Storage
+from webwatcher.watchconfiguration import PageUnderObsevation
+from webwatcher.webfetcher import WebFetcher
+
+
+class _CountingScreenshotter:
+    def __init__(self, tmpdir):
+        self._tmpdir = tmpdir
+        self.taken = 0
+
+    def take_screenshot_of(self, url):
+        self.taken += 1
+        shot = self._tmpdir.join('shot{}.png'.format(self.taken))
+        shot.write('not really a png')
+        return Screenshot(content_hash=sha256(b'not really a png').hexdigest(),
+                          content_path=str(shot))
+
+
+def test_fetcher_sends_validators_and_understands_304(web_server,
+                                                      temp_storage):
+    web_server.pages['/page'] = (200, b'content')
+    web_server.etags['/page'] = '"v1"'
+    fetcher = WebFetcher(temp_storage)
+
+    first = fetcher.fetch(web_server.url + '/page')
+    second = fetcher.fetch(web_server.url + '/page',
+                           validators=first.validators)
+
+    assert first.validators == {'etag': '"v1"'}
+    assert second.not_modified
+    assert second.raw_content_location is None
+    assert web_server.requests[1][1]['If-None-Match'] == '"v1"'
+
+
+def test_unchanged_page_skips_download_and_screenshot(web_server,
+                                                      temp_storage,
+                                                      tmpdir):
+    web_server.pages['/page'] = (200, b'content')
+    web_server.etags['/page'] = '"v1"'
+    storage = Storage(storage_root=Path(str(tmpdir.mkdir('storage'))))
+    screenshotter = _CountingScreenshotter(tmpdir)
+    watcher = Observer(screenshotter, WebFetcher(temp_storage))
+    pages = [PageUnderObsevation(url=web_server.url + '/page')]
+
+    observe_the_web(Diffa(), storage, watcher, pages)
+    observe_the_web(Diffa(), storage, watcher, pages)
+
+    assert screenshotter.taken == 1
+    first, second = storage.find().order_by('timestamp').fetch()
+    assert second['etag'] == '"v1"'
+    assert second['raw_content_size'] == first['raw_content_size'] == 7
+    assert second.fetch_local('raw_content') == \
+        first.fetch_local('raw_content')
+    assert second['screenshot_content'] == first['screenshot_content']
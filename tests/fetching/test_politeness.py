@@ -0,0 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import time
+
+from webwatcher.hostlimiter import HostLimiter, retry_after_seconds
+from webwatcher.webfetcher import WebFetcher
+
+
+def _fetch_concurrently(fetcher, urls):
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        return list(executor.map(fetcher.fetch, urls))
+
+
+def test_limits_requests_in_flight_per_host(web_server, temp_storage):
+    web_server.delay = 0.1
+    web_server.pages['/page'] = (200, b'hello')
+    limiter = HostLimiter(max_in_flight=4)
+    limiter.configure(web_server.url, max_in_flight=2)
+    fetcher = WebFetcher(temp_storage, limiter=limiter)
+
+    results = _fetch_concurrently(fetcher, [web_server.url + '/page'] * 6)
+
+    assert all(r.was_available for r in results)
+    assert web_server.most_in_flight == 2
+
+
+def test_spaces_out_requests_to_a_host(web_server, temp_storage):
+    web_server.pages['/page'] = (200, b'hello')
+    fetcher = WebFetcher(temp_storage, limiter=HostLimiter(rate=20))
+
+    started = time.monotonic()
+    _fetch_concurrently(fetcher, [web_server.url + '/page'] * 5)
+
+    # The first request goes straight away; the other four wait their turn
+    assert time.monotonic() - started >= 0.19
+
+
+def test_other_hosts_are_not_held_up():
+    limiter = HostLimiter(rate=0.01)
+    with limiter.slot('http://slow.example.com/a'):
+        pass
+
+    started = time.monotonic()
+    with limiter.slot('http://other.example.com/a'):
+        pass
+
+    assert time.monotonic() - started < 0.1
+
+
+def test_honours_retry_after(web_server, temp_storage):
+    web_server.pages['/busy'] = (429, b'slow down')
+    web_server.headers['/busy'] = {'Retry-After': '1'}
+    web_server.pages['/page'] = (200, b'hello')
+    fetcher = WebFetcher(temp_storage)
+
+    assert not fetcher.fetch(web_server.url + '/busy').was_available
+    started = time.monotonic()
+    assert fetcher.fetch(web_server.url + '/page').was_available
+
+    assert time.monotonic() - started >= 0.9
+
+
+def test_retry_after_can_be_a_date():
+    now = datetime(2026, 10, 18, 12, 0, 0, tzinfo=timezone.utc)
+
+    assert retry_after_seconds('120') == 120
+    assert retry_after_seconds('Sun, 18 Oct 2026 12:01:30 GMT', now) == 90
+    assert retry_after_seconds('Sun, 18 Oct 2026 11:00:00 GMT', now) == 0
+    assert retry_after_seconds('soon') is None
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+
+from webwatcher.observation import PageObservation
+from webwatcher.webfetcher import WebFetcher
+
+
+def _fetcher(temp_storage, **kwargs):
+    sleeps = []
+    fetcher = WebFetcher(temp_storage, sleep=sleeps.append,
+                         rand=lambda: 1.0, **kwargs)
+    return fetcher, sleeps
+
+
+def test_retries_transient_errors_with_backoff(web_server, temp_storage):
+    web_server.sequences['/page'] = [(503, b'busy'), (502, b'bad gateway')]
+    web_server.pages['/page'] = (200, b'hello')
+    fetcher, sleeps = _fetcher(temp_storage, retries=2, backoff=0.5)
+
+    result = fetcher.fetch(web_server.url + '/page')
+
+    assert result.was_available
+    assert sleeps == [0.5, 1.0]
+    assert [(f['attempt'], f['detail']) for f in result.failures] == \
+        [(1, 'HTTP 503'), (2, 'HTTP 502')]
+
+
+def test_gives_up_after_the_last_retry(web_server, temp_storage):
+    web_server.pages['/page'] = (500, b'broken')
+    fetcher, sleeps = _fetcher(temp_storage, retries=1)
+
+    result = fetcher.fetch(web_server.url + '/page')
+
+    assert not result.was_available
+    assert len(web_server.requests) == 2
+    assert len(result.failures) == 2
+
+
+def test_client_errors_are_not_retried(web_server, temp_storage):
+    fetcher, sleeps = _fetcher(temp_storage, retries=3)
+
+    result = fetcher.fetch(web_server.url + '/missing')
+
+    assert not result.was_available
+    assert len(web_server.requests) == 1
+    assert result.failures == []
+
+
+def test_read_timeouts_are_recorded(web_server, temp_storage):
+    web_server.delay = 0.5
+    web_server.pages['/slow'] = (200, b'eventually')
+    fetcher, sleeps = _fetcher(temp_storage, retries=1, timeout=(1, 0.1))
+
+    result = fetcher.fetch(web_server.url + '/slow')
+
+    assert not result.was_available
+    assert result.raw_content is None
+    assert [f['reason'] for f in result.failures] == \
+        ['read_timeout', 'read_timeout']
+
+
+def test_oversized_bodies_are_not_kept(web_server, temp_storage, tmpdir):
+    web_server.pages['/big'] = (200, b'x' * 1000)
+    fetcher, sleeps = _fetcher(temp_storage, retries=2, max_body_size=100)
+
+    result = fetcher.fetch(web_server.url + '/big')
+
+    assert not result.was_available
+    assert [f['reason'] for f in result.failures] == ['too_large']
+    assert len(web_server.requests) == 1
+    assert tmpdir.listdir() == []
+
+
+def test_failures_are_kept_with_the_observation():
+    failures = [{'attempt': 1, 'reason': 'connection',
+                 'detail': 'refused', 'seconds': 0.01}]
+    observation = PageObservation('http://example.com',
+                                  datetime.now(timezone.utc), False,
+                                  None, None, fetch_failures=failures)
+
+    assert observation.get_meta_info()['fetch_failures'] == failures
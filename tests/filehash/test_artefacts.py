@@ -0,0 +1,27 @@
+
+from webwatcher import filehash
+from webwatcher.artefact import Artefact, HashingWriter
+
+
+def test_hashing_writer_describes_what_was_written(tmpdir):
+    target_file = tmpdir.join('some_file')
+
+    with open(str(target_file), 'wb') as f:
+        writer = HashingWriter(f)
+        writer.write(b'hello ')
+        writer.write(b'world')
+
+    artefact = writer.artefact()
+    assert artefact.path == str(target_file)
+    assert artefact.size == 11
+    assert artefact.sha256 == filehash.file_hash(str(target_file)).hexdigest()
+
+
+def test_described_artefact_keeps_known_hash(tmpdir):
+    target_file = tmpdir.join('some_file')
+    target_file.write('hello world')
+
+    artefact = Artefact(str(target_file), sha256='ab' * 32).described()
+
+    assert artefact.sha256 == 'ab' * 32
+    assert artefact.size == 11
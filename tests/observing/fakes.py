@@ -0,0 +1,23 @@
+
+from webwatcher.artefact import Artefact
+from webwatcher.webfetcher import FetchResult
+
+
+class FakeWebFetcher:
+    def __init__(self, tmpdir, unavailable=()):
+        self._tmpdir = tmpdir
+        self._unavailable = set(unavailable)
+        self.fetched = []
+
+    def fetch(self, url, validators=None):
+        self.fetched.append(url)
+        if url in self._unavailable:
+            return FetchResult(False, None)
+        content = self._tmpdir.join(str(len(self.fetched)))
+        content.write('content of {}'.format(url))
+        return FetchResult(True, Artefact(str(content)).described())
+
+
+class NoScreenshots:
+    def take_screenshot_of(self, url):
+        return None
@@ -0,0 +1,105 @@
+import logging
+from pathlib import Path
+import threading
+
+import pytest
+
+from webwatcher.diffa import Diffa
+from webwatcher.main import Observer, watch_the_web
+from webwatcher.scheduler import Scheduler
+from webwatcher.watchconfiguration import PageUnderObsevation, \
+    parse_duration, watched_pages
+
+from fakes import FakeWebFetcher, NoScreenshots
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _page(url, interval=None):
+    return PageUnderObsevation(url=url, interval=interval)
+
+
+def test_pages_fall_due_at_their_own_intervals():
+    clock = FakeClock()
+    fast, slow = _page('https://fast', interval=60), _page('https://slow')
+    scheduler = Scheduler([fast, slow], default_interval=600,
+                          jitter=0, clock=clock)
+
+    assert scheduler.due() == [fast, slow]
+    assert scheduler.seconds_until_next() is None
+    scheduler.reschedule(fast)
+    scheduler.reschedule(slow)
+
+    clock.now += 60
+    assert scheduler.due() == [fast]
+    scheduler.reschedule(fast)
+    assert scheduler.seconds_until_next() == 60
+
+    clock.now += 540
+    assert scheduler.due() == [fast, slow]
+
+
+def test_jitter_stays_within_its_fraction_of_the_interval():
+    page = _page('https://example.com')
+    for r in (0.0, 1.0):
+        clock = FakeClock()
+        scheduler = Scheduler([page], default_interval=100, jitter=0.1,
+                              clock=clock, rand=lambda: r)
+        clock.now += 10
+        assert scheduler.due() == [page]
+        scheduler.reschedule(page)
+        assert scheduler.seconds_until_next() == (90 if r == 0 else 110)
+
+
+def test_durations():
+    assert parse_duration(90) == 90
+    assert parse_duration('90s') == 90
+    assert parse_duration('15m') == 900
+    assert parse_duration('1.5h') == 5400
+    assert parse_duration('1d') == 86400
+
+
+def test_bad_intervals_are_reported_as_such(tmpdir, monkeypatch):
+    config = tmpdir.join('config.toml')
+    config.write('[site.example]\n'
+                 'url = "https://example.com"\n'
+                 'interval = "soon"\n')
+    warnings = []
+    monkeypatch.setattr(logging, 'warning',
+                        lambda msg, *args: warnings.append(msg % args))
+
+    with pytest.raises(ValueError):
+        list(watched_pages(Path(str(config))))
+    assert warnings == ['Bad interval for example: soon']
+
+
+def test_daemon_keeps_checking_until_stopped(local_storage, tmpdir):
+    stop = threading.Event()
+
+    class StoppingFetcher(FakeWebFetcher):
+        def fetch(self, url, validators=None):
+            if url.endswith('/broken') and 'broken' not in self.fetched:
+                self.fetched.append('broken')
+                raise RuntimeError('flaky')
+            result = super().fetch(url, validators)
+            if len(self.fetched) >= 7:
+                stop.set()
+            return result
+
+    fetcher = StoppingFetcher(tmpdir)
+    pages = [_page('https://example.com/ok', interval=0.01),
+             _page('https://example.com/broken', interval=0.01)]
+
+    watch_the_web(Diffa(), local_storage, Observer(NoScreenshots(), fetcher),
+                  Scheduler(pages, default_interval=60),
+                  workers=2, stop=stop)
+
+    urls = [r['url'] for r in local_storage.find().fetch()]
+    assert urls.count('https://example.com/ok') >= 2
+    assert 'https://example.com/broken' in urls
@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+import json
+import pstats
+
+from webwatcher.diffa import Diffa
+from webwatcher.main import Observer, observe_the_web
+from webwatcher.metrics import ProfilerHook, RunMetrics
+from webwatcher.watchconfiguration import PageUnderObsevation
+
+from fakes import FakeWebFetcher, NoScreenshots
+
+
+class SteppingClock:
+    def __init__(self, steps):
+        self._steps = iter(steps)
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += next(self._steps, 0.0)
+        return self.now
+
+
+def test_spans_are_summarised_per_stage():
+    # Each span reads the clock twice; the second read advances it by
+    # the span's duration
+    durations = [1.0, 2.0, 3.0, 4.0, 10.0]
+    clock = SteppingClock(d for duration in durations for d in (0, duration))
+    metrics = RunMetrics(clock=clock)
+
+    for _ in durations:
+        with metrics.span('fetch', 'https://example.com'):
+            pass
+    metrics.count('bytes_fetched', 100)
+    metrics.count('bytes_fetched', 20)
+
+    summary = metrics.summary({'artefact_dedup_hits': 3})
+    fetch = summary['stages']['fetch']
+    assert fetch['count'] == 5
+    assert fetch['total'] == 20.0
+    assert fetch['p50'] == 3.0
+    assert fetch['p95'] == 10.0
+    assert fetch['max'] == 10.0
+    assert summary['counters'] == {'bytes_fetched': 120,
+                                   'artefact_dedup_hits': 3}
+
+
+def test_hooks_wrap_every_span():
+    seen = []
+
+    @contextmanager
+    def hook(stage, url):
+        seen.append(('enter', stage, url))
+        yield
+        seen.append(('exit', stage, url))
+
+    metrics = RunMetrics()
+    metrics.add_hook(hook)
+    with metrics.span('persist', 'https://example.com'):
+        pass
+
+    assert seen == [('enter', 'persist', 'https://example.com'),
+                    ('exit', 'persist', 'https://example.com')]
+
+
+def test_run_records_each_stage(local_storage, tmpdir):
+    metrics = RunMetrics()
+    watcher = Observer(NoScreenshots(), FakeWebFetcher(tmpdir),
+                       metrics=metrics)
+    pages = [PageUnderObsevation(url='https://example.com/{}'.format(i))
+             for i in range(3)]
+
+    observe_the_web(Diffa(), local_storage, watcher, pages)
+
+    summary = metrics.summary()
+    for stage in ('page', 'previous', 'fetch', 'screenshot', 'diff',
+                  'persist'):
+        assert summary['stages'][stage]['count'] == 3
+    assert summary['counters']['bytes_fetched'] > 0
+
+
+def test_exports(tmpdir):
+    metrics = RunMetrics()
+    with metrics.span('fetch'):
+        pass
+    metrics.count('bytes_fetched', 42)
+
+    json_lines = str(tmpdir.join('metrics.jsonl'))
+    metrics.write_json_lines(json_lines)
+    metrics.write_json_lines(json_lines)
+    lines = [json.loads(line) for line in open(json_lines)]
+    assert [line.get('stage') for line in lines] == \
+        ['fetch', None, 'fetch', None]
+    assert lines[1]['counters'] == {'bytes_fetched': 42}
+
+    textfile = str(tmpdir.join('webwatcher.prom'))
+    metrics.write_prometheus(textfile, {'artefact_dedup_hits': 5})
+    text = open(textfile).read()
+    assert 'webwatcher_stage_seconds{stage="fetch",quantile="0.95"}' in text
+    assert 'webwatcher_stage_seconds_count{stage="fetch"} 1\n' in text
+    assert 'webwatcher_bytes_fetched_total 42\n' in text
+    assert 'webwatcher_artefact_dedup_hits_total 5\n' in text
+    assert not tmpdir.join('webwatcher.prom.updating').exists()
+
+
+def test_profiler_only_profiles_chosen_stages(tmpdir):
+    def fetching():
+        return sum(range(1000))
+
+    def persisting():
+        return sum(range(1000))
+
+    profiler = ProfilerHook(['fetch'])
+    metrics = RunMetrics()
+    metrics.add_hook(profiler)
+    with metrics.span('fetch'):
+        fetching()
+    with metrics.span('persist'):
+        persisting()
+
+    path = str(tmpdir.join('run.prof'))
+    profiler.write(path)
+
+    functions = {f[2] for f in pstats.Stats(path).stats}
+    assert 'fetching' in functions
+    assert 'persisting' not in functions
@@ -0,0 +1,52 @@
+
+import pytest
+
+from webwatcher.diffa import Diffa
+from webwatcher.main import Observer, observe_the_web
+from webwatcher.watchconfiguration import PageUnderObsevation
+
+from fakes import FakeWebFetcher, NoScreenshots
+
+
+def _pages(n):
+    return [PageUnderObsevation(url='https://example.com/{}'.format(i))
+            for i in range(n)]
+
+
+def test_concurrent_run_persists_every_page(local_storage, tmpdir):
+    fetcher = FakeWebFetcher(tmpdir)
+    watcher = Observer(NoScreenshots(), fetcher,
+                       max_fetches=2, max_screenshots=1)
+
+    observe_the_web(Diffa(), local_storage, watcher, _pages(20), workers=4)
+
+    records = local_storage.find().fetch()
+    assert len(records) == 20
+    assert {r['url'] for r in records} == {p.url for p in _pages(20)}
+
+
+def test_runs_without_differences_print_nothing(local_storage, tmpdir,
+                                                capsys):
+    watcher = Observer(NoScreenshots(), FakeWebFetcher(tmpdir))
+    observe_the_web(Diffa(), local_storage, watcher, _pages(3))
+    capsys.readouterr()
+
+    observe_the_web(Diffa(), local_storage, watcher, _pages(3))
+
+    out, _ = capsys.readouterr()
+    assert out == ''
+
+
+def test_concurrent_run_reports_errors_after_finishing(local_storage, tmpdir):
+    class ExplodingFetcher(FakeWebFetcher):
+        def fetch(self, url, validators=None):
+            if url.endswith('/3'):
+                raise RuntimeError('boom')
+            return super().fetch(url, validators)
+
+    watcher = Observer(NoScreenshots(), ExplodingFetcher(tmpdir))
+
+    with pytest.raises(RuntimeError):
+        observe_the_web(Diffa(), local_storage, watcher, _pages(8), workers=3)
+
+    assert len(local_storage.find().fetch()) == 7
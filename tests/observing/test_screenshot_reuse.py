@@ -0,0 +1,72 @@
+from hashlib import sha256
+
+from webwatcher.diffa import Diffa
+from webwatcher.main import Observer, observe_the_web
+from webwatcher.observation import Screenshot
+from webwatcher.watchconfiguration import PageUnderObsevation
+
+from fakes import FakeWebFetcher
+
+
+class CountingScreenshotter:
+    def __init__(self, tmpdir):
+        self._tmpdir = tmpdir
+        self.taken = []
+
+    def take_screenshot_of(self, url):
+        self.taken.append(url)
+        shot = self._tmpdir.join('shot{}.png'.format(len(self.taken)))
+        shot.write('pixels')
+        return Screenshot(content_hash=sha256(b'pixels').hexdigest(),
+                          content_path=str(shot))
+
+
+class SameContentFetcher(FakeWebFetcher):
+    def fetch(self, url, validators=None):
+        result = super().fetch(url, validators)
+        result.raw_content.sha256 = sha256(b'same every time').hexdigest()
+        return result
+
+
+class ChangingContentFetcher(FakeWebFetcher):
+    def fetch(self, url, validators=None):
+        result = super().fetch(url, validators)
+        result.raw_content.sha256 = \
+            sha256(str(len(self.fetched)).encode('utf-8')).hexdigest()
+        return result
+
+
+def _run_twice(storage, watcher, page):
+    observe_the_web(Diffa(), storage, watcher, [page])
+    observe_the_web(Diffa(), storage, watcher, [page])
+
+
+def test_unchanged_content_reuses_previous_screenshot(local_storage, tmpdir):
+    screenshotter = CountingScreenshotter(tmpdir)
+    watcher = Observer(screenshotter, SameContentFetcher(tmpdir))
+
+    _run_twice(local_storage, watcher, PageUnderObsevation('https://a'))
+
+    assert len(screenshotter.taken) == 1
+    first, second = local_storage.find().order_by('timestamp').fetch()
+    assert second['screenshot_content'] == first['screenshot_content']
+    assert second.fetch_local('screenshot') == first.fetch_local('screenshot')
+
+
+def test_changed_content_takes_new_screenshot(local_storage, tmpdir):
+    screenshotter = CountingScreenshotter(tmpdir)
+    watcher = Observer(screenshotter, ChangingContentFetcher(tmpdir))
+
+    _run_twice(local_storage, watcher, PageUnderObsevation('https://a'))
+
+    assert len(screenshotter.taken) == 2
+
+
+def test_forced_pages_always_get_a_screenshot(local_storage, tmpdir):
+    screenshotter = CountingScreenshotter(tmpdir)
+    watcher = Observer(screenshotter, SameContentFetcher(tmpdir))
+
+    _run_twice(local_storage, watcher,
+               PageUnderObsevation('https://a', force_screenshot=True))
+
+    assert len(screenshotter.taken) == 2
@@ -0,0 +1,102 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from webwatcher import browserpool
+from webwatcher.browserpool import BrowserPool, MarionetteClient, \
+    PageLoadTimeoutException
+from webwatcher.temporarystorage import TemporaryStorage
+
+
+def _packet(message):
+    payload = json.dumps(message).encode('utf-8')
+    return str(len(payload)).encode('ascii') + b':' + payload
+
+
+def test_marionette_client_frames_commands_and_responses():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    received = []
+
+    def serve():
+        conn, _ = server.accept()
+        with conn:
+            conn.sendall(_packet({'marionetteProtocol': 3}))
+            data = b''
+            while not data.endswith(b']'):
+                data += conn.recv(1024)
+            received.append(json.loads(data.partition(b':')[2]))
+            # split the response across writes to exercise buffering
+            response = _packet([1, 1, None, {'value': 'aGk='}])
+            conn.sendall(response[:3])
+            conn.sendall(response[3:])
+
+    t = threading.Thread(target=serve)
+    t.start()
+    client = MarionetteClient('127.0.0.1', server.getsockname()[1], 5)
+    result = client.send('WebDriver:TakeScreenshot', {'full': True})
+    t.join()
+    client.close()
+    server.close()
+
+    assert client.hello == {'marionetteProtocol': 3}
+    assert received == [[0, 1, 'WebDriver:TakeScreenshot', {'full': True}]]
+    assert result == {'value': 'aGk='}
+
+
+class _FakeBrowser:
+    started = []
+
+    def __init__(self, firefox_path, profile_dir, startup_timeout):
+        self.profile_dir = profile_dir
+        self.quit_called = False
+        _FakeBrowser.started.append(self)
+
+    def screenshot(self, url, page_timeout):
+        if 'slow' in url:
+            raise PageLoadTimeoutException('too slow')
+        if 'broken' in url:
+            raise ConnectionResetError()
+        return url.encode('utf-8')
+
+    def quit(self):
+        self.quit_called = True
+
+    def kill(self):
+        pass
+
+
+@pytest.fixture
+def fake_browsers(monkeypatch):
+    _FakeBrowser.started = []
+    monkeypatch.setattr(browserpool, '_Browser', _FakeBrowser)
+    return _FakeBrowser.started
+
+
+def test_pool_reuses_browsers_until_recycle_limit(tmpdir, fake_browsers):
+    pool = BrowserPool(TemporaryStorage(str(tmpdir)), 'firefox',
+                       size=1, recycle_after=3)
+
+    for i in range(7):
+        assert pool.screenshot('http://x/{}'.format(i)) == \
+            'http://x/{}'.format(i).encode('utf-8')
+    pool.close()
+
+    assert len(fake_browsers) == 3
+    assert len({b.profile_dir for b in fake_browsers}) == 1
+    assert all(b.quit_called for b in fake_browsers)
+
+
+def test_pool_keeps_browser_after_page_timeout(tmpdir, fake_browsers):
+    pool = BrowserPool(TemporaryStorage(str(tmpdir)), 'firefox', size=1)
+
+    with pytest.raises(PageLoadTimeoutException):
+        pool.screenshot('http://slow')
+    with pytest.raises(ConnectionResetError):
+        pool.screenshot('http://broken')
+    pool.screenshot('http://fine')
+
+    assert len(fake_browsers) == 2
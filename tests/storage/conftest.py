@@ -5,6 +5,6 @@ import pytest
 from webwatcher.storage import Storage
 
 
-@pytest.fixture
-def local_storage(tmpdir):
-    return Storage(storage_root=Path(str(tmpdir)))
+@pytest.fixture(params=['jsonlines', 'sqlite', 'binary'])
+def local_storage(tmpdir, request):
+    return Storage(storage_root=Path(str(tmpdir)), backend=request.param)
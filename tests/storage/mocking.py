@@ -1,3 +1,4 @@
+from datetime import datetime, timedelta, timezone
 
 
 class MockPersistable:
@@ -11,3 +12,16 @@ class MockPersistable:
     def get_meta_info(self):
         return self._meta
 
+
+def observation(url='https://example.com', minutes_ago=0, artefacts=None,
+                **meta):
+    """
+    An observation of `url` made `minutes_ago`, with any other `meta`
+    recorded alongside (which may override its timestamp).
+    """
+    return MockPersistable(artefacts=artefacts, meta=dict({
+        'url': url,
+        'minutes_ago': minutes_ago,
+        'timestamp':
+            datetime.now(timezone.utc) - timedelta(minutes=minutes_ago),
+    }, **meta))
@@ -0,0 +1,59 @@
+import os
+from pathlib import Path
+
+from webwatcher.artefact import Artefact
+from webwatcher.artefactstore import ArtefactStore
+
+
+def _file(tmpdir, name, content):
+    f = tmpdir.join(name)
+    f.write(content)
+    return str(f)
+
+
+def test_disposable_artefacts_are_moved_in(tmpdir):
+    store = ArtefactStore(Path(str(tmpdir.join('store'))))
+    source = _file(tmpdir, 'temp', 'data')
+    artefact = Artefact(source, disposable=True)
+
+    stored = store.put(artefact)
+
+    assert not os.path.exists(source)
+    assert stored.read_text() == 'data'
+    assert artefact.path == str(stored)
+
+
+def test_duplicates_are_not_written_again(tmpdir):
+    store = ArtefactStore(Path(str(tmpdir.join('store'))))
+    first = store.put(Artefact(_file(tmpdir, 'a', 'data'), disposable=True))
+    duplicate = _file(tmpdir, 'b', 'data')
+
+    second = store.put(Artefact(duplicate, disposable=True))
+
+    assert first == second
+    assert not os.path.exists(duplicate)
+    assert store.stats.writes == 1
+    assert store.stats.hits == 1
+    assert store.stats.hit_ratio == 0.5
+
+
+def test_other_artefacts_are_copied_and_left_alone(tmpdir):
+    store = ArtefactStore(Path(str(tmpdir.join('store'))))
+    source = _file(tmpdir, 'mine', 'data')
+
+    stored = store.put(Artefact(source))
+
+    assert os.path.exists(source)
+    assert stored.read_text() == 'data'
+    assert os.listdir(str(store.root)) == [stored.name]
+
+
+def test_storing_a_stored_artefact_is_a_hit(tmpdir):
+    store = ArtefactStore(Path(str(tmpdir.join('store'))))
+    stored = store.put(Artefact(_file(tmpdir, 'a', 'data'), disposable=True))
+
+    again = store.put(Artefact(str(stored)))
+
+    assert again == stored
+    assert stored.exists()
+    assert store.stats.hits == 1
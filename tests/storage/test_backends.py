@@ -0,0 +1,62 @@
+
+from pathlib import Path
+import threading
+import time
+
+from webwatcher.recordstore import JsonLinesRecordStore
+from webwatcher.storage import Storage
+
+from mocking import observation
+
+
+def test_sqlite_backend_migrates_existing_records(tmpdir):
+    root = Path(str(tmpdir))
+    legacy = Storage(storage_root=root, backend='jsonlines')
+    legacy.persist(observation('https://example.com', minutes_ago=2))
+    legacy.persist(observation('https://example.com', minutes_ago=1))
+
+    migrated = Storage(storage_root=root, backend='sqlite')
+
+    assert len(migrated.find(url='https://example.com').fetch()) == 2
+    assert not (root / 'record.dat').exists()
+    assert (root / 'record.dat.migrated').exists()
+
+
+def test_records_are_migrated_only_once(tmpdir):
+    root = Path(str(tmpdir))
+    legacy = Storage(storage_root=root, backend='jsonlines')
+    legacy.persist(observation('https://example.com', minutes_ago=1))
+    opened = []
+
+    def open_sqlite():
+        opened.append(Storage(storage_root=root, backend='sqlite'))
+
+    # A migration waits for whoever holds the records, then finds that
+    # it has nothing left to do if they migrated them first
+    with JsonLinesRecordStore(root).exclusive():
+        starting = [threading.Thread(target=open_sqlite) for _ in range(2)]
+        for thread in starting:
+            thread.start()
+        time.sleep(0.2)
+        assert (root / 'record.dat').exists()
+    for thread in starting:
+        thread.join()
+
+    assert len(opened) == 2
+    for storage in opened:
+        assert len(storage.find().fetch()) == 1
+
+
+def test_sqlite_backend_orders_history_by_timestamp(tmpdir):
+    storage = Storage(storage_root=Path(str(tmpdir)), backend='sqlite')
+    storage.persist(observation('https://example.com', minutes_ago=5))
+    storage.persist(observation('https://example.com', minutes_ago=1))
+    storage.persist(observation('https://example.org', minutes_ago=0))
+    storage.persist(observation('https://example.com', minutes_ago=3))
+
+    results = storage.find(url='https://example.com') \
+        .having('timestamp') \
+        .order_by('timestamp', desc=True) \
+        .fetch()
+
+    assert [r['minutes_ago'] for r in results] == [1, 3, 5]
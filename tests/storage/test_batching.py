@@ -0,0 +1,131 @@
+import os
+from pathlib import Path
+import threading
+import time
+
+import pytest
+
+from webwatcher.storage import Storage
+
+from mocking import observation
+
+
+def _lines(root):
+    try:
+        return (root / 'record.dat').read_text().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def test_batched_records_are_written_together(tmpdir):
+    root = Path(str(tmpdir))
+    storage = Storage(storage_root=root)
+
+    with storage.batch(max_records=3, max_delay=60):
+        storage.persist(observation(minutes_ago=5))
+        storage.persist(observation(minutes_ago=4))
+        assert _lines(root) == []
+        storage.persist(observation(minutes_ago=3))
+        assert len(_lines(root)) == 3
+        storage.persist(observation(minutes_ago=2))
+        assert len(_lines(root)) == 3
+
+    assert len(_lines(root)) == 4
+
+
+def test_waiting_records_can_be_found(tmpdir):
+    root = Path(str(tmpdir))
+    storage = Storage(storage_root=root)
+    storage.persist(observation(minutes_ago=2))
+
+    with storage.batch(max_records=10, max_delay=60):
+        storage.persist(observation(minutes_ago=1))
+        assert storage.latest('https://example.com')['minutes_ago'] == 1
+        assert len(_lines(root)) == 1
+
+        assert len(storage.find().fetch()) == 2
+        assert storage.find(minutes_ago=1).first()['minutes_ago'] == 1
+        # Finding them doesn't commit them early
+        assert len(_lines(root)) == 1
+
+
+def test_records_are_committed_soon_after_they_start_waiting(tmpdir):
+    root = Path(str(tmpdir))
+    storage = Storage(storage_root=root)
+
+    with storage.batch(max_records=10, max_delay=0.05):
+        storage.persist(observation(minutes_ago=1))
+        deadline = time.monotonic() + 5
+        while not _lines(root) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(_lines(root)) == 1
+
+
+def test_one_fsync_of_the_records_per_batch(tmpdir, monkeypatch):
+    storage = Storage(storage_root=Path(str(tmpdir.mkdir('storage'))),
+                      durability='fsync')
+    synced = []
+    real_fsync = os.fsync
+
+    def fsync(fd):
+        synced.append(os.readlink('/proc/self/fd/{}'.format(fd)))
+        real_fsync(fd)
+
+    monkeypatch.setattr(os, 'fsync', fsync)
+
+    with storage.batch(max_records=10, max_delay=60):
+        for i in range(5):
+            content = tmpdir.join('content{}'.format(i))
+            content.write('page {}'.format(i))
+            storage.persist(observation(
+                minutes_ago=i, artefacts={'raw_content': str(content)}))
+
+    assert len([p for p in synced if p.endswith('record.dat')]) == 1
+    assert len([p for p in synced if '/artefacts/' in p]) == 5
+
+
+def test_unknown_durability_is_refused(tmpdir):
+    with pytest.raises(ValueError):
+        Storage(storage_root=Path(str(tmpdir)), durability='sometimes')
+
+
+def test_records_committed_during_a_query_are_found_once(tmpdir):
+    root = Path(str(tmpdir))
+    storage = Storage(storage_root=root)
+    storage.persist(observation(minutes_ago=2))
+
+    with storage.batch(max_records=10, max_delay=60):
+        storage.persist(observation(minutes_ago=1))
+        stream = storage.find().stream()
+        first = next(stream)
+        storage.commit()
+        rest = list(stream)
+
+    assert sorted(r['minutes_ago'] for r in [first] + rest) == [1, 2]
+
+
+def test_records_being_committed_when_a_query_starts_are_found_once(tmpdir):
+    storage = Storage(storage_root=Path(str(tmpdir)))
+    append_all = storage._records.append_all
+    written = threading.Event()
+    carry_on = threading.Event()
+
+    def appending(records, durable=False):
+        append_all(records, durable=durable)
+        written.set()
+        carry_on.wait(5)
+
+    storage._records.append_all = appending
+    with storage.batch(max_records=10, max_delay=60):
+        storage.persist(observation(minutes_ago=1))
+        committing = threading.Thread(target=storage.commit)
+        committing.start()
+        try:
+            assert written.wait(5)
+            # Written, but still pending until the commit finishes
+            found = [r['minutes_ago'] for r in storage.find().fetch()]
+        finally:
+            carry_on.set()
+            committing.join()
+
+    assert found == [1]
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+from webwatcher.recordstore import BinaryRecordStore, JsonLinesRecordStore, \
+    convert_records
+from webwatcher.storage import Storage
+
+from mocking import observation
+
+
+def _records():
+    start = datetime(2020, 1, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    return [
+        {'url': 'https://example.com', 'timestamp': start, 'n': 0},
+        {'url': 'https://example.org', 'timestamp': start.astimezone(
+            timezone(timedelta(hours=-5))), 'n': 1},
+        {'url': 'https://example.com',
+         'timestamp': start + timedelta(microseconds=1), 'n': 2,
+         'first_seen': start, 'tags': ['a', 'b']},
+        {'type': 'note', 'n': 3},
+        {'url': None, 'timestamp': None, 'n': 4},
+    ]
+
+
+def test_records_read_back_as_written(tmpdir):
+    store = BinaryRecordStore(Path(str(tmpdir)))
+    store.append_all(_records()[:2])
+    for record in _records()[2:]:
+        store.append(record)
+
+    read = list(store.scan({}, ()))
+
+    assert read == _records()
+    assert read[1]['timestamp'].utcoffset() == timedelta(hours=-5)
+    assert store.latest('https://example.com')['n'] == 2
+    assert [r['n'] for r in store.scan({'url': 'https://example.org'}, ())] \
+        == [1]
+
+
+def test_reads_the_same_as_json_lines(tmpdir):
+    binary = BinaryRecordStore(Path(str(tmpdir.mkdir('binary'))))
+    json_lines = JsonLinesRecordStore(Path(str(tmpdir.mkdir('jsonlines'))))
+    for store in (binary, json_lines):
+        store.replace_all(_records())
+
+    assert list(binary.scan({}, ())) == list(json_lines.scan({}, ()))
+
+
+def test_torn_frames_are_skipped_and_then_overwritten(tmpdir):
+    root = Path(str(tmpdir))
+    store = BinaryRecordStore(root)
+    store.append_all(_records()[:2])
+    with open(str(root / 'record.bin'), 'ab') as f:
+        f.write(b'R\x40\x00\x00\x00partial')
+
+    assert [r['n'] for r in BinaryRecordStore(root).scan({}, ())] == [0, 1]
+
+    BinaryRecordStore(root).append(_records()[2])
+
+    assert [r['n'] for r in store.scan({}, ())] == [0, 1, 2]
+    assert store.latest('https://example.com')['n'] == 2
+
+
+def test_conversion_covers_every_segment(tmpdir):
+    root = Path(str(tmpdir))
+    Storage(storage_root=root).persist(observation(minutes_ago=2))
+    Storage(storage_root=root, segment='shard-1-of-1').persist(
+        observation(minutes_ago=1))
+
+    assert convert_records(root, 'jsonlines', 'binary') == 2
+
+    assert (root / 'record.dat.converted').exists()
+    assert not (root / 'record.dat').exists()
+    storage = Storage(storage_root=root, backend='binary')
+    assert sorted(r['minutes_ago'] for r in storage.find().fetch()) == [1, 2]
+    assert storage.latest('https://example.com')['minutes_ago'] == 1
+
+    assert convert_records(root, 'binary', 'sqlite') == 2
+    assert len(Storage(storage_root=root, backend='sqlite')
+               .find().fetch()) == 2
+
+
+def test_conversion_wont_mix_records(tmpdir):
+    root = Path(str(tmpdir))
+    Storage(storage_root=root).persist(observation(minutes_ago=2))
+    Storage(storage_root=root, backend='binary').persist(
+        observation(minutes_ago=1))
+
+    with pytest.raises(ValueError):
+        convert_records(root, 'jsonlines', 'binary')
+    assert (root / 'record.dat').exists()
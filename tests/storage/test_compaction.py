@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta, timezone
+import os
+
+from webwatcher.retention import RetentionPolicy
+
+from mocking import observation
+
+
+_NOW = datetime(2020, 6, 1, tzinfo=timezone.utc)
+
+
+def _observation(url, days_ago, state='same', artefacts=None):
+    return observation(url,
+                       artefacts=artefacts,
+                       timestamp=_NOW - timedelta(days=days_ago),
+                       was_available=True,
+                       screenshot_content=state,
+                       days_ago=days_ago)
+
+
+def _kept(storage, url):
+    return sorted(r['days_ago'] for r in storage.find(url=url).fetch())
+
+
+def test_keeps_newest_and_changed_observations(local_storage):
+    for days_ago in range(10, 0, -1):
+        state = 'changed' if days_ago == 6 else 'same'
+        local_storage.persist(_observation('https://a', days_ago, state))
+
+    policy = RetentionPolicy(keep_last=2)
+    report = local_storage.compact(
+        lambda records: policy.select(records, now=_NOW))
+
+    # the first sighting, the change, the change back, the newest two
+    assert _kept(local_storage, 'https://a') == [1, 2, 5, 6, 10]
+    assert report.records_before == 10
+    assert report.records_after == 5
+
+
+def test_keeps_recent_days(local_storage):
+    for days_ago in range(10, 0, -1):
+        local_storage.persist(_observation('https://a', days_ago))
+
+    policy = RetentionPolicy(keep_last=1, keep_days=3.5)
+    local_storage.compact(lambda records: policy.select(records, now=_NOW))
+
+    assert _kept(local_storage, 'https://a') == [1, 2, 3, 10]
+
+
+def test_removes_artefacts_nothing_refers_to(local_storage, tmpdir):
+    def content(text):
+        f = tmpdir.join(text)
+        f.write(text)
+        return str(f)
+
+    local_storage.persist(_observation(
+        'https://a', 3, artefacts={'raw_content': content('old')}))
+    local_storage.persist(_observation(
+        'https://a', 2, artefacts={'raw_content': content('new')}))
+    local_storage.persist(_observation(
+        'https://a', 1, artefacts={'raw_content': content('new')}))
+
+    report = local_storage.compact(
+        lambda records: [r for r in records if r['days_ago'] != 3],
+        grace_period=timedelta(0))
+
+    remaining = local_storage.find().fetch()
+    assert report.artefacts_removed == 1
+    assert all(os.path.exists(r.fetch_local('raw_content'))
+               for r in remaining)
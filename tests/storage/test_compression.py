@@ -0,0 +1,118 @@
+from datetime import datetime, timezone
+from hashlib import sha256
+import os
+from pathlib import Path
+
+import pytest
+
+from webwatcher.artefact import Artefact
+from webwatcher.artefactstore import ArtefactStore
+from webwatcher.compression import open_artefact
+from webwatcher.contentdiff import ContentDiffer
+from webwatcher.storage import Storage
+
+from mocking import MockPersistable
+
+
+_PAGE = b'<html><body>' + b'<p>Hello, world</p>' * 200 + b'</body></html>'
+
+
+def _file(tmpdir, name, content):
+    f = tmpdir.join(name)
+    f.write_binary(content)
+    return str(f)
+
+
+def test_compressed_blobs_read_back_as_the_original(tmpdir):
+    store = ArtefactStore(Path(str(tmpdir.join('store'))), compression='gzip')
+
+    stored = store.put(Artefact(_file(tmpdir, 'page', _PAGE)))
+
+    assert stored.name.endswith('.gz')
+    assert stored.stat().st_size < len(_PAGE) / 5
+    with open_artefact(str(stored)) as f:
+        assert f.read() == _PAGE
+    assert store.stats.bytes_saved_by_compression == \
+        len(_PAGE) - stored.stat().st_size
+
+
+def test_blobs_are_addressed_by_their_uncompressed_contents(tmpdir):
+    root = Path(str(tmpdir.join('store')))
+    plain = ArtefactStore(root).put(Artefact(_file(tmpdir, 'a', _PAGE)))
+    compressing = ArtefactStore(root, compression='gzip')
+
+    again = compressing.put(Artefact(_file(tmpdir, 'b', _PAGE)))
+
+    assert again == plain
+    assert compressing.stats.hits == 1
+    described = Artefact(str(again)).described()
+    assert described.sha256 == sha256(_PAGE).hexdigest()
+
+
+def test_already_compressed_formats_are_stored_as_they_are(tmpdir):
+    png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 1000
+    store = ArtefactStore(Path(str(tmpdir.join('store'))), compression='gzip')
+
+    stored = store.put(Artefact(_file(tmpdir, 'shot.png', png)))
+
+    assert not stored.name.endswith('.gz')
+    assert stored.read_bytes() == png
+
+
+def test_stored_content_can_be_opened_and_diffed(tmpdir):
+    storage = Storage(storage_root=Path(str(tmpdir.join('storage'))),
+                      compression='gzip')
+    changed = _PAGE.replace(b'Hello, world', b'Goodbye', 1)
+    for name, content in (('old', _PAGE), ('new', changed)):
+        storage.persist(MockPersistable(
+            artefacts={'raw_content': _file(tmpdir, name, content)},
+            meta={'name': name}))
+
+    old = storage.find(name='old').first()
+    new = storage.find(name='new').first()
+    with old.open('raw_content') as f:
+        assert f.read() == _PAGE
+
+    diff = ContentDiffer().diff(old.fetch_local('raw_content'),
+                                new.fetch_local('raw_content'))
+    assert diff.examples == ['Goodbye']
+
+
+def test_stored_blobs_are_reused_without_reading_them(tmpdir, monkeypatch):
+    storage = Storage(storage_root=Path(str(tmpdir.join('storage'))),
+                      compression='gzip', max_delta_chain=2)
+    changed = _PAGE.replace(b'Hello, world', b'Goodbye', 1)
+    for n, content in enumerate((_PAGE, changed)):
+        storage.persist(MockPersistable(
+            artefacts={'raw_content': _file(tmpdir, str(n), content)},
+            meta={'url': 'https://example.com', 'n': n,
+                  'timestamp': datetime(2026, 1, 1, n, tzinfo=timezone.utc)}))
+    stored = storage.latest('https://example.com').fetch_local('raw_content')
+    assert stored.endswith('.delta')
+
+    def no_reading(path):
+        raise AssertionError('Read {}'.format(path))
+
+    monkeypatch.setattr('webwatcher.artefact.open_artefact', no_reading)
+    monkeypatch.setattr('webwatcher.artefactstore.open_artefact', no_reading)
+    # As a previous observation recorded before sizes were
+    reused = Artefact(stored, sha256=sha256(changed).hexdigest())
+    storage.persist(MockPersistable(
+        artefacts={'raw_content': reused},
+        meta={'url': 'https://example.com', 'n': 2,
+              'timestamp': datetime(2026, 1, 1, 2, tzinfo=timezone.utc)}))
+
+    assert storage.find(n=2).first().fetch_local('raw_content') == stored
+    assert storage.artefact_stats.hits == 1
+    assert reused.described().size == len(changed)
+
+
+def test_zstd(tmpdir):
+    pytest.importorskip('zstandard')
+    store = ArtefactStore(Path(str(tmpdir.join('store'))), compression='zstd')
+
+    stored = store.put(Artefact(_file(tmpdir, 'page', _PAGE)))
+
+    assert stored.name.endswith('.zst')
+    with open_artefact(str(stored)) as f:
+        assert f.read() == _PAGE
@@ -0,0 +1,68 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from pathlib import Path
+import time
+
+import pytest
+
+from webwatcher.storage import Storage
+
+from mocking import observation
+
+
+@pytest.fixture(params=['jsonlines', 'sqlite', 'binary'])
+def backend(request):
+    return request.param
+
+
+def _write_records(root, backend, writer, count):
+    storage = Storage(storage_root=Path(root), backend=backend)
+    for i in range(count):
+        storage.persist(observation('https://example.com/{}'.format(writer),
+                                    writer=writer, n=i))
+
+
+def test_processes_can_write_at_the_same_time(tmpdir, backend):
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        for future in [executor.submit(_write_records, str(tmpdir), backend,
+                                       writer, 50)
+                       for writer in range(4)]:
+            future.result()
+
+    records = Storage(storage_root=Path(str(tmpdir)), backend=backend) \
+        .find().fetch()
+    assert sorted((r['writer'], r['n']) for r in records) == \
+        [(writer, n) for writer in range(4) for n in range(50)]
+
+
+def test_writers_wait_for_an_exclusive_hold(tmpdir, backend):
+    storage = Storage(storage_root=Path(str(tmpdir)), backend=backend)
+    storage.persist(observation('https://example.com/0', writer=0, n=0))
+
+    writer = multiprocessing.Process(
+        target=_write_records, args=(str(tmpdir), backend, 1, 1))
+    with storage._records.exclusive():
+        writer.start()
+        time.sleep(0.5)
+        assert len(storage.find().fetch()) == 1
+    writer.join(10)
+
+    assert len(storage.find().fetch()) == 2
+
+
+def test_torn_records_are_skipped(tmpdir):
+    root = Path(str(tmpdir))
+    storage = Storage(storage_root=root)
+    storage.persist(observation('https://example.com/0', writer=0, n=0))
+    with open(str(root / 'record.dat'), 'ab') as f:
+        f.write(b'{"url": "https://exa')
+
+    assert [r['n'] for r in storage.find().fetch()] == [0]
+    assert storage.latest('https://example.com/0')['n'] == 0
+
+    storage.persist(observation('https://example.com/0', writer=0, n=1))
+
+    assert [r['n'] for r in storage.find().fetch()] == [0, 1]
+    assert storage.latest('https://example.com/0')['n'] == 1
+    assert Storage(storage_root=root).latest('https://example.com/0')['n'] \
+        == 1
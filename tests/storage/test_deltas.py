@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta, timezone
+import os
+import time
+from pathlib import Path
+
+from webwatcher.delta import apply_delta, make_delta
+from webwatcher.storage import Storage
+
+from mocking import MockPersistable
+
+
+def _version(n):
+    rows = ''.join('<tr><td>row {}</td><td>{}</td></tr>\n'.format(
+        i, n if i == 50 else i) for i in range(200))
+    return '<html><body><table>\n{}</table></body></html>\n'.format(rows)
+
+
+def _persist_version(storage, tmpdir, url, n):
+    content = tmpdir.join('v{}'.format(n))
+    content.write(_version(n))
+    storage.persist(MockPersistable(
+        artefacts={'raw_content': str(content)},
+        meta={'url': url,
+              'version': n,
+              'timestamp': datetime(2026, 1, 1, tzinfo=timezone.utc) +
+              timedelta(hours=n)}))
+
+
+def _stored(storage, n):
+    record = storage.find(version=n).first()
+    with record.open('raw_content') as f:
+        return record.fetch_local('raw_content'), f.read().decode('utf-8')
+
+
+def test_deltas_rebuild_the_original():
+    old = b'<p>one</p>\n<p>two</p>\n<p>three</p>\n'
+    for new in (b'<p>one</p>\n<p>2</p>\n<p>three</p>\n',
+                b'',
+                b'no separators at all',
+                old + b'<p>four</p>'):
+        assert apply_delta(old, make_delta(old, new)) == new
+
+
+def test_repetitive_pages_are_delta_encoded_quickly():
+    def rows(text):
+        return ''.join('<tr><td>{}</td><td>cell</td></tr>\n'.format(text(i))
+                       for i in range(8000)).encode('utf-8')
+
+    old = rows(lambda i: 'old' if i % 97 == 0 else 'same')
+    new = rows(lambda i: 'new' if i % 89 == 0 else 'same')
+
+    started = time.monotonic()
+    delta = make_delta(old, new)
+
+    assert time.monotonic() - started < 5
+    assert apply_delta(old, delta) == new
+    assert sum(len(i) for i in delta if isinstance(i, bytes)) < 1000
+
+
+def test_chains_are_capped_with_full_copies(tmpdir):
+    storage = Storage(storage_root=Path(str(tmpdir.join('storage'))),
+                      max_delta_chain=2)
+
+    for n in range(6):
+        _persist_version(storage, tmpdir, 'https://example.com', n)
+
+    kinds = []
+    for n in range(6):
+        location, content = _stored(storage, n)
+        assert content == _version(n)
+        kinds.append('delta' if location.endswith('.delta') else 'full')
+    assert kinds == ['full', 'delta', 'delta', 'full', 'delta', 'delta']
+    assert storage.artefact_stats.deltas == 4
+    assert storage.artefact_stats.bytes_saved_by_deltas > \
+        3 * len(_version(0))
+
+
+def test_pages_only_build_on_their_own_history(tmpdir):
+    storage = Storage(storage_root=Path(str(tmpdir.join('storage'))),
+                      max_delta_chain=5)
+
+    _persist_version(storage, tmpdir, 'https://example.com', 0)
+    _persist_version(storage, tmpdir, 'https://example.org', 1)
+
+    assert not _stored(storage, 1)[0].endswith('.delta')
+
+
+def test_garbage_collection_keeps_delta_bases(tmpdir):
+    storage = Storage(storage_root=Path(str(tmpdir.join('storage'))),
+                      max_delta_chain=3)
+    for n in range(3):
+        _persist_version(storage, tmpdir, 'https://example.com', n)
+
+    storage.compact(lambda records: records[-1:], grace_period=timedelta(0))
+
+    location, content = _stored(storage, 2)
+    assert content == _version(2)
+    assert len(os.listdir(os.path.dirname(location))) == 3
+
+
+def test_garbage_collection_keeps_bases_of_recent_deltas(tmpdir):
+    storage = Storage(storage_root=Path(str(tmpdir.join('storage'))),
+                      max_delta_chain=3)
+    for n in range(2):
+        _persist_version(storage, tmpdir, 'https://example.com', n)
+    base, _ = _stored(storage, 0)
+    delta, _ = _stored(storage, 1)
+    an_hour_ago = time.time() - 3600
+    os.utime(base, (an_hour_ago, an_hour_ago))
+
+    # The delta is still inside the grace period, as if its record were
+    # yet to be written, so the base it was built on has to stay too
+    storage.compact(lambda records: [], grace_period=timedelta(minutes=30))
+
+    assert sorted(os.listdir(os.path.dirname(delta))) == \
+        sorted(os.path.basename(path) for path in (base, delta))
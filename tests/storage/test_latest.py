@@ -0,0 +1,76 @@
+import os
+from pathlib import Path
+
+from webwatcher.storage import Storage
+
+from mocking import observation
+
+
+def test_latest_is_most_recent_by_timestamp(local_storage):
+    local_storage.persist(observation('https://example.com', minutes_ago=5))
+    local_storage.persist(observation('https://example.com', minutes_ago=1))
+    local_storage.persist(observation('https://example.org', minutes_ago=0))
+    local_storage.persist(observation('https://example.com', minutes_ago=3))
+
+    assert local_storage.latest('https://example.com')['minutes_ago'] == 1
+    assert local_storage.latest('https://example.org')['minutes_ago'] == 0
+    assert local_storage.latest('https://example.net') is None
+
+
+def test_latest_follows_compaction(local_storage):
+    for minutes_ago in (3, 2, 1):
+        local_storage.persist(
+            observation('https://example.com', minutes_ago))
+
+    local_storage.compact(
+        lambda records: [r for r in records if r['minutes_ago'] != 1])
+
+    assert local_storage.latest('https://example.com')['minutes_ago'] == 2
+
+
+def test_index_is_caught_up_with_records_written_elsewhere(tmpdir):
+    root = Path(str(tmpdir))
+    storage = Storage(storage_root=root)
+    storage.persist(observation('https://example.com', minutes_ago=2))
+    assert storage.latest('https://example.com')['minutes_ago'] == 2
+
+    # e.g. another process, or a version from before the index existed
+    Storage(storage_root=root).persist(
+        observation('https://example.com', minutes_ago=1))
+    (root / 'record.latest').unlink()
+    Storage(storage_root=root).persist(
+        observation('https://example.com', minutes_ago=0))
+
+    assert storage.latest('https://example.com')['minutes_ago'] == 0
+    assert Storage(storage_root=root) \
+        .latest('https://example.com')['minutes_ago'] == 0
+
+
+def test_index_is_rebuilt_when_records_are_rewritten(tmpdir):
+    root = Path(str(tmpdir))
+    storage = Storage(storage_root=root)
+    storage.persist(observation('https://example.org', minutes_ago=9))
+    storage.persist(observation('https://example.com', minutes_ago=1))
+    storage.latest('https://example.com')
+
+    lines = (root / 'record.dat').read_text().splitlines(keepends=True)
+    (root / 'record.dat').write_text(lines[1] + lines[0])
+
+    assert storage.latest('https://example.com')['minutes_ago'] == 1
+    assert storage.latest('https://example.org')['minutes_ago'] == 9
+
+
+def test_index_is_rebuilt_when_records_are_replaced(tmpdir):
+    root = Path(str(tmpdir))
+    storage = Storage(storage_root=root)
+    for minutes_ago in (3, 2):
+        storage.persist(observation('https://example.com', minutes_ago))
+    assert storage.latest('https://example.com')['minutes_ago'] == 2
+
+    # A new file of the same size, where the record at the indexed
+    # offset is for the same url but is no longer the latest
+    lines = (root / 'record.dat').read_text().splitlines(keepends=True)
+    (root / 'record.new').write_text(lines[1] + lines[0])
+    os.replace(str(root / 'record.new'), str(root / 'record.dat'))
+
+    assert storage.latest('https://example.com')['minutes_ago'] == 2
@@ -1,6 +1,8 @@
-
+import base64
 from pathlib import Path
 
+from webwatcher.artefact import Artefact
+
 from mocking import MockPersistable
 
 
@@ -31,3 +33,19 @@ def test_can_retrieve_thing_from_storage(local_storage, tmpdir):
     retreived = storage.find().fetch()[0]
     assert Path(retreived.fetch_local('some_file')).exists()
 
+
+def test_persisting_described_artefact_does_not_rehash(local_storage, tmpdir):
+    storage = local_storage
+    artefact = tmpdir.join('some_file')
+    artefact.write('sample_data')
+    recorded_hash = 'ab' * 32
+
+    storage.persist(MockPersistable(
+        artefacts={
+            'some_file': Artefact(str(artefact), sha256=recorded_hash, size=11)
+        }
+    ))
+
+    stored = Path(storage.find().fetch()[0].fetch_local('some_file'))
+    assert stored.name == base64.b64encode(
+        bytes.fromhex(recorded_hash), altchars=b'_-').decode('utf-8')
@@ -1,3 +1,4 @@
+from datetime import datetime, timedelta, timezone
 
 from mocking import MockPersistable
 
@@ -32,6 +33,50 @@ def test_query_ordering(local_storage):
     assert c['attrib1'] == 'a'
 
 
+def test_limit_and_first_respect_ordering(local_storage):
+    for i in (3, 1, 4, 1, 5, 9, 2, 6):
+        local_storage.persist(_persisted_thing(n=i, kind='digit'))
+    local_storage.persist(_persisted_thing(kind='letter'))
+
+    query = local_storage.find(kind='digit').having('n')
+    top = query.order_by('n', desc=True).limit(3).fetch()
+    assert [r['n'] for r in top] == [9, 6, 5]
+    assert query.order_by('n').first()['n'] == 1
+    assert local_storage.find(kind='none').first() is None
+
+
+def test_stream_stops_reading_at_the_limit(local_storage, monkeypatch):
+    for i in range(5):
+        local_storage.persist(_persisted_thing(n=i))
+    records = local_storage._records
+    scan_raw = records.scan_raw
+    read = []
+
+    def reading(*args):
+        for record in scan_raw(*args):
+            read.append(record['n'])
+            yield record
+
+    monkeypatch.setattr(records, 'scan_raw', reading)
+    stream = local_storage.find().limit(2).stream()
+
+    assert next(stream)['n'] == 0
+    assert next(stream)['n'] == 1
+    assert next(stream, None) is None
+    assert read == [0, 1]
+
+
+def test_dates_are_decoded_and_filterable(local_storage):
+    when = datetime(2026, 3, 1, 12, 30, tzinfo=timezone.utc)
+    local_storage.persist(_persisted_thing(n=1, at=when))
+    local_storage.persist(_persisted_thing(n=2, at=when + timedelta(days=1)))
+
+    found = local_storage.find(at=when).first()
+
+    assert found['n'] == 1
+    assert found['at'] == when
+
+
 def _persisted_thing(**kwargs):
     return MockPersistable(meta=kwargs)
 
@@ -0,0 +1,102 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from webwatcher.sharding import Shard
+from webwatcher.storage import Storage
+
+from mocking import observation
+
+
+@pytest.fixture(params=['jsonlines', 'sqlite', 'binary'])
+def backend(request):
+    return request.param
+
+
+def test_shards_split_the_pages_between_them():
+    urls = ['https://example.com/{}'.format(i) for i in range(200)]
+    shards = [Shard.parse('{}/4'.format(i)) for i in range(1, 5)]
+
+    shares = [[url for url in urls if shard.contains(url)]
+              for shard in shards]
+
+    assert sorted(url for share in shares for url in share) == sorted(urls)
+    assert all(share for share in shares)
+
+
+@pytest.mark.parametrize('arg', ['0/4', '5/4', '1/0', 'one/4', '3'])
+def test_nonexistent_shards_are_refused(arg):
+    with pytest.raises(ValueError):
+        Shard.parse(arg)
+
+
+def test_queries_read_every_segment(tmpdir, backend):
+    root = Path(str(tmpdir))
+    Storage(storage_root=root, backend=backend).persist(
+        observation('https://example.com', minutes_ago=3))
+    Storage(storage_root=root, backend=backend, segment='shard-1-of-2') \
+        .persist(observation('https://example.com', minutes_ago=1))
+    Storage(storage_root=root, backend=backend, segment='shard-2-of-2') \
+        .persist(observation('https://example.org', minutes_ago=2))
+
+    storage = Storage(storage_root=root, backend=backend)
+
+    assert sorted(r['minutes_ago'] for r in storage.find().fetch()) == \
+        [1, 2, 3]
+    assert storage.latest('https://example.com')['minutes_ago'] == 1
+    assert storage.find(url='https://example.org').first()['minutes_ago'] \
+        == 2
+
+
+def test_segments_written_while_open_are_read(tmpdir, backend):
+    root = Path(str(tmpdir))
+    storage = Storage(storage_root=root, backend=backend)
+    assert storage.latest('https://example.com') is None
+
+    Storage(storage_root=root, backend=backend, segment='shard-1-of-1') \
+        .persist(observation('https://example.com', minutes_ago=1))
+
+    assert storage.latest('https://example.com')['minutes_ago'] == 1
+
+
+def test_merging_folds_segments_into_the_main_records(tmpdir, backend):
+    root = Path(str(tmpdir))
+    Storage(storage_root=root, backend=backend).persist(
+        observation('https://example.com', minutes_ago=3))
+    for i, minutes_ago in ((1, 2), (2, 1)):
+        Storage(storage_root=root, backend=backend,
+                segment='shard-{}-of-2'.format(i)).persist(
+            observation('https://example.com', minutes_ago))
+
+    storage = Storage(storage_root=root, backend=backend)
+    assert storage.merge_segments() == 2
+    assert storage.merge_segments() == 0
+
+    assert not any((root / 'segments').iterdir())
+    reopened = Storage(storage_root=root, backend=backend)
+    assert sorted(r['minutes_ago'] for r in reopened.find().fetch()) == \
+        [1, 2, 3]
+    assert reopened.latest('https://example.com')['minutes_ago'] == 1
+
+
+def test_merged_records_are_on_disk_before_segments_go(tmpdir, backend):
+    root = Path(str(tmpdir))
+    for i in (1, 2):
+        Storage(storage_root=root, backend=backend,
+                segment='shard-{}-of-2'.format(i)).persist(
+            observation('https://example.com', minutes_ago=i))
+    storage = Storage(storage_root=root, backend=backend)
+    main = storage._records._main
+    append_all = main.append_all
+    writes = []
+
+    def appending(records, durable=False):
+        writes.append((len(records), durable,
+                       sorted(os.listdir(str(root / 'segments')))))
+        append_all(records, durable=durable)
+
+    main.append_all = appending
+    storage.merge_segments()
+
+    assert writes == [(2, True, ['shard-1-of-2', 'shard-2-of-2'])]